@@ -1,10 +1,42 @@
+import itertools
 import json
 import os
 import web_crawler
 import numpy as np
-from collections import defaultdict
 import preprocessing_pipelines
 from utils.lang_detector import LangDetector
+from utils import index_storage
+from utils.doc_table import DocTable
+from utils.preprocessor import token_cache
+from utils.postings_codec import ArrayPostings, CompressedPostings, impact_bound, impact_bounds
+from utils.result_cache import new_generation
+from utils.spimi import SpimiBuilder
+
+
+def collect_postings(preped_docs, field):
+    """
+    Collects the postings of the field in a single pass over every document
+    :param preped_docs:  preprocessed documents
+    :param field:  field to collect
+    :return:  {token: (docIDs, positions)} - tokens in the order of the first occurrence, tf is len(positions)
+    """
+    postings = {}
+    for doc in preped_docs:
+        doc_positions = {}
+        for pos, token in enumerate(doc[field]):
+            positions = doc_positions.get(token)
+            if positions is None:
+                doc_positions[token] = [pos]
+            else:
+                positions.append(pos)
+        for token, positions in doc_positions.items():
+            token_postings = postings.get(token)
+            if token_postings is None:
+                postings[token] = token_postings = ([], [])
+            token_postings[0].append(doc["id"])
+            token_postings[1].append(positions)
+    return postings
+
 
 class Index:
     """
@@ -14,13 +46,17 @@ class Index:
     pipeline:  preprocessing pipeline to use
     index_folder:  folder to save the index to
     index_name:  name of the index
-    docs:  dictionary with documents
+    docs:  dictionary with documents, keyed by the integer document id
     index:  inverted index
-    document_norms:  norms of the documents
+    document_norms:  norms of the documents {field: array indexed by docID}
+    doc_table:  per-document arrays (live documents, languages, norms) indexed by docID
+    forward:  forward index {field: {docID: {token: count}}} - terms of every document, used by the changes
+    max_impacts:  impact bounds of the terms {field: {token: bound}} for the pruned top-k search, see max_impact
     keywords:  set of keywords
     fields:  fields to index
     lang_detector_all:  language detector for all languages
     lang_detector_cz_sk:  language detector for Czech and Slovak
+    read_only:  whether the index is opened read-only (memory-mapped)
 
     """
     def __init__(self, pipeline, index_folder, index_name):
@@ -35,53 +71,186 @@ class Index:
         self.index_name = index_name
         self.docs = {}
         self.index = {}
-        self.document_norms = {}
+        self.forward = {}
+        self.max_impacts = {}
+        self.exact_norms = True  # document norms are computed from the same tf-idf weights the postings return
+        self.global_idf = None  # {field: {term: idf}} of the whole collection when the index is a shard
         self.keywords = set()
         self.fields = ["title", "table_of_contents", "infobox", "content"]
+        self.doc_table = DocTable(self.fields)
+        self.document_norms = self.doc_table.norms
         self.lang_detector_all = LangDetector(only_czech_slovak=False)
         self.lang_detector_cz_sk = LangDetector(only_czech_slovak=True)
+        self.read_only = False
+        self.generation = new_generation()  # changes with every change of the search results
         if not os.path.exists(index_folder):
             os.makedirs(index_folder)
 
-    def save_index(self):
+    def save_index(self, fmt="binary", compress=False, compress_docs=False, save_tokens=False):
         """
         Saves the index to a file
+        :param fmt:  "binary" - single versioned binary file (default), "json" - JSON export in five files
+        :param compress:  store delta/varint compressed postings in the binary file
+        :param compress_docs:  compress the documents in the binary file in zlib blocks
+        :param save_tokens:  also save the cached stems and lemmas of the tokens, they are loaded with the index
+                             and before it is rebuilt
         """
+        self._check_writable()
+        if save_tokens:
+            token_cache.save(self._tokens_path())
+        if fmt == "binary":
+            index_storage.write_index(os.path.join(self.index_folder, self.index_name + ".bin"), self.index,
+                                      self.document_norms, self.docs, self.keywords, self.fields, compress,
+                                      compress_docs)
+            return
+        if fmt != "json":
+            raise ValueError("Unknown index format: {}".format(fmt))
         with open(os.path.join(self.index_folder, self.index_name + "_index.json"), "w", encoding="utf-8") as file:
-            json.dump(self.index, file, ensure_ascii=False, indent=1)
+            json.dump({field: {token: self._plain_entry(field, token) for token in self.index[field]}
+                       for field in self.index}, file, ensure_ascii=False, indent=1)
         with open(os.path.join(self.index_folder, self.index_name + "_document_norms.json"), "w", encoding="utf-8") as file:
-            json.dump(self.document_norms, file, ensure_ascii=False, indent=1)
+            json.dump({field: {doc_id: self.document_norms[field][doc_id]
+                               for doc_id in np.flatnonzero(self.document_norms[field]).tolist()}
+                       for field in self.fields}, file, ensure_ascii=False, indent=1)
         with open(os.path.join(self.index_folder, self.index_name + "_docs.json"), "w", encoding="utf-8") as file:
-            json.dump(self.docs, file, ensure_ascii=False, indent=1)
+            json.dump({"docs": dict(self.docs["docs"].items()), "unused_ids": self.docs["unused_ids"],
+                       "max_id": self.docs["max_id"]}, file, ensure_ascii=False, indent=1)
+        with open(os.path.join(self.index_folder, self.index_name + "_forward.json"), "w", encoding="utf-8") as file:
+            json.dump({field: dict(self.forward[field].items()) for field in self.forward}, file, ensure_ascii=False)
         with open(os.path.join(self.index_folder, self.index_name + "_keywords.json"), "w", encoding="utf-8") as file:
             json.dump(list(self.keywords), file, ensure_ascii=False, indent=1)
 
-    def load_index(self):
+    def _tokens_path(self):
+        """
+        Returns the path to the file with the cached stems and lemmas of the tokens
+        :return:  path
+        """
+        return os.path.join(self.index_folder, self.index_name + "_tokens.json")
+
+    def load_index(self, fmt=None, mmap=False):
         """
         Loads the index from a file
+        :param fmt:  "binary" or "json", if None the binary file is used when it exists
+        :param mmap:  open the binary index read-only and memory-mapped - postings are decoded only when a query
+                      touches them, the index can't be modified
+        Documents of the binary index are always fetched from the file on demand (titles and languages
+        are loaded into the doc table).
         """
+        binary_path = os.path.join(self.index_folder, self.index_name + ".bin")
+        if fmt is None:
+            fmt = "binary" if os.path.exists(binary_path) else "json"
+        if mmap and fmt != "binary":
+            raise ValueError("Only the binary index can be memory-mapped")
+        self.read_only = mmap
+        self.generation = new_generation()
+        token_cache.load(self._tokens_path())
+        if fmt == "binary":
+            index_file = index_storage.IndexFile(binary_path, use_mmap=mmap)
+            self.fields = index_file.header["fields"]
+            # postings are decoded lazily - only the terms that are accessed are turned into dictionaries
+            self.index = {field: index_storage.LazyField(index_file.field(field), read_only=mmap)
+                          for field in self.fields}
+            self.doc_table = index_file.doc_table(self.fields)
+            self.document_norms = self.doc_table.norms
+            self.docs = index_file.docs()
+            self.keywords = index_file.keywords()
+            self.forward = {field: index_file.forward(field) for field in self.fields}
+            # files written without the bounds get them computed on demand
+            self.max_impacts = {field: self.index[field].binary_field.max_impacts() or {} for field in self.fields}
+            if not mmap and None in self.forward.values():
+                self.build_forward()  # index written before the forward index was stored
+            return
+        if fmt != "json":
+            raise ValueError("Unknown index format: {}".format(fmt))
+        # JSON object keys are strings - document ids are turned back into integers
         with open(os.path.join(self.index_folder, self.index_name + "_index.json"), "r", encoding="utf-8") as file:
-            self.index = json.load(file)
-        with open(os.path.join(self.index_folder, self.index_name + "_document_norms.json"), "r", encoding="utf-8") as file:
-            self.document_norms = json.load(file)
+            self.index = {field: {token: {"idf": entry["idf"], "df": entry["df"],
+                                          "docIDs": {int(doc_id): posting for doc_id, posting in entry["docIDs"].items()}}
+                                  for token, entry in tokens.items()}
+                          for field, tokens in json.load(file).items()}
         with open(os.path.join(self.index_folder, self.index_name + "_docs.json"), "r", encoding="utf-8") as file:
             self.docs = json.load(file)
+        self.docs["docs"] = {int(doc_id): doc for doc_id, doc in self.docs["docs"].items()}
+        self.docs["unused_ids"] = [int(doc_id) for doc_id in self.docs["unused_ids"]]
+        self.doc_table = DocTable.from_docs(self.fields, self.docs["docs"], self.docs["max_id"])
+        self.document_norms = self.doc_table.norms
+        self.max_impacts = {}  # not exported to JSON, computed on demand
+        with open(os.path.join(self.index_folder, self.index_name + "_document_norms.json"), "r", encoding="utf-8") as file:
+            for field, norms in json.load(file).items():
+                for doc_id, norm in norms.items():
+                    self.document_norms[field][int(doc_id)] = norm
         with open(os.path.join(self.index_folder, self.index_name + "_keywords.json"), "r", encoding="utf-8") as file:
             self.keywords = set(json.load(file))
+        forward_path = os.path.join(self.index_folder, self.index_name + "_forward.json")
+        if os.path.exists(forward_path):
+            with open(forward_path, "r", encoding="utf-8") as file:
+                self.forward = {field: {int(doc_id): terms for doc_id, terms in docs.items()}
+                                for field, docs in json.load(file).items()}
+        else:
+            self.build_forward()
+
+    def build_forward(self):
+        """
+        Rebuilds the forward index from the postings (for indexes saved without it)
+        """
+        for field in self.fields:
+            self.forward[field] = {}
+            for token in self.index[field]:
+                for docID, posting in self.index[field][token]["docIDs"].items():
+                    self.forward[field].setdefault(docID, {})[token] = len(posting["pos"])
+
+    def compress_postings(self):
+        """
+        Keeps the postings of the in-memory index compressed (delta/varint coded blocks)
+        Postings are decompressed again only when a document containing the term is changed.
+        """
+        for field in self.fields:
+            for token in self.index[field]:
+                entry = self.index[field][token]
+                if not isinstance(entry["docIDs"], CompressedPostings):
+                    entry["docIDs"] = CompressedPostings.from_dict(entry["docIDs"], entry["idf"])
+
+    def _thaw(self, field, token):
+        """
+        Replaces array or compressed postings of the token with a modifiable dictionary before the index is changed
+        :param field:  field of the token
+        :param token:  token to thaw
+        """
+        entry = self.index[field][token]
+        if not isinstance(entry["docIDs"], dict):
+            entry["docIDs"] = entry["docIDs"].to_dict()
+
+    def _plain_entry(self, field, token):
+        """
+        Returns the entry of the token with the postings as a plain dictionary (e.g. for the JSON export)
+        :param field:  field of the token
+        :param token:  token
+        :return:  {"idf", "df", "docIDs": {docID: {"tf", "tf-idf", "pos"}}}
+        """
+        entry = self.index[field][token]
+        return {"idf": entry["idf"], "df": entry["df"], "docIDs": dict(entry["docIDs"].items())}
+
+    def _check_writable(self):
+        """
+        Raises an error if the index is opened read-only
+        """
+        if self.read_only:
+            raise RuntimeError("Index \"{}\" is opened read-only".format(self.index_name))
 
-    def create_doc_cache(self, data_folder="data"):
+    def create_doc_cache(self, data_folder="data", filenames=None):
         """
         Loads documents from the data folder and saves them to a cache
         :param data_folder:  path to the data folder
+        :param filenames:  names of the files to load (in this order), None for all files of the folder
         """
         self.docs = {"docs": {}, "unused_ids": [], "max_id": 0}
         index = 0
         contents = []
-        for filename in os.listdir(data_folder):
+        for filename in os.listdir(data_folder) if filenames is None else filenames:
             if filename.endswith(".json"):
                 with open(os.path.join(data_folder, filename), "r", encoding="utf-8") as file:
                     data = json.load(file)
-                    self.docs["docs"][str(index)] = data
+                    self.docs["docs"][index] = data
                     index += 1
                     contents.append(data["content"])
         langs1 = self.lang_detector_all.predict(contents)
@@ -89,59 +258,123 @@ class Index:
         for doc, lang1, lang2 in zip(self.docs["docs"].keys(), langs1, langs2):
             self.docs["docs"][doc]["lang_all"] = lang1
             self.docs["docs"][doc]["lang_cz_sk"] = lang2
+            preprocessing_pipelines.add_token_offsets(self.docs["docs"][doc])
         self.docs["max_id"] = index - 1
         print("Loaded", len(self.docs["docs"]), "documents")
 
-    def create_index(self, preped_docs):
+    def create_index(self, preped_docs, global_idf=None):
         """
         Creates an inverted index from the documents
         :param preped_docs:  preprocessed documents
+        :param global_idf:  {field: {term: idf}} of the whole collection when the index is a shard - the weights,
+                            norms and query weights are then the same as in an index of the whole collection
         """
         N = len(preped_docs)
+        self.generation = new_generation()
+        self.global_idf = global_idf
+        # postings are kept in arrays sorted by document id
+        preped_docs = sorted(preped_docs, key=lambda doc: doc["id"])
+        self.doc_table = DocTable.from_docs(self.fields, self.docs["docs"], self.docs["max_id"])
+        self.document_norms = self.doc_table.norms
         for field in self.fields:
-            self.index[field] = defaultdict(
-                lambda: {"idf": 0, "df": 0, "docIDs": defaultdict(lambda: {"tf": 0, "tf-idf": 0, "pos": []})})
-            # document norms are needed for cosine similarity
-            document_field_norms = defaultdict(int)
-            for doc in preped_docs:
-                seen = set()
-                for pos, token in enumerate(doc[field]):
-                    if token not in seen:
-                        seen.add(token)
-                        self.index[field][token]["df"] += 1  # count the number of documents containing the word
-                        tf = doc[field].count(token)  # term frequency
-                        tf = 1 + np.log10(tf)  # compute tf
-                        self.index[field][token]["docIDs"][doc["id"]]["tf"] = tf  # store tf
-                        self.index[field][token]["docIDs"][doc["id"]]["tf-idf"] = tf
-                    self.index[field][token]["docIDs"][doc["id"]]["pos"].append(pos)
+            postings = collect_postings(preped_docs, field)
 
-            for token in self.index[field]:
-                self.index[field][token]["idf"] = np.log10(N / float(self.index[field][token]["df"]))  # compute idf
-                for docID in self.index[field][token]["docIDs"]:
-                    self.index[field][token]["docIDs"][docID]["tf-idf"] *= self.index[field][token][
-                        "idf"]  # compute tf-idf
-                    document_field_norms[docID] += (self.index[field][token]["docIDs"][docID]["tf-idf"]) ** 2
+            # tf, idf, tf-idf and document norms are computed for all postings at once
+            tokens = list(postings.keys())
+            df = np.array([len(postings[token][0]) for token in tokens], dtype=np.int64)
+            if global_idf is None:
+                idf = np.log10(N / df.astype(np.float64))  # compute idf
+            else:
+                idf = np.array([global_idf[field][token] for token in tokens], dtype=np.float64)
+            counts = np.fromiter((len(positions) for token in tokens for positions in postings[token][1]),
+                                 dtype=np.float64, count=int(df.sum()))
+            tf = 1 + np.log10(counts)  # compute tf
+            tf_idf = tf * np.repeat(idf, df)  # compute tf-idf
+            docs = np.fromiter((docID for token in tokens for docID in postings[token][0]),
+                               dtype=np.int64, count=int(df.sum()))
+            # document norms are needed for cosine similarity
+            self.document_norms[field] = np.sqrt(np.bincount(docs, weights=tf_idf ** 2, minlength=len(self.doc_table)))
 
-            document_field_norms = {docID: np.sqrt(document_field_norms[docID]) for docID in document_field_norms}
-            self.document_norms[field] = document_field_norms
+            pos = np.fromiter(itertools.chain.from_iterable(positions for token in tokens
+                                                            for positions in postings[token][1]),
+                              dtype=np.int32, count=int(counts.sum()))
+            pos_ptr = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+            ends = np.cumsum(df)
+            bounds = impact_bounds(docs, tf, ends - df, self.document_norms[field]).tolist()
+            self.max_impacts[field] = dict(zip(tokens, bounds))
+            ends = ends.tolist()
+            idf, df = idf.tolist(), df.tolist()
+            self.index[field] = {}
+            start = 0
+            for i, token in enumerate(tokens):
+                # postings of the term are views into the arrays of the field
+                end = ends[i]
+                self.index[field][token] = {"idf": idf[i], "df": df[i], "docIDs": ArrayPostings(
+                    docs[start:end], tf[start:end], tf_idf[start:end], pos_ptr[start:end + 1], pos)}
+                start = end
+            self.forward[field] = {}
+            for token in tokens:
+                for docID, positions in zip(*postings[token]):
+                    self.forward[field].setdefault(docID, {})[token] = len(positions)
 
-    def create_index_from_folder(self, data_folder="data"):
+    def create_index_from_folder(self, data_folder="data", workers=1):
         """
         Creates an inverted index from the documents in the data folder
         :param data_folder:  path to the data folder
+        :param workers:  number of processes used for preprocessing, None for the number of CPUs
         """
         self.create_doc_cache(data_folder)
-        preped_docs = []
-        for doc_id in self.docs["docs"].keys():
-            preped_docs.append(preprocessing_pipelines.preprocess(self.docs["docs"][doc_id], doc_id, self.pipeline))
+        token_cache.load(self._tokens_path())
+        preped_docs = preprocessing_pipelines.preprocess_parallel(self.docs["docs"].items(), self.pipeline, workers)
 
         self.create_index(preped_docs)
 
-    def create_index_from_url(self, seed_url, data_folder="data"):
+    def create_index_external(self, data_folder="data", memory_budget=256 * 1024 * 1024, batch_size=1000,
+                              workers=1, compress=False, mmap=False):
+        """
+        Creates the index from the documents in the data folder without holding the corpus in memory
+        Documents are read, preprocessed and indexed in batches, partial runs are flushed to disk when the
+        memory budget is exceeded and merged into the binary index file, which is then loaded.
+        :param data_folder:  path to the data folder
+        :param memory_budget:  maximal estimated size of the in-memory postings in bytes
+        :param batch_size:  number of documents read and preprocessed at once
+        :param workers:  number of processes used for preprocessing, None for the number of CPUs
+        :param compress:  store delta/varint compressed postings
+        :param mmap:  load the created index read-only and memory-mapped
+        """
+        self._check_writable()
+        token_cache.load(self._tokens_path())
+        filenames = [filename for filename in os.listdir(data_folder) if filename.endswith(".json")]
+        builder = SpimiBuilder(self.fields, self.index_folder, memory_budget)
+        writer = index_storage.IndexWriter(os.path.join(self.index_folder, self.index_name + ".bin"), self.fields,
+                                           compress)
+        for start in range(0, len(filenames), batch_size):
+            docs = []
+            for filename in filenames[start:start + batch_size]:
+                with open(os.path.join(data_folder, filename), "r", encoding="utf-8") as file:
+                    docs.append(json.load(file))
+            contents = [doc["content"] for doc in docs]
+            for doc, lang1, lang2 in zip(docs, self.lang_detector_all.predict(contents),
+                                         self.lang_detector_cz_sk.predict(contents)):
+                doc["lang_all"] = lang1
+                doc["lang_cz_sk"] = lang2
+                preprocessing_pipelines.add_token_offsets(doc)
+            doc_ids = list(range(start, start + len(docs)))
+            preped_docs = preprocessing_pipelines.preprocess_parallel(zip(doc_ids, docs), self.pipeline, workers)
+            for doc_id, doc, preped_doc in zip(doc_ids, docs, preped_docs):
+                writer.add_doc(doc_id, doc)
+                builder.add(preped_doc)
+        builder.merge(writer)
+        writer.close(set(), len(filenames) - 1, [])
+        print("Indexed", len(filenames), "documents in", builder.runs, "runs")
+        self.load_index("binary", mmap=mmap)
+
+    def create_index_from_url(self, seed_url, data_folder="data", workers=1):
         """
         Creates an inverted index for the documents crawled from the seed URL
         :param seed_url: URL of the seed page
         :param data_folder:  path to the data folder
+        :param workers:  number of processes used for preprocessing, None for the number of CPUs
         """
         topics_refs = web_crawler.crawl(seed_url, 1)
 
@@ -149,100 +382,155 @@ class Index:
             os.makedirs(data_folder)
 
         web_crawler.scrape_urls(topics_refs, folder=data_folder, wait_time=1)
-        self.create_index_from_folder(data_folder)
+        self.create_index_from_folder(data_folder, workers)
+
+    def _reweight(self, field, token, N):
+        """
+        Recomputes the idf of the token after its df changed and updates the tf-idf and norms of its documents
+        :param field:  field of the token
+        :param token:  token
+        :param N:  number of documents
+        """
+        entry = self.index[field][token]
+        idf = np.log10(N / float(entry["df"]))
+        entry["idf"] = idf
+        for docID, posting in entry["docIDs"].items():
+            old_tf_idf = posting["tf-idf"]
+            posting["tf-idf"] = posting["tf"] * idf
+            self.document_norms[field][docID] = np.sqrt(
+                self.document_norms[field][docID] ** 2 - (old_tf_idf ** 2) + (posting["tf-idf"] ** 2))
+
+    def _remove_terms(self, field, doc_id, tokens, N):
+        """
+        Removes the document from the postings of the tokens
+        :param field:  field of the tokens
+        :param doc_id:  id of the document
+        :param tokens:  tokens of the document to remove
+        :param N:  number of documents after the change
+        """
+        for token in tokens:
+            self._thaw(field, token)
+            entry = self.index[field][token]
+            del entry["docIDs"][doc_id]
+            entry["df"] -= 1
+            if entry["df"] > 0:
+                self._reweight(field, token, N)
+            else:
+                # Remove the token from the index if it's not in any document
+                self.index[field].pop(token)
+
+    def _add_terms(self, field, doc_id, postings, N):
+        """
+        Adds the document to the postings of the tokens
+        :param field:  field of the tokens
+        :param doc_id:  id of the document
+        :param postings:  {token: positions} of the tokens to add
+        :param N:  number of documents after the change
+        """
+        for token, positions in postings.items():
+            if token in self.index[field]:
+                self._thaw(field, token)
+            else:
+                self.index[field][token] = {"idf": 0, "df": 0, "docIDs": {}}
+            entry = self.index[field][token]
+            entry["df"] += 1
+            self._reweight(field, token, N)
+            tf = 1 + np.log10(len(positions))
+            entry["docIDs"][doc_id] = {"tf": tf, "tf-idf": tf * entry["idf"], "pos": positions}
+
+    def _set_document_terms(self, field, doc_id, preprocessed_doc, N):
+        """
+        Replaces the terms of the document in the field - only the postings of the old and new terms
+        of the document are touched, the old terms are taken from the forward index
+        :param field:  field to change
+        :param doc_id:  id of the document
+        :param preprocessed_doc:  preprocessed document, None to remove the document
+        :param N:  number of documents after the change
+        """
+        old_terms = self.forward[field].get(doc_id, {})
+        new_postings = {}
+        if preprocessed_doc is not None:
+            new_postings = {token: positions[0] for token, (_, positions)
+                            in collect_postings([preprocessed_doc], field).items()}
+        self._remove_terms(field, doc_id, [token for token in old_terms if token not in new_postings], N)
+        self._add_terms(field, doc_id, {token: positions for token, positions in new_postings.items()
+                                        if token not in old_terms}, N)
+        for token, positions in new_postings.items():
+            if token in old_terms:  # df has not changed
+                self._thaw(field, token)
+                tf = 1 + np.log10(len(positions))
+                self.index[field][token]["docIDs"][doc_id] = {"tf": tf, "tf-idf": tf * self.index[field][token]["idf"],
+                                                              "pos": positions}
+        # norm of the changed document is computed from its own terms
+        self.document_norms[field][doc_id] = np.sqrt(sum(
+            self.index[field][token]["docIDs"][doc_id]["tf-idf"] ** 2 for token in new_postings))
+        if new_postings:
+            self.forward[field][doc_id] = {token: len(positions) for token, positions in new_postings.items()}
+        else:
+            self.forward[field].pop(doc_id, None)
+        # the idf changes moved the norms of other documents too, the bounds of the field are computed again
+        self.max_impacts[field] = {}
+
+    def max_impact(self, field, token):
+        """
+        Returns the impact bound of the token - max(tf / document norm) over its postings
+        The token adds at most query weight * idf * bound / query norm to the cosine similarity of a document.
+        Bounds are computed when the index is created and stored in the binary file, after a change of the field
+        they are computed again on demand.
+        :param field:  field of the token
+        :param token:  token in the index
+        :return:  bound
+        """
+        bounds = self.max_impacts.setdefault(field, {})
+        if token in bounds:
+            return bounds[token]
+        bound = impact_bound(self.index[field][token]["docIDs"], self.document_norms[field])
+        if isinstance(bounds, dict):  # the bounds loaded from the binary file are read-only
+            bounds[token] = bound
+        return bound
 
     def delete_document(self, doc_id):
         """
         Removes the document from the index
         :param doc_id:  id of the document to remove
         """
-        doc_id = str(doc_id)
+        self._check_writable()
+        self.generation = new_generation()
+        doc_id = int(doc_id)
         print("Removing document \"{}\" with id {}".format(self.docs["docs"][doc_id]["title"], doc_id))
         self.docs["unused_ids"].append(doc_id)
-        preprocessed_doc = preprocessing_pipelines.preprocess(self.docs["docs"][doc_id], doc_id, self.pipeline)
         N = len(self.docs["docs"]) - 1  # number of documents without the removed one
         for field in self.fields:
-            for token in self.index[field]:
-                # Remove the document from the index
-                if doc_id in self.index[field][token]["docIDs"]:
-                    del self.index[field][token]["docIDs"][doc_id]
-            if doc_id in self.document_norms[field]:
-                # Remove the document from the document norms
-                del self.document_norms[field][doc_id]
-            # Update the idf and df
-            tokens = preprocessed_doc[field]
-            for token in set(tokens):
-                self.index[field][token]["df"] -= 1
-                df = self.index[field][token]["df"]
-                if df > 0:
-                    idf = np.log10(N / float(df))
-                    self.index[field][token]["idf"] = idf
-                    docs_with_token = set(self.index[field][token]["docIDs"].keys())
-                    # Update the document norms
-                    for docID in docs_with_token:
-                        old_tf_idf = self.index[field][token]["docIDs"][docID]["tf-idf"]
-                        self.index[field][token]["docIDs"][docID]["tf-idf"] = (
-                                self.index[field][token]["docIDs"][docID]["tf"] * idf)
-                        self.document_norms[field][docID] = np.sqrt(
-                            self.document_norms[field][docID] ** 2 - (old_tf_idf ** 2) + (
-                                    self.index[field][token]["docIDs"][docID]["tf-idf"] ** 2))
-                else:
-                    # Remove the token from the index if it's not in any document
-                    self.index[field].pop(token)
+            self._set_document_terms(field, doc_id, None, N)
         # Remove the document from the cache
         self.docs["docs"].pop(doc_id)
+        self.doc_table.remove(doc_id)
 
     def create_document(self, doc):
         """
         Adds the document to the index
         :param doc:  document to add - dictionary with fields: title, table_of_contents (list), infobox, content
+        :return:  id of the document
         """
+        self._check_writable()
+        self.generation = new_generation()
         unused_ids = self.docs["unused_ids"]
         if len(unused_ids) > 0:
             doc_id = self.docs["unused_ids"].pop()
         else:
             doc_id = self.docs["max_id"] + 1
             self.docs["max_id"] = doc_id
-        doc_id = str(doc_id)
         print("Adding document \"{}\" with id {}".format(doc["title"], doc_id))
         doc["lang_all"] = self.lang_detector_all.predict([doc["content"]])[0]
         doc["lang_cz_sk"] = self.lang_detector_cz_sk.predict([doc["content"]])[0]
+        preprocessing_pipelines.add_token_offsets(doc)
         self.docs["docs"][doc_id] = doc
+        self.doc_table.add(doc_id, doc)
         preprocessed_doc = preprocessing_pipelines.preprocess(doc, doc_id, self.pipeline)
         N = len(self.docs["docs"])  # number of documents
         for field in self.fields:
-            tokens = preprocessed_doc[field]
-            for token in set(tokens):
-                if token in self.index[field]:
-                    docs_with_token = set(self.index[field][token]["docIDs"].keys())
-                else:
-                    docs_with_token = set()
-                if token not in self.index[field]:
-                    self.index[field][token] = {"idf": 0, "df": 0, "docIDs": defaultdict(lambda: {"tf": 0, "tf-idf": 0, "pos": []})}
-                # Update the idf and df
-                self.index[field][token]["df"] += 1
-                df = self.index[field][token]["df"]
-                idf = np.log10(N / float(df))
-                self.index[field][token]["idf"] = idf
-                # Update the tf-idf and norms of the documents affected by the change
-                for docID in docs_with_token:
-                    old_tf_idf = self.index[field][token]["docIDs"][docID]["tf-idf"]
-                    self.index[field][token]["docIDs"][docID]["tf-idf"] = (
-                            self.index[field][token]["docIDs"][docID]["tf"] * idf)
-                    self.document_norms[field][docID] = np.sqrt(
-                        self.document_norms[field][docID] ** 2 - (old_tf_idf ** 2) + (
-                                self.index[field][token]["docIDs"][docID]["tf-idf"] ** 2))
-                tf = tokens.count(token)
-                if doc_id not in self.index[field][token]["docIDs"]:
-                    self.index[field][token]["docIDs"][doc_id] = {"tf": 0, "tf-idf": 0, "pos": []}
-                self.index[field][token]["docIDs"][doc_id]["tf"] = tf
-                tf_idf = (1 + np.log10(tf)) * idf
-                self.index[field][token]["docIDs"][doc_id]["tf-idf"] = tf_idf
-                self.index[field][token]["docIDs"][doc_id]["pos"] = [pos for pos, t in enumerate(tokens) if t == token]
-                if doc_id not in self.document_norms[field]:
-                    self.document_norms[field][doc_id] = 0
-                self.document_norms[field][doc_id] = np.sqrt(self.document_norms[field][doc_id] ** 2 + (tf_idf ** 2))
-
+            self._set_document_terms(field, doc_id, preprocessed_doc, N)
+        return doc_id
 
     def update_document(self, doc_id, replacement, field):
         """
@@ -251,81 +539,19 @@ class Index:
         :param replacement:  replacement for the field
         :param field:  field to update
         """
-        doc_id = str(doc_id)
+        self._check_writable()
+        self.generation = new_generation()
+        doc_id = int(doc_id)
         print("Updating document \"{}\" with id {}".format(self.docs["docs"][doc_id]["title"], doc_id))
-        self.docs["docs"][doc_id][field] = replacement
-        preprocessed_text = preprocessing_pipelines.preprocess(self.docs["docs"][doc_id], doc_id, self.pipeline)
+        doc = self.docs["docs"][doc_id]
+        doc[field] = replacement
+        if field == "content":
+            preprocessing_pipelines.add_token_offsets(doc)
+        self.docs["docs"][doc_id] = doc  # the document store returns copies
+        self.doc_table.add(doc_id, doc)
+        preprocessed_text = preprocessing_pipelines.preprocess(doc, doc_id, self.pipeline)
         N = len(self.docs["docs"])  # number of documents
-        for token in list(self.index[field].keys()):
-            if doc_id in self.index[field][token]["docIDs"]:  # if the token is already associated with the document
-                if token in preprocessed_text[field]:  # if the token is in the new text
-                    # df has not changed
-                    old_tf_idf = self.index[field][token]["docIDs"][doc_id]["tf-idf"]
-                    tf = preprocessed_text[field].count(token)
-                    tf_idf = (1 + np.log10(tf)) * self.index[field][token]["idf"]  # compute new tf-idf
-                    self.index[field][token]["docIDs"][doc_id]["tf-idf"] = tf_idf
-                    self.index[field][token]["docIDs"][doc_id]["pos"] = [pos for pos, t in enumerate(preprocessed_text[field]) if
-                                                                    t == token]
-                    self.document_norms[field][doc_id] = np.sqrt(
-                        self.document_norms[field][doc_id] ** 2 - (old_tf_idf ** 2) + (tf_idf ** 2))
-                else:  # if the token is not in the new text - it has been removed
-                    old_tf_idf = self.index[field][token]["docIDs"][doc_id]["tf-idf"]
-                    self.index[field][token]["docIDs"].pop(doc_id)
-                    new_doc_norm = self.document_norms[field][doc_id] ** 2 - (old_tf_idf ** 2)
-                    if new_doc_norm > 0:
-                        self.document_norms[field][doc_id] = np.sqrt(new_doc_norm)
-                    else:
-                        self.document_norms[field][doc_id] = 0
-                    self.index[field][token]["df"] -= 1
-                    if self.index[field][token]["df"] == 0:
-                        self.index[field].pop(token)
-                        continue
-                    df = self.index[field][token]["df"]
-                    idf = np.log10(N / float(df))
-                    self.index[field][token]["idf"] = idf
-                    for docID in self.index[field][token]["docIDs"]:
-                        old_tf_idf = self.index[field][token]["docIDs"][docID]["tf-idf"]
-                        self.index[field][token]["docIDs"][docID]["tf-idf"] = (
-                                self.index[field][token]["docIDs"][docID]["tf"] * idf)
-                        # update document norms
-                        self.document_norms[field][docID] = np.sqrt(self.document_norms[field][docID] ** 2 - (old_tf_idf ** 2) + (
-                                self.index[field][token]["docIDs"][docID]["tf-idf"] ** 2))
-
-            else:  # if the token is not associated with the document
-                if token in preprocessed_text[field]:  # if the token is in the new text
-                    self.index[field][token]["df"] += 1
-                    df = self.index[field][token]["df"]
-                    idf = np.log10(N / float(df))
-                    self.index[field][token]["idf"] = idf
-                    tf = preprocessed_text[field].count(token)
-                    tf_idf = (1 + np.log10(tf)) * idf
-                    self.index[field][token]["docIDs"][doc_id]["tf-idf"] = tf_idf
-                    self.index[field][token]["docIDs"][doc_id]["pos"] = [pos for pos, t in enumerate(preprocessed_text[field]) if
-                                                                    t == token]
-                    self.document_norms[field][doc_id] = np.sqrt(tf_idf ** 2)
-                    for docID in self.index[field][token]["docIDs"]:
-                        old_tf_idf = self.index[field][token]["docIDs"][docID]["tf-idf"]
-                        self.index[field][token]["docIDs"][docID]["tf-idf"] = (
-                                self.index[field][token]["docIDs"][docID]["tf"] * idf)
-                        self.document_norms[field][docID] = np.sqrt(self.document_norms[field][docID] ** 2 - (old_tf_idf ** 2) + (
-                                self.index[field][token]["docIDs"][docID]["tf-idf"] ** 2))
-
-        for token in set(preprocessed_text[field]):
-            if token not in self.index[field]:  # new word
-                self.index[field][token] = {"idf": 0, "df": 0, "docIDs": defaultdict(lambda: {"tf": 0, "tf-idf": 0, "pos": []})}
-                self.index[field][token]["df"] += 1
-                df = self.index[field][token]["df"]
-                idf = np.log10(N / float(df))
-                self.index[field][token]["idf"] = idf
-                tf = preprocessed_text[field].count(token)
-                tf_idf = (1 + np.log10(tf)) * idf
-                self.index[field][token]["docIDs"][doc_id]["tf-idf"] = tf_idf
-                self.index[field][token]["docIDs"][doc_id]["pos"] = [pos for pos, t in enumerate(preprocessed_text[field]) if
-                                                                t == token]
-                if doc_id not in self.document_norms[field]:
-                    self.document_norms[field][doc_id] = 0
-                old_doc_norm = self.document_norms[field][doc_id]
-                self.document_norms[field][doc_id] = np.sqrt(old_doc_norm ** 2 + (tf_idf ** 2))
+        self._set_document_terms(field, doc_id, preprocessed_text, N)
 
     def create_document_from_url(self, url):
         """
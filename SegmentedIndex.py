@@ -0,0 +1,677 @@
+import json
+import math
+import os
+import threading
+from collections.abc import Mapping
+
+import numpy as np
+
+import preprocessing_pipelines
+from Index import collect_postings
+from utils import index_storage
+from utils.doc_table import DocTable
+from utils.lang_detector import LangDetector
+from utils.postings_codec import impact_bound, postings_arrays
+from utils.result_cache import new_generation
+
+
+class Segment:
+    """
+    Immutable part of a segmented index - postings, norms and documents of a set of documents
+
+    Only the tombstones (deleted documents) of a segment change after it is created.
+    The stored idf and tf-idf of the postings are not used, weights are computed with the global idf.
+
+    Attributes:
+    name: name of the segment (file name without extension)
+    index: {field: {term: {"idf", "df", "docIDs": postings}}}
+    document_norms: {field: array indexed by docID} computed with the global statistics when the segment was written
+    docs: {docID: document}
+    deleted: tombstones - ids of the deleted documents
+    saved: whether the segment is saved to disk
+    doc_table: DocTable with the titles and languages of the documents, None if they are read from the documents
+    max_impacts: impact bounds of the terms {field: {term: bound}}, missing bounds are computed on demand
+    """
+
+    def __init__(self, name, index, document_norms, docs, deleted=(), saved=False, doc_table=None, max_impacts=None):
+        """
+        Initializes the segment
+        :param name: name of the segment
+        :param index: postings of the segment
+        :param document_norms: norms of the documents
+        :param docs: documents of the segment
+        :param deleted: ids of the deleted documents
+        :param saved: whether the segment is saved to disk
+        :param doc_table: DocTable with the titles and languages of the documents
+        :param max_impacts: stored impact bounds of the terms {field: {term: bound}}
+        """
+        self.name = name
+        self.index = index
+        self.document_norms = document_norms
+        self.docs = docs
+        self.deleted = set(deleted)
+        self.saved = saved
+        self.doc_table = doc_table
+        self.max_impacts = {field: dict(bounds) if isinstance(bounds, dict) else bounds
+                            for field, bounds in (max_impacts or {}).items()}
+
+    @property
+    def num_docs(self):
+        """
+        Number of live documents in the segment
+        """
+        return len(self.docs) - len(self.deleted)
+
+    def doc_info(self, docID):
+        """
+        Returns the title and the detected languages of the document
+        :param docID: id of the document
+        :return: {"title", "lang_all", "lang_cz_sk"}
+        """
+        if self.doc_table is None:
+            return self.docs[docID]
+        return {"title": self.doc_table.title(docID), "lang_all": self.doc_table.lang(docID),
+                "lang_cz_sk": self.doc_table.languages[self.doc_table.lang_cz_sk[docID]]}
+
+    def postings(self, field, term):
+        """
+        Returns the postings of the term or None
+        :param field: field of the term
+        :param term: term
+        :return: postings or None
+        """
+        if term not in self.index[field]:
+            return None
+        return self.index[field][term]["docIDs"]
+
+    def max_impact(self, field, term):
+        """
+        Returns the impact bound of the term in the segment - max(tf / document norm) over its postings
+        The norms of a segment don't change, deleted documents only make the bound less tight.
+        :param field: field of the term
+        :param term: term in the segment
+        :return: bound
+        """
+        bounds = self.max_impacts.setdefault(field, {})
+        if term in bounds:
+            return bounds[term]
+        bound = impact_bound(self.postings(field, term), self.document_norms[field])
+        if isinstance(bounds, dict):  # the bounds loaded from the segment file are read-only
+            bounds[term] = bound
+        return bound
+
+    def live_df(self, field, term):
+        """
+        Returns the number of live documents of the segment containing the term
+        :param field: field of the term
+        :param term: term
+        :return: document frequency
+        """
+        postings = self.postings(field, term)
+        if postings is None:
+            return 0
+        return len(postings) - sum(1 for docID in self.deleted if docID in postings)
+
+
+class SegmentedIndex:
+    """
+    Inverted index made of immutable segments (LSM-style) for cheap incremental changes
+
+    New and updated documents are written to new small segments, deleted documents are only marked with
+    tombstones in their segment. The cost of a change is proportional to the size of the changed document,
+    not to the length of the postings of its terms. Searches read all live segments: df and idf are computed
+    from the live documents at query time, the document norms are computed with the statistics valid when
+    the segment was written. A merge policy compacts segments of similar size (and segments with many
+    deleted documents) into one, recomputing their norms - either after every change or in a background thread.
+
+    Exposes the same index, document_norms, docs and doc_table attributes as Index, so it can be passed to the searcher.
+
+    Attributes:
+    pipeline:  preprocessing pipeline to use
+    index_folder:  folder to save the index to
+    index_name:  name of the index
+    fields:  fields to index
+    segments:  list of segments, oldest first
+    doc_segment:  docID -> segment with the live version of the document
+    index:  {field: SegmentedField} - merged view of the postings
+    document_norms:  {field: array indexed by docID} - norms of the live documents taken from their segments
+    docs:  {"docs": SegmentedDocs, "unused_ids": [...], "max_id": int}
+    doc_table:  live documents, their titles and languages indexed by docID
+    keywords:  set of keywords
+    merge_factor:  number of segments of similar size merged together
+    """
+
+    def __init__(self, pipeline, index_folder, index_name, merge_factor=8, background_merge=False):
+        """
+        Initializes an empty segmented index
+        :param pipeline:  preprocessing pipeline
+        :param index_folder:  folder to save the index to
+        :param index_name:  name of the index
+        :param merge_factor:  number of segments of similar size merged together
+        :param background_merge:  run the merges in a background thread instead of after every change
+        """
+        self.pipeline = pipeline
+        self.index_folder = index_folder
+        self.index_name = index_name
+        self.fields = ["title", "table_of_contents", "infobox", "content"]
+        self.segments = []
+        self.doc_segment = {}
+        self.next_segment = 0
+        self.obsolete = []
+        self.keywords = set()
+        self.merge_factor = merge_factor
+        self.lang_detector_all = LangDetector(only_czech_slovak=False)
+        self.lang_detector_cz_sk = LangDetector(only_czech_slovak=True)
+        self.index = {field: SegmentedField(self, field) for field in self.fields}
+        self.docs = {"docs": SegmentedDocs(self), "unused_ids": [], "max_id": -1}
+        self.doc_table = DocTable(self.fields)
+        self.document_norms = self.doc_table.norms
+        # norms of the segments are computed with the idf from the time they were written, the postings use the global idf
+        self.exact_norms = False
+        self.global_idf = None
+        self.generation = new_generation()  # changes with every change of the search results
+        self.lock = threading.RLock()
+        self.merge_needed = threading.Condition(self.lock)
+        self.merge_lock = threading.Lock()  # one merge at a time, the explicit ones and the background ones
+        self.merge_thread = None
+        self.closed = False
+        if background_merge:
+            self.merge_thread = threading.Thread(target=self._merge_loop, daemon=True)
+            self.merge_thread.start()
+        if not os.path.exists(index_folder):
+            os.makedirs(index_folder)
+
+    @classmethod
+    def from_index(cls, index, **kwargs):
+        """
+        Creates a segmented index with the existing index as its first segment
+        :param index:  Index
+        :return:  SegmentedIndex
+        """
+        segmented = cls(index.pipeline, index.index_folder, index.index_name, **kwargs)
+        docs = index.docs["docs"]
+        segmented._add_segment(Segment(segmented._segment_name(), index.index, index.document_norms, docs,
+                                       doc_table=index.doc_table, max_impacts=index.max_impacts))
+        segmented.docs["max_id"] = index.docs["max_id"]
+        segmented.docs["unused_ids"] = list(index.docs["unused_ids"])
+        segmented.keywords = set(index.keywords)
+        return segmented
+
+    def _segment_name(self):
+        name = "{}_seg{}".format(self.index_name, self.next_segment)
+        self.next_segment += 1
+        return name
+
+    def _manifest_path(self):
+        return os.path.join(self.index_folder, self.index_name + "_segments.json")
+
+    def save_index(self, compress=False, compress_docs=False):
+        """
+        Saves the new segments and the list of segments with their tombstones
+        :param compress:  store delta/varint compressed postings in the new segments
+        :param compress_docs:  compress the documents of the new segments in zlib blocks
+        """
+        with self.lock:
+            segments = list(self.segments)
+            for segment in segments:
+                if not segment.saved:
+                    docs = {"docs": segment.docs, "unused_ids": [], "max_id": self.docs["max_id"]}
+                    index_storage.write_index(os.path.join(self.index_folder, segment.name + ".bin"), segment.index,
+                                              segment.document_norms, docs, set(), self.fields, compress,
+                                              compress_docs)
+                    segment.saved = True
+            manifest = {
+                "segments": [{"name": segment.name, "deleted": sorted(segment.deleted)}
+                             for segment in segments],
+                "next_segment": self.next_segment,
+                "max_id": self.docs["max_id"],
+                "unused_ids": self.docs["unused_ids"],
+                "keywords": sorted(self.keywords),
+            }
+            with open(self._manifest_path(), "w", encoding="utf-8") as file:
+                json.dump(manifest, file, ensure_ascii=False)
+            # files of merged segments are removed only after the manifest stops referencing them
+            for name in self.obsolete:
+                path = os.path.join(self.index_folder, name + ".bin")
+                if os.path.exists(path):
+                    os.remove(path)
+            self.obsolete = []
+
+    def load_index(self, mmap=False):
+        """
+        Loads the segments listed in the manifest
+        :param mmap:  memory-map the segment files (segments are immutable, so the index stays modifiable)
+        """
+        with open(self._manifest_path(), "r", encoding="utf-8") as file:
+            manifest = json.load(file)
+        with self.lock:
+            self.segments = []
+            self.doc_segment = {}
+            self.doc_table = DocTable(self.fields)
+            self.document_norms = self.doc_table.norms
+            for item in manifest["segments"]:
+                index_file = index_storage.IndexFile(os.path.join(self.index_folder, item["name"] + ".bin"),
+                                                     use_mmap=mmap)
+                index = {field: index_storage.LazyField(index_file.field(field), read_only=mmap)
+                         for field in self.fields}
+                norms = {field: index_file.document_norms(field) for field in self.fields}
+                bounds = {field: index[field].binary_field.max_impacts() for field in self.fields}
+                self._add_segment(Segment(item["name"], index, norms, index_file.docs()["docs"], item["deleted"],
+                                          saved=True, doc_table=index_file.doc_table([]),
+                                          max_impacts={field: b for field, b in bounds.items() if b is not None}))
+            self.next_segment = manifest["next_segment"]
+            self.docs["max_id"] = manifest["max_id"]
+            self.docs["unused_ids"] = manifest["unused_ids"]
+            self.keywords = set(manifest["keywords"])
+
+    def _add_segment(self, segment, position=None):
+        """
+        Adds the segment and routes its live documents to it
+        :param segment:  segment to add
+        :param position:  position in the list of segments, appended if None
+        The norms of a segment without them are published by _compute_norms.
+        """
+        self.generation = new_generation()
+        if position is None:
+            self.segments.append(segment)
+        else:
+            self.segments.insert(position, segment)
+        for docID in segment.docs:
+            if docID not in segment.deleted:
+                self.doc_segment[docID] = segment
+                self.doc_table.add(docID, segment.doc_info(docID))
+        if segment.document_norms:
+            self._publish_norms(segment)
+
+    def _publish_norms(self, segment):
+        """
+        Copies the norms of the live documents of the segment to the norms of the index
+        :param segment:  segment with computed norms
+        """
+        self.generation = new_generation()
+        live = np.array([docID for docID in segment.docs if self.doc_segment.get(docID) is segment], dtype=np.int64)
+        for field in self.fields:
+            self.document_norms[field][live] = segment.document_norms[field][live]
+
+    def num_docs(self):
+        """
+        Returns the number of live documents
+        """
+        return len(self.doc_segment)
+
+    def df(self, field, term, segments=None):
+        """
+        Returns the number of live documents containing the term
+        :param field:  field of the term
+        :param term:  term
+        :param segments:  segments to count in, all segments if None
+        :return:  document frequency
+        """
+        return sum(segment.live_df(field, term) for segment in (self.segments if segments is None else segments))
+
+    def idf(self, field, term, segments=None):
+        """
+        Returns the idf of the term computed from the live documents
+        :param field:  field of the term
+        :param term:  term
+        :param segments:  snapshot of the segments, all segments if None
+        :return:  idf, 0 if the term is not in any live document
+        """
+        df = self.df(field, term, segments)
+        if df == 0:
+            return 0
+        return np.log10(self.num_docs() / float(df))
+
+    def max_impact(self, field, term):
+        """
+        Returns the impact bound of the term - the largest bound of the term in the segments
+        :param field:  field of the term
+        :param term:  term
+        :return:  bound, 0 if the term is not in any segment
+        """
+        return max((segment.max_impact(field, term) for segment in list(self.segments)
+                    if segment.postings(field, term) is not None), default=0.0)
+
+    def _build_segment(self, docs):
+        """
+        Creates a segment from the documents
+        :param docs:  {docID: document}
+        :return:  Segment (norms are computed once the segment is added)
+        """
+        preped_docs = [preprocessing_pipelines.preprocess(doc, docID, self.pipeline) for docID, doc in docs.items()]
+        index = {}
+        for field in self.fields:
+            index[field] = {}
+            for token, (docIDs, positions) in collect_postings(preped_docs, field).items():
+                index[field][token] = {"idf": 0, "df": len(docIDs), "docIDs": {
+                    docID: {"tf": 1 + np.log10(len(pos)), "tf-idf": 0, "pos": pos}
+                    for docID, pos in zip(docIDs, positions)}}
+        return Segment(self._segment_name(), index, {}, docs)
+
+    def _compute_norms(self, segment):
+        """
+        Computes the tf-idf weights and document norms of the segment with the current global statistics
+        :param segment:  segment with dictionary postings
+        """
+        size = max(segment.docs, default=-1) + 1
+        for field in self.fields:
+            norms = np.zeros(size, dtype=np.float64)
+            for token, entry in segment.index[field].items():
+                idf = self.idf(field, token)
+                entry["idf"] = idf
+                for docID, posting in entry["docIDs"].items():
+                    posting["tf-idf"] = posting["tf"] * idf
+                    norms[docID] += posting["tf-idf"] ** 2
+            segment.document_norms[field] = np.sqrt(norms)
+        self._publish_norms(segment)
+
+    def _write_documents(self, docs):
+        """
+        Writes the documents to a new segment
+        :param docs:  {docID: document}
+        """
+        segment = self._build_segment(docs)
+        with self.lock:
+            for docID in docs:
+                self._tombstone(docID)
+            self._add_segment(segment)
+            self._compute_norms(segment)
+        self._merge_after_change()
+
+    def _tombstone(self, docID):
+        """
+        Marks the live version of the document as deleted in its segment
+        :param docID:  id of the document
+        """
+        segment = self.doc_segment.pop(docID, None)
+        if segment is not None:
+            self.generation = new_generation()
+            segment.deleted.add(docID)
+            self.doc_table.remove(docID)
+
+    def create_document(self, doc):
+        """
+        Adds the document to a new segment, ids of deleted documents are reused like in Index
+        :param doc:  document to add - dictionary with fields: title, table_of_contents (list), infobox, content
+        :return:  id of the document
+        """
+        with self.lock:
+            if self.docs["unused_ids"]:
+                doc_id = self.docs["unused_ids"].pop()
+            else:
+                doc_id = self.docs["max_id"] + 1
+                self.docs["max_id"] = doc_id
+        print("Adding document \"{}\" with id {}".format(doc["title"], doc_id))
+        doc["lang_all"] = self.lang_detector_all.predict([doc["content"]])[0]
+        doc["lang_cz_sk"] = self.lang_detector_cz_sk.predict([doc["content"]])[0]
+        preprocessing_pipelines.add_token_offsets(doc)
+        self._write_documents({doc_id: doc})
+        return doc_id
+
+    def update_document(self, doc_id, replacement, field):
+        """
+        Writes the updated document to a new segment and deletes the old version
+        :param doc_id:  id of the document to update
+        :param replacement:  replacement for the field
+        :param field:  field to update
+        """
+        doc_id = int(doc_id)
+        doc = dict(self.docs["docs"][doc_id])
+        print("Updating document \"{}\" with id {}".format(doc["title"], doc_id))
+        doc[field] = replacement
+        if field == "content":
+            preprocessing_pipelines.add_token_offsets(doc)
+        self._write_documents({doc_id: doc})
+
+    def delete_document(self, doc_id):
+        """
+        Deletes the document - only a tombstone is written
+        :param doc_id:  id of the document to remove
+        """
+        doc_id = int(doc_id)
+        print("Removing document \"{}\" with id {}".format(self.docs["docs"][doc_id]["title"], doc_id))
+        with self.lock:
+            self._tombstone(doc_id)
+            self.docs["unused_ids"].append(doc_id)
+        self._merge_after_change()
+
+    def set_keywords(self):
+        """
+        Sets the keywords for the index
+        """
+        tokens = set()
+        fields = ["title", "infobox", "content"]
+        for docID in self.docs["docs"]:
+            for field in fields:
+                tokens.update(preprocessing_pipelines.pipeline_tokenizer(self.docs["docs"][docID][field])[1])
+        self.keywords = tokens
+
+    def merge_candidates(self):
+        """
+        Selects the segments to merge - tiered merge policy
+        Segments are grouped into tiers by the number of their documents (powers of merge_factor),
+        merge_factor segments of one tier are merged together. A segment with more than half of its documents
+        deleted is rewritten on its own.
+        :return:  list of segments to merge, empty if there is nothing to merge
+        """
+        tiers = {}
+        for segment in self.segments:
+            if segment.deleted and len(segment.deleted) * 2 > len(segment.docs):
+                return [segment]
+            tier = int(math.log(max(segment.num_docs, 1), self.merge_factor))
+            tiers.setdefault(tier, []).append(segment)
+        for tier in sorted(tiers):
+            if len(tiers[tier]) >= self.merge_factor:
+                return tiers[tier][:self.merge_factor]
+        return []
+
+    def merge(self, segments=None):
+        """
+        Merges the segments into one, dropping the deleted documents and recomputing the norms
+        :param segments:  segments to merge, all segments if None
+        """
+        with self.merge_lock:
+            with self.lock:
+                segments = list(self.segments if segments is None else segments)
+                # the segments selected before the merge lock was taken may have been merged meanwhile
+                if any(segment not in self.segments for segment in segments):
+                    return
+                deleted = {segment.name: set(segment.deleted) for segment in segments}
+            if not segments:
+                return
+            # the segments are immutable, so the merged segment is built without holding the lock
+            index = {}
+            docs = {}
+            for field in self.fields:
+                index[field] = {}
+                for segment in segments:
+                    for token, entry in segment.index[field].items():
+                        postings = {docID: dict(posting) for docID, posting in entry["docIDs"].items()
+                                    if docID not in deleted[segment.name]}
+                        if postings:
+                            index[field].setdefault(token, {"idf": 0, "df": 0, "docIDs": {}})["docIDs"].update(postings)
+                for token, entry in index[field].items():
+                    entry["df"] = len(entry["docIDs"])
+            for segment in segments:
+                for docID in segment.docs:
+                    if docID not in deleted[segment.name]:
+                        docs[docID] = segment.docs[docID]
+            merged = Segment(self._segment_name(), index, {}, docs)
+
+            with self.lock:
+                position = self.segments.index(segments[0])
+                for segment in segments:
+                    self.segments.remove(segment)
+                    if segment.saved:
+                        self.obsolete.append(segment.name)
+                    # documents deleted while the merge was running
+                    merged.deleted.update(segment.deleted - deleted[segment.name])
+                self._add_segment(merged, position)
+                self._compute_norms(merged)
+            print("Merged", len(segments), "segments into", merged.name, "with", merged.num_docs, "documents")
+
+    def _merge_after_change(self):
+        """
+        Runs the merge policy after a change - in the background thread if there is one
+        """
+        if self.merge_thread is not None:
+            with self.merge_needed:
+                self.merge_needed.notify()
+            return
+        segments = self.merge_candidates()
+        while segments:
+            self.merge(segments)
+            segments = self.merge_candidates()
+
+    def _merge_loop(self):
+        """
+        Background merge thread - waits for changes and merges the segments selected by the merge policy
+        """
+        while True:
+            with self.merge_needed:
+                self.merge_needed.wait_for(lambda: self.closed or self.merge_candidates())
+                if self.closed:
+                    return
+                segments = self.merge_candidates()
+            try:
+                self.merge(segments)
+            except Exception as e:
+                print("Background merge of", len(segments), "segments failed:", repr(e))
+
+    def close(self):
+        """
+        Stops the background merge thread
+        """
+        with self.merge_needed:
+            self.closed = True
+            self.merge_needed.notify()
+        if self.merge_thread is not None:
+            self.merge_thread.join()
+
+
+class SegmentedPostings(Mapping):
+    """
+    Live postings of a term across all segments, weighted with the global idf
+    """
+
+    def __init__(self, index, field, term, segments, idf):
+        """
+        Initializes the postings
+        :param index:  SegmentedIndex
+        :param field:  field of the term
+        :param term:  term
+        :param segments:  snapshot of the segments
+        :param idf:  global idf of the term
+        """
+        self.index = index
+        self.field = field
+        self.term = term
+        self.segments = segments
+        self.idf = idf
+
+    def arrays(self, idf=None):
+        """
+        Returns the live postings of all segments as arrays
+        :param idf:  idf used for the weights, the global idf of the term by default
+        :return:  doc_ids, tf-idf weights
+        """
+        idf = self.idf if idf is None else idf
+        all_doc_ids, all_weights = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.float64)]
+        for segment in self.segments:
+            postings = segment.postings(self.field, self.term)
+            if postings is None:
+                continue
+            doc_ids, weights = postings_arrays(postings, idf)
+            if segment.deleted:
+                live = ~np.isin(doc_ids, list(segment.deleted))
+                doc_ids, weights = doc_ids[live], weights[live]
+            all_doc_ids.append(doc_ids)
+            all_weights.append(weights)
+        return np.concatenate(all_doc_ids), np.concatenate(all_weights)
+
+    def __getitem__(self, docID):
+        segment = self.index.doc_segment.get(docID)
+        postings = None if segment is None else segment.postings(self.field, self.term)
+        if postings is None or docID not in postings:
+            raise KeyError(docID)
+        posting = dict(postings[docID])
+        posting["tf-idf"] = posting["tf"] * self.idf
+        return posting
+
+    def __contains__(self, docID):
+        segment = self.index.doc_segment.get(docID)
+        postings = None if segment is None else segment.postings(self.field, self.term)
+        return postings is not None and docID in postings
+
+    def __iter__(self):
+        for segment in self.segments:
+            postings = segment.postings(self.field, self.term)
+            if postings is not None:
+                for docID in postings:
+                    if docID not in segment.deleted:
+                        yield docID
+
+    def __len__(self):
+        return self.index.df(self.field, self.term, self.segments)
+
+
+class SegmentedField(Mapping):
+    """
+    Terms of a field across all segments of a SegmentedIndex
+    """
+
+    def __init__(self, index, field):
+        """
+        Initializes the field
+        :param index:  SegmentedIndex
+        :param field:  name of the field
+        """
+        self.index = index
+        self.field = field
+
+    def __getitem__(self, term):
+        segments = list(self.index.segments)
+        df = self.index.df(self.field, term, segments)
+        if df == 0:
+            raise KeyError(term)
+        idf = np.log10(self.index.num_docs() / float(df))
+        return {"idf": idf, "df": df, "docIDs": SegmentedPostings(self.index, self.field, term, segments, idf)}
+
+    def __contains__(self, term):
+        return self.index.df(self.field, term) > 0
+
+    def __iter__(self):
+        seen = set()
+        for segment in list(self.index.segments):
+            for term in segment.index[self.field]:
+                if term not in seen and term in self:
+                    seen.add(term)
+                    yield term
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class SegmentedDocs(Mapping):
+    """
+    Live documents of a SegmentedIndex
+    """
+
+    def __init__(self, index):
+        """
+        Initializes the documents
+        :param index:  SegmentedIndex
+        """
+        self.index = index
+
+    def __getitem__(self, docID):
+        segment = self.index.doc_segment.get(int(docID))
+        if segment is None:
+            raise KeyError(docID)
+        return segment.docs[int(docID)]
+
+    def __iter__(self):
+        return iter(list(self.index.doc_segment.keys()))
+
+    def __len__(self):
+        return len(self.index.doc_segment)
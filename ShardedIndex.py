@@ -0,0 +1,406 @@
+import functools
+import json
+import multiprocessing
+import os
+import threading
+import zlib
+from collections import Counter
+
+import numpy as np
+
+import preprocessing_pipelines
+import searcher
+from Index import Index
+from utils.query_stats import QueryStats
+from utils.result_cache import new_generation
+
+
+class Shard:
+    """
+    Index of one shard - lives in the process of the shard and executes the commands of ShardedIndex
+
+    Attributes:
+    index: Index of the documents of the shard (local document ids in the order of the global ids)
+    preped_docs: preprocessed documents waiting for the global statistics of the build
+    """
+
+    def __init__(self, pipeline, index_folder, index_name):
+        """
+        Initializes the shard
+        :param pipeline: preprocessing pipeline
+        :param index_folder: folder of the shard index
+        :param index_name: name of the shard index
+        """
+        self.index = Index(pipeline, index_folder, index_name)
+        self.preped_docs = None
+
+    def load_docs(self, data_folder, filenames):
+        """
+        Loads and preprocesses the documents of the shard - the first phase of the build
+        :param data_folder: path to the data folder
+        :param filenames: files of the shard in the order of the global document ids
+        :return: number of documents, document frequencies {field: {term: df}}
+        """
+        self.index.create_doc_cache(data_folder, filenames)
+        self.preped_docs = preprocessing_pipelines.preprocess_parallel(self.index.docs["docs"].items(),
+                                                                       self.index.pipeline, workers=1)
+        df = {field: Counter() for field in self.index.fields}
+        for doc in self.preped_docs:
+            for field in self.index.fields:
+                df[field].update(set(doc[field]))
+        return len(self.preped_docs), {field: dict(counts) for field, counts in df.items()}
+
+    def build(self, global_idf):
+        """
+        Creates the index of the shard with the idf of the whole collection - the second phase of the build
+        :param global_idf: {field: {term: idf}}
+        :return: keywords of the shard
+        """
+        self.index.create_index(self.preped_docs, global_idf)
+        self.preped_docs = None
+        self.index.set_keywords()
+        return self.index.keywords
+
+    def save(self):
+        """
+        Saves the index of the shard
+        """
+        self.index.save_index()
+
+    def load(self, mmap, global_idf):
+        """
+        Loads the index of the shard
+        :param mmap: open the index read-only and memory-mapped
+        :param global_idf: {field: {term: idf}} of the whole collection
+        :return: keywords of the shard
+        """
+        self.index.load_index(mmap=mmap)
+        self.index.global_idf = global_idf
+        if not self.index.keywords:
+            self.index.set_keywords()
+        return self.index.keywords
+
+    def search(self, query, field, k, model, prune):
+        """
+        Searches for the k best documents of the shard
+        :return: result_obj, results_total, QueryStats of the search
+        """
+        stats = QueryStats(query, field, model, k)
+        result_obj, results_total = searcher._search(query, field, k, self.index, model, False, prune, stats)
+        return result_obj, results_total, stats
+
+    def snippet(self, loader):
+        """
+        Creates the snippet of a search result of the shard
+        :param loader: SnippetLoader of the result (sent without the index)
+        :return: snippet
+        """
+        loader.index = self.index
+        return loader()
+
+    def document(self, doc_id):
+        """
+        Returns the document of the shard
+        :param doc_id: local id of the document
+        :return: document
+        """
+        return self.index.docs["docs"][doc_id]
+
+
+def _shard_main(connection, pipeline, index_folder, index_name):
+    """
+    Loop of the process of a shard - executes the commands received from ShardedIndex
+    :param connection: end of the pipe to ShardedIndex
+    :param pipeline: preprocessing pipeline
+    :param index_folder: folder of the shard index
+    :param index_name: name of the shard index
+    """
+    shard = Shard(pipeline, index_folder, index_name)
+    while True:
+        try:
+            command, args = connection.recv()
+        except EOFError:
+            break
+        if command == "close":
+            break
+        try:
+            connection.send(("ok", getattr(shard, command)(*args)))
+        except Exception as error:
+            connection.send(("error", "{}: {}".format(type(error).__name__, error)))
+
+
+class ShardedDocs:
+    """
+    Read-only view of the documents of all shards by global document id (ShardedIndex.docs["docs"])
+    """
+
+    def __init__(self, sharded_index):
+        """
+        Initializes the view
+        :param sharded_index: ShardedIndex
+        """
+        self.sharded_index = sharded_index
+
+    def __getitem__(self, doc_id):
+        shard, local_id = self.sharded_index.locate(doc_id)
+        return self.sharded_index.call(shard, "document", local_id)
+
+    def __contains__(self, doc_id):
+        return 0 <= doc_id < len(self)
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def __len__(self):
+        return len(self.sharded_index.shard_of)
+
+
+class ShardedIndex:
+    """
+    Index of a collection hash-partitioned into shards, every shard is an Index built and searched in its own process
+    A query is sent to all shards at once, every shard returns its k best documents and they are merged into
+    the global k best. The shards are built with the idf of the whole collection (document frequencies of the
+    shards are summed before the shard indexes are created), so the scores are the same as in one Index of
+    the collection. The documents can only be changed by building the index again.
+
+    Attributes:
+    pipeline: preprocessing pipeline
+    index_folder: folder of the shard indexes
+    index_name: name of the index, the shards are named <index_name>_shard<number>
+    global_ids: global ids of the documents of every shard (indexed by the local id)
+    shard_of: shard of every document (indexed by the global id)
+    local_of: local id of every document in its shard (indexed by the global id)
+    global_idf: {field: {term: idf}} of the whole collection
+    keywords: set of keywords of all shards
+    docs: {"docs": ShardedDocs} - documents by global id
+    generation: changes with every change of the search results (see result_cache)
+    """
+
+    def __init__(self, pipeline, index_folder, index_name, shards=4):
+        """
+        Initializes the index and starts the processes of the shards
+        :param pipeline: preprocessing pipeline (module level function, e.g. pipeline_stemmer)
+        :param index_folder: folder to save the shard indexes to
+        :param index_name: name of the index
+        :param shards: number of shards
+        """
+        self.pipeline = pipeline
+        self.index_folder = index_folder
+        self.index_name = index_name
+        self.global_ids = [np.empty(0, dtype=np.int64) for _ in range(shards)]
+        self.shard_of = np.empty(0, dtype=np.int64)
+        self.local_of = np.empty(0, dtype=np.int64)
+        self.global_idf = None
+        self.keywords = set()
+        self.docs = {"docs": ShardedDocs(self), "unused_ids": [], "max_id": -1}
+        self.generation = new_generation()
+        self.lock = threading.Lock()  # one request to the shards at a time
+        if not os.path.exists(index_folder):
+            os.makedirs(index_folder)
+        # forked shards don't import the modules again (config loads the indexes when imported)
+        context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+        self.connections = []
+        self.processes = []
+        for shard in range(shards):
+            connection, shard_connection = context.Pipe()
+            process = context.Process(target=_shard_main, daemon=True, args=(
+                shard_connection, pipeline, index_folder, "{}_shard{}".format(index_name, shard)))
+            process.start()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def scatter(self, command, args):
+        """
+        Sends the command to all shards and waits for all of them, the shards execute it in parallel
+        :param command: name of the Shard method
+        :param args: arguments of the method for every shard
+        :return: results of the shards
+        """
+        with self.lock:
+            for connection, shard_args in zip(self.connections, args):
+                connection.send((command, shard_args))
+            replies = [connection.recv() for connection in self.connections]
+        errors = [reply for status, reply in replies if status == "error"]
+        if errors:
+            raise RuntimeError("Shard command {} failed: {}".format(command, errors[0]))
+        return [reply for _, reply in replies]
+
+    def call(self, shard, command, *args):
+        """
+        Executes the command in one shard
+        :param shard: number of the shard
+        :param command: name of the Shard method
+        :return: result of the shard
+        """
+        with self.lock:
+            self.connections[shard].send((command, args))
+            status, reply = self.connections[shard].recv()
+        if status == "error":
+            raise RuntimeError("Shard command {} failed: {}".format(command, reply))
+        return reply
+
+    def locate(self, doc_id):
+        """
+        Finds the shard of a document
+        :param doc_id: global id of the document
+        :return: shard, local id of the document in the shard
+        """
+        doc_id = int(doc_id)
+        if not 0 <= doc_id < len(self.shard_of):
+            raise KeyError(doc_id)
+        return int(self.shard_of[doc_id]), int(self.local_of[doc_id])
+
+    def _set_shards(self, global_ids):
+        """
+        Sets the mapping between the global and the local document ids
+        :param global_ids: global ids of the documents of every shard
+        """
+        self.global_ids = [np.asarray(ids, dtype=np.int64) for ids in global_ids]
+        size = sum(len(ids) for ids in self.global_ids)
+        self.shard_of = np.empty(size, dtype=np.int64)
+        self.local_of = np.empty(size, dtype=np.int64)
+        for shard, ids in enumerate(self.global_ids):
+            self.shard_of[ids] = shard
+            self.local_of[ids] = np.arange(len(ids))
+        self.docs["max_id"] = size - 1
+
+    def _shards_path(self):
+        """
+        Returns the path to the file with the document ids of the shards and the global idf
+        :return: path
+        """
+        return os.path.join(self.index_folder, self.index_name + "_shards.json")
+
+    def create_index_from_folder(self, data_folder="data"):
+        """
+        Creates the shards from the documents in the data folder
+        The documents are assigned to the shards by the hash of their file name and get the global ids in the
+        order of the files (like in Index.create_doc_cache). Every shard loads and preprocesses its documents
+        and returns their document frequencies, the summed frequencies give the idf of the whole collection
+        and the shards create their indexes with it.
+        :param data_folder: path to the data folder
+        """
+        filenames = [filename for filename in os.listdir(data_folder) if filename.endswith(".json")]
+        parts = [[] for _ in self.connections]
+        for doc_id, filename in enumerate(filenames):
+            parts[zlib.crc32(filename.encode("utf-8")) % len(parts)].append((doc_id, filename))
+        loaded = self.scatter("load_docs", [(data_folder, [filename for _, filename in part]) for part in parts])
+        N = sum(count for count, _ in loaded)
+        self.global_idf = {}
+        for field in loaded[0][1]:
+            df = Counter()
+            for _, shard_df in loaded:
+                df.update(shard_df[field])
+            self.global_idf[field] = {term: float(np.log10(N / count)) for term, count in df.items()}
+        keywords = self.scatter("build", [(self.global_idf,)] * len(parts))
+        self._set_shards([[doc_id for doc_id, _ in part] for part in parts])
+        self.keywords = set().union(*keywords)
+        self.generation = new_generation()
+        print("Created {} shards with {} documents".format(len(parts), N))
+
+    def save_index(self):
+        """
+        Saves the shards and the document ids of the shards with the global idf
+        """
+        self.scatter("save", [()] * len(self.connections))
+        with open(self._shards_path(), "w", encoding="utf-8") as file:
+            json.dump({"global_ids": [ids.tolist() for ids in self.global_ids], "global_idf": self.global_idf},
+                      file, ensure_ascii=False)
+
+    def load_index(self, mmap=False):
+        """
+        Loads the shards saved by save_index
+        :param mmap: open the shard indexes read-only and memory-mapped
+        """
+        with open(self._shards_path(), "r", encoding="utf-8") as file:
+            saved = json.load(file)
+        if len(saved["global_ids"]) != len(self.connections):
+            raise ValueError("The index has {} shards, not {}".format(len(saved["global_ids"]), len(self.connections)))
+        self.global_idf = saved["global_idf"]
+        keywords = self.scatter("load", [(mmap, self.global_idf)] * len(self.connections))
+        self._set_shards(saved["global_ids"])
+        self.keywords = set().union(*keywords)
+        self.generation = new_generation()
+
+    def scatter_search(self, query, field, k, model, prune, stats):
+        """
+        Searches for the k best documents in all shards and merges them (called by searcher.search)
+        Results are ordered like in one index - by the score, proximity results by the length of the occurrence
+        first, boolean results by the document id; equal scores are ordered by the document id.
+        :param query: query to search for
+        :param field: field to search in, if empty search in all fields
+        :param k: number of best documents to return
+        :param model: model to use for the search
+        :param prune: skip the documents that can't get into the top k in the shards
+        :param stats: QueryStats of the search
+        :return: result_obj, results_total
+        """
+        replies = self.scatter("search", [(query, field, k, model, prune)] * len(self.connections))
+        merged = []
+        results_total = 0
+        for shard, (result_obj, shard_total, shard_stats) in enumerate(replies):
+            results_total += shard_total
+            stats.postings += shard_stats.postings
+            stats.scored += shard_stats.scored
+            for name, seconds in shard_stats.stages.items():  # the shards search in parallel - the slowest one
+                stats.stages["shard:" + name] = max(stats.stages.get("shard:" + name, 0.0), seconds)
+            for result in result_obj:
+                result.doc_id = int(self.global_ids[shard][result.doc_id])
+                span = 0
+                if isinstance(result._snippet, searcher.SnippetLoader):
+                    if result._snippet.match is not None:
+                        span = result._snippet.match[-1] - result._snippet.match[0]
+                    result._snippet.stats = None
+                    result._snippet = functools.partial(self._snippet, shard, result._snippet, stats)
+                merged.append((span, result))
+        if model == "boolean":
+            merged.sort(key=lambda item: item[1].doc_id)
+        else:
+            merged.sort(key=lambda item: (item[0], -item[1].score, item[1].doc_id))
+        return [result for _, result in merged[:k]], results_total
+
+    def _snippet(self, shard, loader, stats):
+        """
+        Creates the snippet of a search result in its shard
+        :param shard: number of the shard
+        :param loader: SnippetLoader of the result
+        :param stats: QueryStats of the search counting the created snippets
+        :return: snippet
+        """
+        stats.snippets += 1
+        with stats.stage("create_snippet"):
+            return self.call(shard, "snippet", loader)
+
+    def _check_writable(self):
+        """
+        Raises an error - the documents of the shards can only be changed by building the index again
+        """
+        raise RuntimeError("Index \"{}\" is sharded, it can only be built again".format(self.index_name))
+
+    def create_document(self, doc):
+        """
+        Not supported - see _check_writable
+        """
+        self._check_writable()
+
+    def update_document(self, doc_id, replacement, field):
+        """
+        Not supported - see _check_writable
+        """
+        self._check_writable()
+
+    def delete_document(self, doc_id):
+        """
+        Not supported - see _check_writable
+        """
+        self._check_writable()
+
+    def close(self):
+        """
+        Stops the processes of the shards
+        """
+        with self.lock:
+            for connection in self.connections:
+                connection.send(("close", ()))
+        for process in self.processes:
+            process.join()
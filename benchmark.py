@@ -0,0 +1,228 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+import preprocessing_pipelines
+import searcher
+from Index import Index
+from config import pipeline
+from utils.preprocessor import token_cache
+
+pipelines = {
+    "stemmer": preprocessing_pipelines.pipeline_stemmer,
+    "lemmatizer": preprocessing_pipelines.pipeline_lemmatizer,
+    "lemmatizer2": preprocessing_pipelines.pipeline_lemmatizer2,
+}
+WORD_REGEX = re.compile(r"^\w{3,}$")  # words used in the generated queries
+
+
+def timed(function, *args, **kwargs):
+    """
+    Calls the function with its output suppressed and measures the time
+    :param function: function to call
+    :return: result of the function, time in seconds
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        return result, time.perf_counter() - start
+
+
+def generate_queries(docs, count, seed):
+    """
+    Generates the benchmark queries from the words of the documents, the same seed gives the same queries
+    :param docs: {docID: document}
+    :param count: number of queries of every kind
+    :param seed: seed of the random generator
+    :return: {"tf-idf": [...], "boolean": [...], "proximity": [...]}
+    """
+    rng = random.Random(seed)
+    doc_ids = sorted(docs)
+    title_words, content = [], []
+    for doc_id in doc_ids:
+        title_words.extend(word for word in docs[doc_id]["title"].split() if WORD_REGEX.match(word))
+        content.append([word for word in docs[doc_id]["content"].split() if WORD_REGEX.match(word)])
+    content = [words for words in content if len(words) >= 2]
+    queries = {"tf-idf": [], "boolean": [], "proximity": []}
+    if not title_words or not content:
+        return queries
+    for _ in range(count):
+        queries["tf-idf"].append(" ".join(rng.choice(title_words) for _ in range(rng.randint(1, 3))))
+        first, second = rng.choice(title_words), rng.choice(title_words)
+        queries["boolean"].append(rng.choice(["{} AND {}", "{} OR {}", "{} AND NOT {}"]).format(first, second))
+        words = rng.choice(content)
+        start = rng.randrange(len(words) - 1)
+        if rng.random() < 0.5:
+            queries["proximity"].append("\"{} {}\"".format(words[start], words[start + 1]))
+        else:
+            queries["proximity"].append("{} {}~3".format(words[start], words[start + 1]))
+    return queries
+
+
+def search_shown(query, field, k, index, model):
+    """
+    Searches for the query and creates the snippets of the results as when they are shown - the snippets are
+    created lazily, so the search alone doesn't include them
+    :param query: query to search for
+    :param field: field to search in, empty for all fields
+    :param k: number of best documents
+    :param index: index of the documents
+    :param model: model to use for the search
+    :return: result_obj, results_total
+    """
+    result_obj, results_total = searcher.search(query, field, k, index, model)
+    for result in result_obj:
+        result.snippet
+    return result_obj, results_total
+
+
+def search_many_shown(queries, field, k, index, model, workers):
+    """
+    Searches for the queries in a batch and creates the snippets of all results
+    :param queries: list of queries
+    :param field: field to search in, empty for all fields
+    :param k: number of best documents
+    :param index: index of the documents
+    :param model: model to use for the search
+    :param workers: number of processes
+    :return: list of (result_obj, results_total)
+    """
+    results = searcher.search_many(queries, field, k, index, model, workers)
+    for result_obj, _ in results:
+        for result in result_obj:
+            result.snippet
+    return results
+
+
+def query_stats(queries, field, k, index, model):
+    """
+    Measures the latency of every query including its snippets (after one warm-up pass), the result cache is not used
+    :param queries: list of queries
+    :param field: field to search in, empty for all fields
+    :param k: number of best documents
+    :param index: index of the documents
+    :param model: model to use for the search
+    :return: {"queries", "p50_ms", "p95_ms", "p99_ms", "mean_ms", "throughput_qps"}
+    """
+    if not queries:
+        return {"queries": 0}
+    for query in queries:
+        timed(search_shown, query, field, k, index, model)
+    latencies = np.array([timed(search_shown, query, field, k, index, model)[1] for query in queries]) * 1000
+    return {
+        "queries": len(queries),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "mean_ms": float(latencies.mean()),
+        "throughput_qps": float(len(queries) / (latencies.sum() / 1000)),
+    }
+
+
+def git_commit():
+    """
+    Returns the current commit of the repository
+    :return: commit hash, None outside of a git repository
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(data_folder, pipeline_names, queries_count, k, seed, workers):
+    """
+    Runs the benchmark - builds, saves and loads the index of the corpus and searches the generated queries
+    :param data_folder: folder with the documents (JSON files)
+    :param pipeline_names: names of the pipelines whose preprocessing is measured
+    :param queries_count: number of queries of every kind
+    :param k: number of best documents of every query
+    :param seed: seed of the generated queries
+    :param workers: number of processes for the preprocessing and the batch search
+    :return: results of the benchmark
+    """
+    results = {"commit": git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+               "cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "params": {"data": data_folder, "pipelines": pipeline_names, "queries": queries_count, "k": k,
+                          "seed": seed, "workers": workers}}
+    # the searcher preprocesses the queries with the pipeline from the config, so the index uses it as well
+    index_pipeline = next((name for name, function in pipelines.items() if function is pipeline), None)
+    if index_pipeline is not None and index_pipeline not in pipeline_names:
+        pipeline_names = pipeline_names + [index_pipeline]
+    searcher.result_cache.max_bytes = 0
+
+    with tempfile.TemporaryDirectory() as folder:
+        index = Index(pipeline, folder, "benchmark")
+        _, seconds = timed(index.create_doc_cache, data_folder)
+        results["create_doc_cache"] = {"seconds": seconds, "documents": len(index.docs["docs"])}
+
+        results["preprocessing"] = {}
+        preped_docs = None
+        for name in pipeline_names:
+            token_cache.forms.clear()  # every pipeline starts without cached stems and lemmas
+            preped, seconds = timed(preprocessing_pipelines.preprocess_parallel, index.docs["docs"].items(),
+                                    pipelines[name], workers)
+            results["preprocessing"][name] = {"seconds": seconds, "docs_per_second": len(preped) / seconds}
+            if pipelines[name] is pipeline:
+                preped_docs = preped
+        if preped_docs is None:
+            preped_docs, _ = timed(preprocessing_pipelines.preprocess_parallel, index.docs["docs"].items(),
+                                   pipeline, workers)
+
+        _, seconds = timed(index.create_index, preped_docs)
+        results["create_index"] = {"seconds": seconds,
+                                   "terms": {field: len(index.index[field]) for field in index.fields}}
+        _, seconds = timed(index.save_index)
+        results["save_index"] = {"seconds": seconds,
+                                 "bytes": os.path.getsize(os.path.join(folder, "benchmark.bin"))}
+        results["load_index"] = {}
+        for mmap in (False, True):
+            loaded = Index(pipeline, folder, "benchmark")
+            _, seconds = timed(loaded.load_index, mmap=mmap)
+            results["load_index"]["mmap" if mmap else "memory"] = {"seconds": seconds}
+
+        queries = generate_queries(index.docs["docs"], queries_count, seed)
+        results["queries"] = {
+            "tf-idf": query_stats(queries["tf-idf"], "", k, index, "tf-idf"),
+            "tf-idf_content": query_stats(queries["tf-idf"], "content", k, index, "tf-idf"),
+            "boolean": query_stats(queries["boolean"], "", k, index, "boolean"),
+            "proximity": query_stats(queries["proximity"], "content", k, index, "tf-idf"),
+        }
+        if workers != 1 and queries["tf-idf"]:
+            _, seconds = timed(search_many_shown, queries["tf-idf"], "", k, index, "tf-idf", workers)
+            results["queries"]["tf-idf_batch"] = {"queries": len(queries["tf-idf"]), "seconds": seconds,
+                                                  "throughput_qps": len(queries["tf-idf"]) / seconds}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures building, saving, loading and searching of the index")
+    parser.add_argument("--data", default="data", help="folder with the documents (JSON files)")
+    parser.add_argument("--pipelines", nargs="+", choices=list(pipelines), default=list(pipelines),
+                        help="pipelines whose preprocessing is measured")
+    parser.add_argument("--queries", type=int, default=200, help="number of queries of every kind")
+    parser.add_argument("-k", type=int, default=10, help="number of best documents of every query")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated queries")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes, 0 for the number of CPUs")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file with the results")
+    args = parser.parse_args()
+
+    results = run(args.data, args.pipelines, args.queries, args.k, args.seed, args.workers or None)
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(results, file, ensure_ascii=False, indent=1)
+    print(json.dumps(results, ensure_ascii=False, indent=1))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,27 @@ from Index import Index
 # Window size for the sliding window when creating snippets
 WINDOW_SIZE = 30
 
+# Safe top-k pruning (MaxScore) of the ranked search - skips the documents that can't get into the top k,
+# the results are the same as with scoring all documents
+SAFE_TOP_K = True
+
+# Max size of the cached search results in bytes (LRU, invalidated by every change of the index), 0 disables the cache
+RESULT_CACHE_SIZE = 64 * 1024 * 1024
+
+# Searches slower than the threshold (seconds) are logged with their per-stage times, None disables the log
+SLOW_QUERY_THRESHOLD = 1.0
+# File of the slow query log (one JSON line per search), None keeps only the last searches in memory
+SLOW_QUERY_LOG = "slow_queries.jsonl"
+
+# HTTP search service (server.py) - address, number of the search processes (None for the number of CPUs,
+# 0 searches in the threads), number of the threads waiting for the searches and running the changes of the indexes
+# (None for the default of Python) and the token of the admin endpoints (None allows them only from localhost)
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8080
+SERVER_PROCESSES = None
+SERVER_WORKERS = 8
+SERVER_ADMIN_TOKEN = None
+
 # PIPELINE - choose between stemmer and lemmatizer
 pipeline = preprocessing_pipelines.pipeline_stemmer
 # pipeline = preprocessing_pipelines.pipeline_lemmatizer
@@ -18,5 +39,12 @@ indexes = []
 # Main index created from the crawled data
 index1 = Index(pipeline, "index", "ES_index")
 index1.load_index()
-index1.set_keywords()
-indexes.append(index1) # ! add index to the list of indexes for the GUI
\ No newline at end of file
+if not index1.keywords:  # keywords are saved with the index, computing them reads every document
+    index1.set_keywords()
+indexes.append(index1) # ! add index to the list of indexes for the GUI
+
+# Sharded index - the documents are split into shards searched in parallel processes (ShardedIndex.py)
+# from ShardedIndex import ShardedIndex
+# index2 = ShardedIndex(pipeline, "index", "ES_index_sharded", shards=4)
+# index2.load_index()  # created by index2.create_index_from_folder("data") and index2.save_index()
+# indexes.append(index2)
\ No newline at end of file
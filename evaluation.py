@@ -4,7 +4,7 @@ import pandas as pd
 
 import preprocessing_pipelines
 from Index import Index
-from searcher import search
+from searcher import search_many
 
 # PIPELINE
 # pipeline = preprocessing_pipelines.pipeline_stemmer
@@ -52,7 +52,7 @@ def create_doc_cache(Index_obj, eval_docs):
     Index_obj.docs = {"docs": {}, "unused_ids": [], "max_id": 0}
     index = 0
     for data in eval_docs:
-        Index_obj.docs["docs"][str(index)] = data
+        Index_obj.docs["docs"][index] = data
         index += 1
     Index_obj.docs["max_id"] = index - 1
     print("Loaded", len(Index_obj.docs["docs"]), "documents")
@@ -70,9 +70,8 @@ time_start = time.time()
 eval_index = Index(pipeline, "eval_index_lem", "eval_index")
 
 # create_doc_cache(eval_index, eval_docs)
-# preped_docs = []
-# for doc_id in eval_index.docs["docs"].keys():
-#     preped_docs.append(preprocessing_pipelines.preprocess(eval_index.docs["docs"][doc_id], doc_id, eval_index.pipeline, remove_stopwords=True))
+# preped_docs = preprocessing_pipelines.preprocess_parallel(eval_index.docs["docs"].items(), eval_index.pipeline,
+#                                                           workers=None, remove_stopwords=True)
 # time_end = time.time()
 # print("Preprocessed documents in", time_end - time_start, "seconds")
 # time_start = time.time()
@@ -92,8 +91,10 @@ print("Loaded index in", time_end - time_start, "seconds")
 model = "tf-idf"
 time_start = time.time()
 eval_results = ""
-for query_id in queries.keys():
-    result_objs, num = search(queries[query_id], "", 100000, eval_index, model)
+query_ids = list(queries.keys())
+# the queries are searched in parallel processes sharing the loaded index
+found = search_many([queries[query_id] for query_id in query_ids], "", 100000, eval_index, model)
+for query_id, (result_objs, num) in zip(query_ids, found):
     if num == 0:
         line = query_id + " Q0 " + "abc" + " " + "99" + " " + str(0.0) + " runindex1"
         continue
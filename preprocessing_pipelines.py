@@ -1,11 +1,16 @@
 import json
+import multiprocessing
 import re
 
+import numpy as np
+
 import utils.preprocessor as preprocessor
+from utils.snippets import encode_offsets
 
 # stopwords taken from Stopwords ISO: https://github.com/stopwords-iso
 CZECH_STOPWORDS = "utils/stopwords-cs.txt"
 SLOVAK_STOPWORDS = "utils/stopwords-sk.txt"
+NUMBER_LETTER_REGEX = r'(\d)([a-zA-Z])|([a-zA-Z])(\d)'  # number followed by a letter or letter followed by a number
 
 def pipeline_tokenizer(text, snippet=False, remove_stopwords=False):
     """
@@ -23,7 +28,7 @@ def pipeline_tokenizer(text, snippet=False, remove_stopwords=False):
     preprocessed_text = preprocessor.remove_in_text_citation_marks(
         preprocessed_text)  # remove in text citation marks e.g. [12]
     preprocessed_text = preprocessor.remove_parentheses(preprocessed_text)  # remove parentheses () or [] or {}
-    preprocessed_text = re.sub(r'(\d)([a-zA-Z])|([a-zA-Z])(\d)', r'\1\3 \2\4',
+    preprocessed_text = re.sub(NUMBER_LETTER_REGEX, r'\1\3 \2\4',
                                preprocessed_text)  # add space between number and letter or letter and number
 
     if snippet:
@@ -37,6 +42,38 @@ def pipeline_tokenizer(text, snippet=False, remove_stopwords=False):
     return preprocessed_text, tokens
 
 
+def token_offsets(text):
+    """
+    Finds the tokens of pipeline_tokenizer in the original text - the token at position i of the index
+    is text[starts[i]:ends[i]]
+    The text goes through the same steps as in pipeline_tokenizer, with the offset of every character
+    in the original text. It is not lowercased - that doesn't change the tokens.
+    :param text:  input text
+    :return:  starts, ends - int arrays
+    """
+    mapping = np.arange(len(text))
+    for pattern in (preprocessor.HTML_TAGS_REGEX, preprocessor.CITATION_MARKS_REGEX, preprocessor.PARENTHESES_REGEX):
+        text, mapping = preprocessor.remove_with_mapping(pattern, text, mapping)
+    spaces = [matched.start() + 1 for matched in re.finditer(NUMBER_LETTER_REGEX, text)]
+    if spaces:  # the inserted space gets the offset of the next character
+        text = " ".join(text[start:end] for start, end in zip([0] + spaces, spaces + [len(text)]))
+        mapping = np.insert(mapping, spaces, mapping[spaces])
+    tokens = preprocessor.tokenize_with_starts(text)
+    offsets = np.array([offset for offset, _ in tokens], dtype=np.int64)
+    lengths = np.array([len(token) for _, token in tokens], dtype=np.int64)
+    if len(tokens) == 0:
+        return offsets, offsets
+    return mapping[offsets], mapping[offsets + lengths - 1] + 1
+
+
+def add_token_offsets(doc):
+    """
+    Stores the offsets of the content tokens in the document (used for the snippets)
+    :param doc:  document - dictionary with the content
+    """
+    doc["content_offsets"] = encode_offsets(*token_offsets(doc["content"]))
+
+
 def pipeline_stemmer(text, remove_stopwords=False):
     """
     Stems the input text and removes diacritics
@@ -122,4 +159,49 @@ def preprocess(doc, doc_id, pipeline, remove_stopwords=False):
     preprocessed_data["table_of_contents"] = [word for chapter in preprocessed_data["table_of_contents"] for word in
                                               pipeline(re.sub(chapter_num, "",
                                                         chapter), remove_stopwords=remove_stopwords)]  # remove chapter numbers and preprocess the chapters
-    return preprocessed_data
\ No newline at end of file
+    return preprocessed_data
+
+
+def _preprocess_item(item):
+    """
+    Helper for preprocess_parallel - preprocesses one (doc_id, doc) item
+    :param item: (doc_id, doc, pipeline, remove_stopwords)
+    :return: preprocessed document
+    """
+    doc_id, doc, pipeline, remove_stopwords = item
+    return preprocess(doc, doc_id, pipeline, remove_stopwords=remove_stopwords)
+
+
+def _preprocess_chunk(chunk):
+    """
+    Helper for preprocess_parallel - preprocesses a chunk of items in a worker process
+    :param chunk: list of items for _preprocess_item
+    :return: (preprocessed documents, forms added to the token cache of the worker)
+    """
+    sizes = preprocessor.token_cache.sizes()
+    preped_docs = [_preprocess_item(item) for item in chunk]
+    return preped_docs, preprocessor.token_cache.added_since(sizes)
+
+
+def preprocess_parallel(docs, pipeline, workers=None, chunk_size=64, remove_stopwords=False):
+    """
+    Preprocesses the documents in a pool of processes
+    The stems and lemmas cached by the workers are added to the token cache of this process.
+    :param docs: list of (doc_id, doc) pairs
+    :param pipeline: preprocessing pipeline (module level function, e.g. pipeline_stemmer)
+    :param workers: number of worker processes, None for the number of CPUs, 1 preprocesses in this process
+    :param chunk_size: number of documents sent to a worker at once
+    :param remove_stopwords: if the stopwords should be removed
+    :return: preprocessed documents in the same order as docs
+    """
+    items = [(doc_id, doc, pipeline, remove_stopwords) for doc_id, doc in docs]
+    if workers == 1 or len(items) <= chunk_size:
+        return [_preprocess_item(item) for item in items]
+    chunks = [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+    preped_docs = []
+    with multiprocessing.Pool(workers) as pool:
+        # imap keeps the input order, so the result does not depend on the scheduling of the workers
+        for chunk_docs, forms in pool.imap(_preprocess_chunk, chunks):
+            preped_docs.extend(chunk_docs)
+            preprocessor.token_cache.update(forms)
+    return preped_docs
@@ -1,11 +1,23 @@
-import itertools
+import heapq
+import multiprocessing
+import sys
 import time
 import numpy as np
 from collections import defaultdict
+from utils import boolean_query
 from utils.boolean_parser import infix_to_postfix
+from utils.positional import shortest_match
+from utils.query_stats import QueryStats, SlowQueryLog
+from utils.postings_codec import ArrayPostings, postings_arrays
+from utils.result_cache import ResultCache
+from utils.snippets import decode_offsets, slice_snippet
 from config import *
 
 fields = ["title", "table_of_contents", "infobox", "content"]
+field_weights = {"title": 1.1, "table_of_contents": 1, "infobox": 0.5, "content": 0.5}  # weights for the fields
+result_cache = ResultCache(RESULT_CACHE_SIZE)  # results of the repeated queries
+slow_query_log = SlowQueryLog(SLOW_QUERY_THRESHOLD, SLOW_QUERY_LOG)  # searches slower than the threshold
+_pool_search = None  # (field, k, index, model, prune) inherited by the forked workers of search_many
 
 class SearchResult:
     """
@@ -15,7 +27,7 @@ class SearchResult:
     doc_id: id of the document
     score: score of the document
     title: title of the document
-    snippet: snippet of the document
+    snippet: snippet of the document, created when it is used first
     lang: language of the document - abbreviation
     detected_lang: detected language of the document - full name
 
@@ -27,12 +39,12 @@ class SearchResult:
         :param doc_id: id of the document
         :param score: score of the document
         :param title: title of the document
-        :param snippet: snippet of the document
+        :param snippet: snippet of the document or function creating it (called when the snippet is used first)
         :param lang: language of the document
         """
         self.doc_id = doc_id
         self.score = score
-        self.snippet = snippet
+        self._snippet = snippet
         self.title = title
         self.lang = lang
         self.detected_lang = {
@@ -48,6 +60,16 @@ class SearchResult:
             "sk": "Detekován slovenský jazyk",
         }.get(lang, "Detekován neznámý jazyk")
 
+    @property
+    def snippet(self):
+        """
+        Returns the snippet, it is created now if it wasn't used yet
+        :return: snippet of the document
+        """
+        if callable(self._snippet):
+            self._snippet = self._snippet()
+        return self._snippet
+
     def get_item(self):
         """
         Returns the search result as a list
@@ -65,18 +87,56 @@ class SearchResult:
         return f"Document {self.doc_id} with score {self.score}\nTitle: {self.title}\nSnippet: {self.snippet}\n"
 
 
-def query_prep(query, index):
+class Scores:
+    """
+    Scores of the documents matching a query
+
+    Attributes:
+    doc_ids: ids of the scored documents in the order they were first found in the postings
+    values: scores of the documents
+    """
+
+    def __init__(self, doc_ids, values):
+        """
+        Initializes the scores
+        :param doc_ids: ids of the scored documents
+        :param values: scores of the documents
+        """
+        self.doc_ids = doc_ids
+        self.values = values
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def keys(self):
+        """
+        Returns the ids of the scored documents
+        """
+        return self.doc_ids.tolist()
+
+    def items(self):
+        """
+        Returns the (docID, score) pairs
+        """
+        return zip(self.doc_ids.tolist(), self.values.tolist())
+
+
+def query_prep(query, index, global_idf=None):
     """
     Prepares the query for the search by computing tf-idf and query norm
     :param query: tokenized query
     :param index: index of the documents
+    :param global_idf: {term: idf} of the whole collection when the index is a shard (terms that are not
+                       in the shard still count in the query norm), None to use the idf of the index
     :return: query_tf_idf, query_norm
     """
     query_tf_idf = defaultdict(int)
     for word in set(query):
         tf = query.count(word)
         tf = 1 + np.log10(tf)
-        if word in index.keys():
+        if global_idf is not None:
+            query_tf_idf[word] = tf * global_idf.get(word, 0)
+        elif word in index.keys():
             query_tf_idf[word] = tf * index[word]["idf"]
         else:
             query_tf_idf[word] = 0
@@ -84,57 +144,292 @@ def query_prep(query, index):
     return query_tf_idf, query_norm
 
 
-def calculate_scores(query, query_norm, index, field):
+def _global_idf(index, field):
+    """
+    Returns the idf of the whole collection when the index is a shard
+    :param index: index of the documents
+    :param field: searched field
+    :return: {term: idf}, None if the index is not a shard
+    """
+    global_idf = getattr(index, "global_idf", None)
+    return None if global_idf is None else global_idf[field]
+
+
+def _divide_by_norms(values, norms):
     """
-    Calculates the scores for the documents based on the query
+    Divides the weights by the document norms, a document with zero norm has only terms with zero idf
+    (or the idf changed since its norm was computed) and gets 0
+    :param values: weights of the documents
+    :param norms: norms of the documents
+    :return: divided weights
+    """
+    return np.divide(values, norms, out=np.zeros(len(values)), where=norms > 0)
+
+
+def calculate_scores(query, query_norm, index, field, stats=None):
+    """
+    Calculates the scores for the documents based on the query (term at a time)
+    The weighted postings of every term are added into a dense accumulator indexed by document id.
     :param query:  tf-idf of the query
     :param query_norm: norm of the query
     :param index:  index of the documents
     :param field: field to search in
-    :return:  scores of the documents
+    :param stats: QueryStats counting the read postings, None to not count them
+    :return:  Scores of the documents
     """
-    scores = defaultdict(float)
+    accumulator = np.zeros(len(index.doc_table), dtype=np.float64)
+    seen = np.zeros(len(index.doc_table), dtype=bool)
+    found = []
     for word in query:
         if word in index.index[field]:
-            for docID in index.index[field][word]["docIDs"]:
-                if docID not in scores:
-                    scores[docID] = 0
-                scores[docID] += query[word] * index.index[field][word]["docIDs"][docID]["tf-idf"]
-    for docID in scores:
-        scores[docID] /= (query_norm * index.document_norms[field][docID])  # cosine similarity
-    return scores
+            doc_ids, weights = postings_arrays(index.index[field][word]["docIDs"])
+            accumulator[doc_ids] += query[word] * weights  # document ids of a term are unique
+            if stats is not None:
+                stats.postings += len(doc_ids)
+            # the order in which the documents were found decides the ranking of equal scores
+            new = doc_ids[~seen[doc_ids]]
+            seen[new] = True
+            found.append(new)
+    doc_ids = np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+    scores = _divide_by_norms(accumulator[doc_ids], query_norm * index.document_norms[field][doc_ids])  # cosine
+    return Scores(doc_ids, scores)
 
 
 def calculate_k_best_scores(scores, k):
     """
     Calculates the k best scores of the documents
-    :param scores: scores of the documents
+    :param scores: scores of the documents - Scores or dictionary {docID: score}
     :param k: number of best scores to return
     :return: k best scores
     """
     if k > len(scores):
         k = len(scores)
-    return sorted(scores.items(), key=lambda x: x[1], reverse=True)[:k]
+    if k <= 0:
+        return []
+    if isinstance(scores, Scores):
+        values = scores.values
+        if k < len(values):
+            # partial selection - the k-th best score, all better scores and the first found of the equal ones
+            threshold = np.partition(values, len(values) - k)[len(values) - k]
+            better = np.flatnonzero(values > threshold)
+            equal = np.flatnonzero(values == threshold)[:k - len(better)]
+            candidates = np.sort(np.concatenate((better, equal)))
+        else:
+            candidates = np.arange(len(values))
+        # stable sort keeps the documents with equal scores in the order they were found
+        best = candidates[np.argsort(-values[candidates], kind="stable")]
+        return list(zip(scores.doc_ids[best].tolist(), values[best].tolist()))
+    # same order as sorted(..., reverse=True)[:k], equal scores stay in the order of the dictionary
+    return heapq.nlargest(k, scores.items(), key=lambda x: x[1])
 
 
-def create_snippet(content, positions, prox_search=False):
+def _find_docs(doc_ids, is_sorted, docs, size):
+    """
+    Finds the documents in the postings of a term
+    :param doc_ids: document ids of the postings
+    :param is_sorted: whether the document ids are sorted
+    :param docs: documents to find
+    :param size: number of document ids of the index
+    :return: position of every document in the postings, -1 if the term is not in the document
     """
-    Creates a snippet from the content based on the positions
+    if is_sorted:
+        positions = np.searchsorted(doc_ids, docs.astype(doc_ids.dtype))  # same type - the postings are not copied
+        positions[positions == len(doc_ids)] = 0
+        return np.where(doc_ids[positions] == docs, positions, -1) if len(doc_ids) else np.full(len(docs), -1)
+    lookup = np.full(size, -1, dtype=np.int64)
+    lookup[doc_ids] = np.arange(len(doc_ids))
+    return lookup[docs]
+
+
+def calculate_scores_all_fields(queries, index, field_weights, stats=None):
+    """
+    Calculates the scores of the documents in all fields at once - the score of a document is the weighted sum
+    of its cosine similarities in the fields, all documents containing a query term in any field are scored
+    :param queries: {field: (tf-idf of the query, norm of the query)}
+    :param index: index of the documents
+    :param field_weights: {field: weight}
+    :param stats: QueryStats counting the read postings, None to not count them
+    :return: Scores of the documents, in the order they were found (fields in the order of queries)
+    """
+    combined = np.zeros(len(index.doc_table), dtype=np.float64)
+    seen = np.zeros(len(index.doc_table), dtype=bool)
+    found = []
+    for field, (query, query_norm) in queries.items():
+        scores = calculate_scores(query, query_norm, index, field, stats)
+        if query_norm > 0:  # no query term of the field has a weight
+            combined[scores.doc_ids] += field_weights[field] * scores.values
+        new = scores.doc_ids[~seen[scores.doc_ids]]
+        seen[new] = True
+        found.append(new)
+    doc_ids = np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+    return Scores(doc_ids, combined[doc_ids])
+
+
+def calculate_k_best_scores_pruned(queries, index, k, field_weights=None, stats=None):
+    """
+    Calculates the k best scores with MaxScore dynamic pruning - the result is the same as
+    calculate_k_best_scores(calculate_scores(...), k) for one field and calculate_k_best_scores(
+    calculate_scores_all_fields(...), k) for more fields, but documents that can't get into the top k are skipped
+    Every term has an upper bound of its contribution to the score (from its impact bound in the index).
+    Terms are processed from the highest bound. Once the bounds of the remaining terms add up to less than
+    the k-th best partial score, no new document can get into the top k - the remaining terms are only looked up
+    for the current candidates and the candidates that can't reach the k-th best score are dropped.
+    :param queries: {field: (tf-idf of the query, norm of the query)}
+    :param index: index of the documents
+    :param k: number of best scores to return
+    :param field_weights: {field: weight} of the fields, 1 for every field if None
+    :param stats: QueryStats counting the read postings and the scored documents, None to not count them
+    :return: k best scores, mask of the documents containing any query term (indexed by docID)
+    """
+    size = len(index.doc_table)
+    norms = [index.document_norms[field] for field in queries]
+    # a posting adds field weight * query weight * tf-idf / (query norm * document norm) to the score
+    scales = [(1.0 if field_weights is None else field_weights[field]) / query_norm if query_norm > 0 else 0.0
+              for field, (query, query_norm) in queries.items()]
+    terms = []  # terms of all fields: field number, query weight, postings arrays, bound of the contribution
+    for f, (field, (query, query_norm)) in enumerate(queries.items()):
+        for word in query:
+            if word in index.index[field]:
+                entry = index.index[field][word]
+                doc_ids, weights = postings_arrays(entry["docIDs"])
+                # a term with zero weight adds nothing (its stored bound can be inf in files of older versions)
+                bound = scales[f] * query[word] * entry["idf"] * index.max_impact(field, word) \
+                    if scales[f] and query[word] else 0.0
+                terms.append((f, query[word], doc_ids, weights, isinstance(entry["docIDs"], ArrayPostings), bound))
+    by_bound = sorted(terms, key=lambda term: -term[5])
+
+    def cumulative_bounds(ordered_terms):
+        # bounds of the first 1, 2, ... terms - the sum of their bounds per field and, when the norms are computed
+        # from the same weights, the norm of their query weights / query norm (Cauchy-Schwarz - the cosine
+        # similarity of the terms can't be higher)
+        bound_sums = [0.0] * len(queries)
+        squares = [0.0] * len(queries)
+        field_bounds = [0.0] * len(queries)
+        bounds = []
+        for f, query_weight, _, _, _, bound in ordered_terms:
+            bound_sums[f] += bound
+            squares[f] += query_weight ** 2
+            field_bounds[f] = bound_sums[f]
+            if index.exact_norms:
+                field_bounds[f] = min(bound_sums[f], scales[f] * squares[f] ** 0.5)
+            bounds.append(sum(field_bounds) * (1 + 1e-9))  # covers the rounding of the scores
+        return bounds
+
+    scored = cumulative_bounds(by_bound)  # bound of the terms scored already (after every term)
+    remaining = cumulative_bounds(reversed(by_bound))[-2::-1] + [0.0]  # bound of the terms not scored yet
+
+    accumulator = np.zeros(size, dtype=np.float64)
+    matched = np.zeros(size, dtype=bool)
+    found = []  # documents found by the terms scored in full
+    candidates = None
+    best = None  # the k best candidates, kept once the scored terms can outweigh the remaining ones
+    in_best = np.zeros(size, dtype=bool)
+    # partial scores are summed in a different order than the exact ones - the threshold is lowered a little
+    threshold = -np.inf
+    pruning = False
+    postings_read = 0
+    for (f, query_weight, doc_ids, weights, is_sorted, _), rest, done in zip(by_bound, remaining, scored):
+        weight = scales[f] * query_weight
+        if pruning:  # only the candidates are looked up
+            positions = _find_docs(doc_ids, is_sorted, candidates, size)
+            hits = candidates[positions >= 0]
+            postings_read += len(hits)
+            if weight:
+                accumulator[hits] += _divide_by_norms(weight * weights[positions[positions >= 0]], norms[f][hits])
+            matched[doc_ids] = True
+            partial = accumulator[candidates]
+            kth = np.partition(partial, len(partial) - k)[len(partial) - k]
+            threshold = max(threshold, kth - abs(kth) * 1e-9)
+            candidates = candidates[partial + rest >= threshold]
+            continue
+        # every document of the term is scored
+        found.append(doc_ids[~matched[doc_ids]])
+        postings_read += len(doc_ids)
+        if weight:
+            accumulator[doc_ids] += _divide_by_norms(weight * weights, norms[f][doc_ids])
+        matched[doc_ids] = True
+        if rest >= done:
+            continue  # no partial score can get over the bound of the remaining terms yet
+        # partial scores only grow - the k best are among the previous k best and the documents of the term
+        if best is None:
+            pool = np.concatenate(found)
+        else:
+            pool = np.concatenate((best, doc_ids[~in_best[doc_ids]]))
+            in_best[best] = False
+        if len(pool) > k:
+            partial = accumulator[pool]
+            top = np.argpartition(partial, len(partial) - k)[len(partial) - k:]
+            pool, kth = pool[top], partial[top].min()
+            threshold = kth - abs(kth) * 1e-9
+        best = pool
+        in_best[best] = True
+        if rest < threshold:
+            # documents that were not found yet can get at most the bounds of the remaining terms
+            pruning = True
+            candidates = np.concatenate(found)
+            candidates = candidates[accumulator[candidates] + rest >= threshold]
+
+    if not pruning:
+        candidates = np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+    if len(candidates) > k:
+        approximate = accumulator[candidates]
+        kth = np.partition(approximate, len(approximate) - k)[len(approximate) - k]
+        candidates = candidates[approximate >= kth - abs(kth) * 1e-9]
+
+    # scores of the best candidates are computed again in the order of the fields and query terms
+    # (like calculate_scores), so they are exactly the same and equal scores are ordered by the term
+    # and the posting they were found first in
+    scores = np.zeros(len(candidates), dtype=np.float64)
+    first_term = np.full(len(candidates), len(terms), dtype=np.int64)
+    first_pos = np.zeros(len(candidates), dtype=np.int64)
+    for f, (field, (query, query_norm)) in enumerate(queries.items()):
+        field_scores = np.zeros(len(candidates), dtype=np.float64)
+        in_field = np.zeros(len(candidates), dtype=bool)
+        for i, (term_field, query_weight, doc_ids, weights, is_sorted, _) in enumerate(terms):
+            if term_field != f:
+                continue
+            positions = _find_docs(doc_ids, is_sorted, candidates, size)
+            hit = positions >= 0
+            field_scores[hit] += query_weight * weights[positions[hit]]
+            postings_read += int(hit.sum())
+            in_field |= hit
+            first = hit & (first_term == len(terms))
+            first_term[first] = i
+            first_pos[first] = positions[first]
+        if query_norm > 0:  # documents without the field have no norm in it
+            field_weight = 1.0 if field_weights is None else field_weights[field]
+            scores[in_field] += field_weight * _divide_by_norms(field_scores[in_field],
+                                                                query_norm * norms[f][candidates[in_field]])
+    best = np.lexsort((first_pos, first_term, -scores))[:k]
+    if stats is not None:
+        stats.postings += postings_read
+        stats.scored += sum(len(doc_ids) for doc_ids in found)
+    return list(zip(candidates[best].tolist(), scores[best].tolist())), matched
+
+
+def create_snippet(content, positions, prox_search=False, offsets=None):
+    """
+    Creates a snippet from the content based on the positions - a slice of the content around the window
+    with the most query words
     :param content: content of the document
     :param positions: positions of the words in the snippet
     :param prox_search: whether the search is proximity search
+    :param offsets: offsets of the content tokens stored in the document ("content_offsets"), computed if None
     :return: snippet
     """
-    content_tokens = preprocessing_pipelines.pipeline_tokenizer(content, snippet=True)[1]
+    if offsets is None:  # documents indexed before the offsets were stored
+        starts, ends = preprocessing_pipelines.token_offsets(content)
+    else:
+        starts, ends = decode_offsets(offsets)
 
     # For proximity search, window is given by the first and last word
     if prox_search:
         best_window = [positions[0], positions[-1]]
+        highlighted = set(positions)
     else:
-        positions = np.array([item for sublist in positions for item in sublist])
-        positions.sort()
+        positions = sorted(item for sublist in positions for item in sublist)
         if len(positions) == 0:
-            return " ".join(content_tokens[:min(len(content_tokens), 2 * WINDOW_SIZE)])
+            return slice_snippet(content, starts, ends, 0, min(len(starts), 2 * WINDOW_SIZE), set())
         start = end = max_count = 0
         best_window = None
 
@@ -147,18 +442,81 @@ def create_snippet(content, positions, prox_search=False):
                     max_count = end - start + 1
                     best_window = (positions[start], positions[end])
                 end += 1
+        highlighted = set(positions)
 
-    snippet = ""
-    for i in range(max(0, best_window[0] - WINDOW_SIZE),
-                   min(len(content_tokens), best_window[1] + WINDOW_SIZE)):  # highlight the words
-        if i in positions:
-            content_tokens[i] = f'<span style="background-color:#4B77BE;">{content_tokens[i]}</span>'
-        snippet += content_tokens[i] + " "
+    last = min(len(starts), best_window[1] + WINDOW_SIZE)
+    first = min(max(0, best_window[0] - WINDOW_SIZE), last)
+    return "... " + slice_snippet(content, starts, ends, first, last, highlighted) + " ..."
 
-    return "... " + snippet + " ..."
 
+class SnippetLoader:
+    """
+    Creates the snippet of a document when the search result is shown first
+
+    The loader can be sent to another process without the index (search_many binds the index of the receiving
+    process again).
 
-def boolean_search(query, field, k, index, verbose=False):
+    Attributes:
+    index: index of the documents
+    doc_id: id of the document
+    words: query words highlighted in the snippet
+    match: positions of the words found by the proximity search (instead of words)
+    stats: QueryStats of the search counting the created snippets, None to not count them
+    """
+
+    def __init__(self, index, doc_id, words=None, match=None, stats=None):
+        """
+        Initializes the loader
+        :param index: index of the documents
+        :param doc_id: id of the document
+        :param words: query words highlighted in the snippet
+        :param match: positions of the words found by the proximity search (instead of words)
+        :param stats: QueryStats of the search counting the created snippets, None to not count them
+        """
+        self.index = index
+        self.doc_id = doc_id
+        self.words = words
+        self.match = match
+        self.stats = stats
+
+    def __getstate__(self):
+        """
+        Returns the state for pickling - the index is left out
+        :return: state of the loader
+        """
+        state = dict(self.__dict__)
+        state["index"] = None
+        return state
+
+    def __call__(self):
+        """
+        Creates the snippet
+        :return: snippet of the document
+        """
+        if self.stats is None:
+            return self._create()
+        self.stats.snippets += 1
+        with self.stats.stage("create_snippet"):
+            return self._create()
+
+    def _create(self):
+        """
+        Creates the snippet, see __call__
+        :return: snippet of the document
+        """
+        index, docID = self.index, self.doc_id
+        doc = index.docs["docs"][docID]
+        if self.match is not None:
+            return create_snippet(doc["content"], self.match, prox_search=True, offsets=doc.get("content_offsets"))
+        positions = []
+        for word in self.words:
+            if word in index.index["content"]:
+                if docID in index.index["content"][word]["docIDs"]:
+                    positions.append(index.index["content"][word]["docIDs"][docID]["pos"])
+        return create_snippet(doc["content"], positions, offsets=doc.get("content_offsets"))
+
+
+def boolean_search(query, field, k, index, verbose=False, stats=None):
     """
     Searches for the query in the index using the boolean model
     :param query: query to search for
@@ -166,152 +524,364 @@ def boolean_search(query, field, k, index, verbose=False):
     :param k: number of best documents to return
     :param index: index of the documents
     :param verbose: whether to print the results
+    :param stats: QueryStats counting the postings of the query terms, None to not count them
     :return: result_obj, len(result) - list of the search results and the number of found documents
     """
     print("Searching for the query: {} using the boolean model".format(query))
     postfix_query = infix_to_postfix(query)
     print("Postfix query:", postfix_query)
-    stack = []
-    max_id = index.docs["max_id"]
-    unused_ids = index.docs["unused_ids"]
     words = set()
-    for token in postfix_query:
-        if token not in ["AND", "OR", "NOT"]:
-            if token == "":
-                continue
-            prep = pipeline(token)
-            if len(prep) == 0:
-                continue
-            token = prep[0]
-            words.add(token)
-            if field == "":
-                all_docIDs = set()
-                for f in fields:
-                    if token in index.index[f]:
-                        all_docIDs.update(index.index[f][token]["docIDs"].keys())
-                stack.append(list(all_docIDs))
-            else:
-                if token in index.index[field]:
-                    stack.append(list(index.index[field][token]["docIDs"].keys()))
-                else:
-                    stack.append([])
-        else:
-            if token == "AND" and len(stack) >= 2:
-                stack.append(set(stack.pop()).intersection(stack.pop()))
-            elif token == "OR" and len(stack) >= 2:
-                stack.append(set(stack.pop()).union(stack.pop()))
-            elif token == "NOT" and len(stack) >= 1:
-                all_ids = set(map(str, range(max_id + 1)))
-                dif = stack.pop()
-                all_ids.difference_update(dif)
-                all_ids.difference_update(unused_ids)
-                stack.append(all_ids)
-    if len(stack) != 1:
+    searched_fields = fields if field == "" else [field]
+
+    def term_postings(token):
+        # postings of the token in all searched fields, None for tokens removed by the preprocessing
+        if token == "":
+            return None
+        prep = pipeline(token)
+        if len(prep) == 0:
+            return None
+        words.add(prep[0])
+        postings = [index.index[f][prep[0]]["docIDs"] for f in searched_fields if prep[0] in index.index[f]]
+        if stats is not None:
+            stats.postings += sum(len(p) for p in postings)
+        return postings
+
+    root = boolean_query.parse_postfix(postfix_query, term_postings)
+    if root is None:
         print("Error in the query")
         return [], 0
-    result = stack.pop()
+    result = boolean_query.evaluate(root, index.doc_table.live_ids).tolist()
     result_obj = []
     print("Found", len(result), "documents:")
     for docID in list(result)[:k]:
-        positions = []
-        for word in words:
-            if word in index.index["content"]:
-                if docID in index.index["content"][word]["docIDs"]:
-                    positions.append(index.index["content"][word]["docIDs"][docID]["pos"])
         if verbose:
             print("Top", k, "documents:")
             print("Document", docID)
-            print("Title:", index.docs["docs"][str(docID)]["title"])
+            print("Title:", index.doc_table.title(docID))
             print("\n")
-        if "lang_all" in index.docs["docs"][str(docID)]:
-            snippet = create_snippet(index.docs["docs"][str(docID)]["content"], positions)
-            result_obj.append(SearchResult(docID, 0, index.docs["docs"][str(docID)]["title"],
-                                           snippet,
-                                           index.docs["docs"][str(docID)]["lang_all"]))
+        lang = index.doc_table.lang(docID)
+        if lang is not None:
+            snippet = SnippetLoader(index, docID, words=words, stats=stats)
+            result_obj.append(SearchResult(docID, 0, index.doc_table.title(docID), snippet, lang))
         else:
-            result_obj.append(SearchResult(docID, 0, index.docs["docs"][str(docID)]["title"],
+            result_obj.append(SearchResult(docID, 0, index.doc_table.title(docID),
                                            "snippet"))
 
     return result_obj, len(result)
 
 
-def search(query, field, k, index, model, verbose=False):
+def parse_proximity(query):
+    """
+    Removes the phrase ("...") and proximity (~N) marks from the query
+    :param query: query to search for
+    :return: query without the marks, proximity (0 for no proximity search, None if N is not a number)
+    """
+    proximity = 0
+    if "~" in query:
+        proximity = query.split("~")[1]
+        if not proximity.isdigit():
+            return query.split("~")[0], None
+        proximity = int(proximity)
+        query = query.split("~")[0]
+    if "\"" in query:
+        query = query.replace("\"", "")
+        proximity = 1
+    return query, proximity
+
+
+def normalize_query(query, model):
+    """
+    Normalizes the query for the result cache - queries that are the same after the preprocessing
+    have the same results
+    :param query: query to search for
+    :param model: model to use for the search
+    :return: hashable normalized query
+    """
+    if model == "boolean":
+        query = query.replace("\"", "").split("~")[0]
+        return tuple(token if token in ["AND", "OR", "NOT"] else tuple(pipeline(token))
+                     for token in infix_to_postfix(query))
+    query, proximity = parse_proximity(query)
+    return tuple(pipeline(query)), proximity
+
+
+def search(query, field, k, index, model, verbose=False, prune=SAFE_TOP_K, stats=None, worker=None):
     """
     Searches for the query in the index and prints the k best documents
+    Results of the queries repeated without a change of the index are taken from the result cache.
+    Searches slower than SLOW_QUERY_THRESHOLD are logged to slow_query_log.
     :param query:  query to search for
     :param field:  field to search in, if empty search in all fields
     :param k: number of best documents to return
     :param index:  index of the documents
     :param model:  model to use for the search
-    :param verbose: whether to print the results
+    :param verbose: whether to print the results and the measurements of the search (the result cache is not used)
+    :param prune: skip the documents that can't get into the top k (MaxScore), the results are the same
+    :param stats: QueryStats filled with the measurements of the search - time of every stage, read postings,
+                  scored documents and created snippets (counted when the snippets are used)
+    :param worker: function searching for the query in another process - called with (query, field, k, model,
+                   prune) when the results are not cached, returns the result of search_in_worker; None to search
+                   in this process
     :return: result_obj, results_total - list of the search results and the number of found documents
     """
     print("=" * 50)
+    stats = _start_stats(stats, query, field, model, k)
+    start = time.perf_counter()
+    key = None
+    if not verbose:
+        with stats.stage("result_cache"):
+            key = _cache_key(query, field, k, index, model)
+            cached = _cached_result(key)
+        if cached is not None:
+            stats.cached = True
+            _finish_stats(stats, start)
+            return cached
+    if worker is None:
+        result_obj, results_total = _search(query, field, k, index, model, verbose, prune, stats)
+    else:
+        with stats.stage("worker"):
+            result_obj, results_total, worker_stats = worker(query, field, k, model, prune)
+        stats.stages.update(worker_stats.stages)
+        stats.postings += worker_stats.postings
+        stats.scored += worker_stats.scored
+        stats.snippets += worker_stats.snippets
+    _cache_result(key, result_obj, results_total)
+    _finish_stats(stats, start)
+    if verbose:
+        print(stats.explain())
+    return result_obj, results_total
+
+
+def search_many(queries, field, k, index, model, workers=None, chunk_size=1, prune=SAFE_TOP_K, stats=None):
+    """
+    Searches for the queries in a pool of processes sharing the loaded index
+    The workers are forked after the index is loaded, so they share its memory (copy-on-write, the sections
+    of an index loaded with load_index(mmap=True) are shared through the page cache) and nothing is copied
+    to them. Snippets are created in this process when they are used. Without fork (Windows) the queries
+    are searched in this process. Slow searches are logged to slow_query_log of this process.
+    :param queries: list of queries to search for
+    :param field: field to search in, if empty search in all fields
+    :param k: number of best documents to return for every query
+    :param index: index of the documents (must not change during the search)
+    :param model: model to use for the search
+    :param workers: number of worker processes, None for the number of CPUs, 1 searches in this process
+    :param chunk_size: number of queries sent to a worker at once
+    :param prune: skip the documents that can't get into the top k (MaxScore), the results are the same
+    :param stats: list extended with the QueryStats of every query (in the order of the queries), None to not
+                  return them
+    :return: list of (result_obj, results_total) in the order of the queries
+    """
+    global _pool_search
+    query_stats = [_start_stats(None, query, field, model, k) for query in queries]
+    keys = [_cache_key(query, field, k, index, model) for query in queries]
+    results = [_cached_result(key) for key in keys]
+    for result, query_stat in zip(results, query_stats):
+        query_stat.cached = result is not None
+    missing = [i for i, result in enumerate(results) if result is None]
+    # the shards of a ShardedIndex already search in parallel and can't be shared by forked workers
+    if (workers == 1 or len(missing) <= 1 or "fork" not in multiprocessing.get_all_start_methods()
+            or hasattr(index, "scatter_search")):
+        found = [_search_worker(queries[i], (field, k, index, model, prune), query_stats[i]) for i in missing]
+    else:
+        # the workers get the index from the forked memory, only the queries and the results are pickled
+        _pool_search = (field, k, index, model, prune)
+        try:
+            with multiprocessing.get_context("fork").Pool(workers) as pool:
+                found = pool.map(_search_worker, [queries[i] for i in missing], chunksize=chunk_size)
+        finally:
+            _pool_search = None
+        for result_obj, _, _ in found:
+            for result in result_obj:
+                if isinstance(result._snippet, SnippetLoader):
+                    result._snippet.index = index
+    for i, (result_obj, results_total, query_stat) in zip(missing, found):
+        results[i] = (result_obj, results_total)
+        query_stats[i] = query_stat
+        _cache_result(keys[i], result_obj, results_total)
+        slow_query_log.record(query_stat)
+    if stats is not None:
+        stats.extend(query_stats)
+    return results
+
+
+def search_in_worker(query, field, k, index, model, prune=SAFE_TOP_K):
+    """
+    Searches for the query in a worker process for search(..., worker=...) - the result cache and the slow query
+    log are left to the calling process and the snippets are created here, where the index is
+    :param query: query to search for
+    :param field: field to search in, if empty search in all fields
+    :param k: number of best documents to return
+    :param index: index of the documents
+    :param model: model to use for the search
+    :param prune: skip the documents that can't get into the top k (MaxScore), the results are the same
+    :return: result_obj (with the snippets), results_total, QueryStats of the search
+    """
+    result_obj, results_total, stats = _search_worker(query, (field, k, index, model, prune))
+    for result in result_obj:
+        result.snippet  # the snippet is created and kept by the result
+    return result_obj, results_total, stats
+
+
+def _search_worker(query, search_args=None, stats=None):
+    """
+    Searches for the query in a worker of search_many
+    :param query: query to search for
+    :param search_args: (field, k, index, model, prune), _pool_search if None
+    :param stats: QueryStats of the query, new if None
+    :return: result_obj, results_total, stats
+    """
+    field, k, index, model, prune = search_args or _pool_search
+    if stats is None:
+        stats = _start_stats(None, query, field, model, k)
+    start = time.perf_counter()
+    result_obj, results_total = _search(query, field, k, index, model, False, prune, stats)
+    stats.total = time.perf_counter() - start
+    return result_obj, results_total, stats
+
+
+def _start_stats(stats, query, field, model, k):
+    """
+    Prepares the measurements of a search
+    :param stats: QueryStats given by the caller, None to create new ones
+    :return: QueryStats describing the search
+    """
+    if stats is None:
+        stats = QueryStats()
+    stats.query, stats.field, stats.model, stats.k = query, field, model, k
+    return stats
+
+
+def _finish_stats(stats, start):
+    """
+    Finishes the measurements of a search and logs the search if it was slow
+    :param stats: QueryStats of the search
+    :param start: time.perf_counter() at the start of the search
+    """
+    stats.total = time.perf_counter() - start
+    slow_query_log.record(stats)
+
+
+def _cache_key(query, field, k, index, model):
+    """
+    Returns the key of the query in the result cache
+    :return: hashable key, None if the cache is disabled
+    """
+    if result_cache.max_bytes == 0:
+        return None
+    # the generation is read first - a result computed during a change is cached under the old one
+    return index.generation, normalize_query(query, model), field, model, k
+
+
+def _cached_result(key):
+    """
+    Returns the cached results of the query
+    :param key: key of the query (_cache_key)
+    :return: result_obj, results_total - copy of the cached results, None if they are not cached
+    """
+    if key is None:
+        return None
+    cached = result_cache.get(key)
+    if cached is None:
+        return None
+    print("Found", cached[1], "documents in total (cached)")
+    return list(cached[0]), cached[1]
+
+
+def _cache_result(key, result_obj, results_total):
+    """
+    Adds the results of the query to the result cache
+    :param key: key of the query (_cache_key), None if the results are not cached
+    :param result_obj: list of the search results
+    :param results_total: number of the found documents
+    """
+    if key is None:
+        return
+    # snippets are created when they are shown - their size is estimated (2 windows of tokens)
+    size = sum(sys.getsizeof(result) + sys.getsizeof(result.title) + 2 * WINDOW_SIZE * 32 for result in result_obj)
+    result_cache.put(key, (list(result_obj), results_total), size)
+
+
+def _search(query, field, k, index, model, verbose, prune, stats):
+    """
+    Searches for the query in the index, see search
+    :return: result_obj, results_total - list of the search results and the number of found documents
+    """
+    if hasattr(index, "scatter_search"):  # ShardedIndex - the shards search in their processes
+        with stats.stage("scatter_search"):
+            return index.scatter_search(query, field, k, model, prune, stats)
     if model == "boolean":
         if "\"" in query or "~" in query:
             query = query.replace("\"", "").split("~")[0]
             print("Proximity search is not supported in the boolean model")
-        return boolean_search(query, field, k, index, verbose)
-    proximity = 0
-    if "~" in query:
-        proximity = query.split("~")[1]
-        if not proximity.isdigit():
-            print("Proximity must be a number")
-            return [], 0
-        proximity = int(proximity)
-        query = query.split("~")[0]
-    if "\"" in query:
-        query = query.replace("\"", "")
-        proximity = 1
+        with stats.stage("boolean_search"):
+            return boolean_search(query, field, k, index, verbose, stats)
+    query, proximity = parse_proximity(query)
+    if proximity is None:
+        print("Proximity must be a number")
+        return [], 0
 
     query_orig = query
-    query = pipeline(query)
+    with stats.stage("pipeline"):
+        query = pipeline(query)
     result_obj = []
     if field == "":  # search in all fields
         print("Searching for the query: {} in all fields".format(query_orig))
-        score_by_field = {}
-        docs_found = set()
-        for field in fields:  # search in all fields
-            query_tf_idf, query_norm = query_prep(query, index.index[field])
-            scores = calculate_scores(query_tf_idf, query_norm, index, field)
-            docs_found.update(scores.keys())
-            k_best_scores = calculate_k_best_scores(scores, k * 2)
-            score_by_field[field] = k_best_scores
-
-        results_total = len(docs_found)
-        field_weights = {"title": 1.1, "table_of_contents": 1, "infobox": 0.5, "content": 0.5}  # weights for the fields
-        k_best_scores = {}
-        for field in score_by_field:  # combine the scores from all fields
-            for docID, score in score_by_field[field]:
-                if docID not in k_best_scores:
-                    k_best_scores[docID] = 0
-                k_best_scores[docID] += score * field_weights[field]  # add the score with the weight
-        if proximity > 0 and len(query) > 1: # proximity search
-            return proximity_search(query, index, "content", k_best_scores, proximity, k, verbose)
+        with stats.stage("query_prep"):
+            queries = {field: query_prep(query, index.index[field], _global_idf(index, field)) for field in fields}
+        if proximity > 0 and len(query) > 1:  # proximity search
+            # the proximity is checked in every document of the combined ranking, the k best are taken after
+            with stats.stage("calculate_scores"):
+                scores = calculate_scores_all_fields(queries, index, field_weights, stats)
+            stats.scored += len(scores)
+            with stats.stage("proximity_search"):
+                return proximity_search(query, index, "content", dict(scores.items()), proximity, k, verbose, stats)
+        if prune and k < len(index.doc_table):  # pruning can only skip documents when k is smaller
+            with stats.stage("calculate_k_best_scores_pruned"):
+                k_best_scores, matched = calculate_k_best_scores_pruned(queries, index, k, field_weights, stats)
+            results_total = int(matched.sum())
+        else:
+            with stats.stage("calculate_scores"):
+                scores = calculate_scores_all_fields(queries, index, field_weights, stats)
+            stats.scored += len(scores)
+            with stats.stage("calculate_k_best_scores"):
+                k_best_scores = calculate_k_best_scores(scores, k)
+            results_total = len(scores)
         print("Found", results_total, "documents in total")
         if verbose:
             print("Top", k, "documents:")
-        k_best_scores = calculate_k_best_scores(k_best_scores, k)
-        format_result(index, query, k_best_scores, result_obj, verbose)
+        with stats.stage("format_result"):
+            format_result(index, query, k_best_scores, result_obj, verbose, stats)
 
     else:  # search in the specified field
         print("Searching for the query: {} in the field {}".format(query_orig, field))
-        query_tf_idf, query_norm = query_prep(query, index.index[field])
-        scores = calculate_scores(query_tf_idf, query_norm, index, field)
-
-        if proximity > 0 and len(query) > 1:  # proximity search
-            return proximity_search(query, index, "content", scores, proximity, k, verbose)
-        k_best_scores = calculate_k_best_scores(scores, k)
-        print("Found", len(scores), "documents in total")
-        results_total = len(scores)
+        with stats.stage("query_prep"):
+            query_tf_idf, query_norm = query_prep(query, index.index[field], _global_idf(index, field))
+        if prune and k < len(index.doc_table) and query_norm > 0 and not (proximity > 0 and len(query) > 1):
+            with stats.stage("calculate_k_best_scores_pruned"):
+                k_best_scores, matched = calculate_k_best_scores_pruned({field: (query_tf_idf, query_norm)}, index, k,
+                                                                        stats=stats)
+            results_total = int(matched.sum())
+        else:
+            with stats.stage("calculate_scores"):
+                scores = calculate_scores(query_tf_idf, query_norm, index, field, stats)
+            if proximity > 0 and len(query) > 1:  # proximity search
+                with stats.stage("proximity_search"):
+                    return proximity_search(query, index, "content", dict(scores.items()), proximity, k, verbose,
+                                            stats)
+            stats.scored += len(scores)
+            with stats.stage("calculate_k_best_scores"):
+                k_best_scores = calculate_k_best_scores(scores, k)
+            results_total = len(scores)
+        print("Found", results_total, "documents in total")
         if verbose:
             print("Top", k, "documents:")
-        format_result(index, query, k_best_scores, result_obj, verbose)
+        with stats.stage("format_result"):
+            format_result(index, query, k_best_scores, result_obj, verbose, stats)
 
     return result_obj, results_total
 
 
-def format_result(index, query, k_best_scores, result_obj, verbose=True):
+def format_result(index, query, k_best_scores, result_obj, verbose=True, stats=None):
     """
     Formats the search results and prints them if verbose is True
     :param index: index of the documents
@@ -319,31 +889,27 @@ def format_result(index, query, k_best_scores, result_obj, verbose=True):
     :param k_best_scores: k best scores of the documents
     :param result_obj: list of the search results
     :param verbose: whether to print the results
+    :param stats: QueryStats of the search counting the created snippets, None to not count them
     :return: None directly, but appends the search results to the result_obj
     """
     for docID, score in k_best_scores:
         if verbose:
             print(f"Document {docID} with score {score:.3f}")
-            print("Title:", index.docs["docs"][str(docID)]["title"])
+            print("Title:", index.doc_table.title(docID))
             print("\n")
-        if "lang_all" in index.docs["docs"][str(docID)]:
-            positions = []
-            for word in query:
-                if word in index.index["content"]:
-                    if str(docID) in index.index["content"][word]["docIDs"]:
-                        positions.append(index.index["content"][word]["docIDs"][str(docID)]["pos"])
-            snippet = create_snippet(index.docs["docs"][str(docID)]["content"], positions)
-            result_obj.append(SearchResult(docID, score, index.docs["docs"][str(docID)]["title"],
-                                           snippet,
-                                           index.docs["docs"][str(docID)]["lang_all"]))
+        lang = index.doc_table.lang(docID)
+        if lang is not None:
+            snippet = SnippetLoader(index, docID, words=query, stats=stats)
+            result_obj.append(SearchResult(docID, score, index.doc_table.title(docID), snippet, lang))
         else:
-            result_obj.append(SearchResult(docID, score, index.docs["docs"][str(docID)]["title"],
+            result_obj.append(SearchResult(docID, score, index.doc_table.title(docID),
                                            "snippet"))
 
 
-def proximity_search(query, index, field, scores, proximity, k, verbose=False):
+def proximity_search(query, index, field, scores, proximity, k, verbose=False, stats=None):
     """
     Searches for the proximity query in the documents
+    The documents are ranked by the length of the shortest occurrence of the query, then by the score.
     :param query:  proximity query to search for
     :param index:  index of the documents
     :param field:  field to search in
@@ -351,64 +917,37 @@ def proximity_search(query, index, field, scores, proximity, k, verbose=False):
     :param proximity: max proximity between the words
     :param k: number of best documents to return
     :param verbose: whether to print the results
+    :param stats: QueryStats counting the read postings and the checked documents, None to not count them
     :return: result_obj, results_total - list of the search results and the number of found documents
     """
-    best_scores = defaultdict(float)
-    doc_positions = defaultdict(list)
-    for docID in scores:
-        # print("Proximity search for the query: {} in the field {} in the document {}".format(query, field, docID))
-        positions = []
-        for word in query:
-            if word not in index.index[field]: # word not found in the index
-                break
-            elif docID not in index.index[field][word]["docIDs"]: # word not found in the document
-                break
-            else:
-                positions.append(index.index[field][word]["docIDs"][docID]["pos"])
-        if len(positions) != len(query):
+    if any(word not in index.index[field] for word in query):  # word not found in the index
+        return [], 0
+    postings = [index.index[field][word]["docIDs"] for word in query]
+    # only the documents containing all the words can match
+    with_all_words = boolean_query.evaluate(("and", [("term", [p]) for p in postings]), index.doc_table.live_ids)
+    matches = []
+    checked = 0
+    for docID in with_all_words.tolist():
+        if docID not in scores:
             continue
-        def find_combinations(positions, current, i, proximity):
-            if i == len(positions):
-                if all(abs(current[j] - current[j - 1]) <= proximity for j in range(1, len(current))):
-                    return current
-                else:
-                    return []
-            else:
-                for pos in positions[i]:
-                    combination = find_combinations(positions, current + [pos], i + 1, proximity)
-                    if combination:
-                        return combination
-                return []
-
-        proximity_positions = find_combinations(positions, [], 0, proximity)
-        proximity_positions = sorted(proximity_positions)
-
-        # Post-filtering - check words consecutivness
-        if len(proximity_positions) == len(positions):
-            for p, pos in zip(proximity_positions, positions):
-                if p not in pos:
-                    proximity_positions[0] = -1
-                    break
-        else:
-            proximity_positions.append(-1)
-
-        if proximity_positions[0] != -1:
-            best_scores[docID] = scores[docID]
-            doc_positions[docID] = proximity_positions
-    results_total = len(best_scores)
-    if k > len(best_scores):
-        k = len(best_scores)
+        checked += 1
+        match = shortest_match([p[docID]["pos"] for p in postings], proximity)
+        if match is not None:
+            matches.append((match[-1] - match[0], -scores[docID], docID, match))
+    if stats is not None:
+        stats.postings += sum(len(p) for p in postings)
+        stats.scored += checked
+    results_total = len(matches)
+    matches.sort(key=lambda item: item[:3])
 
-    k_best_scores = dict(itertools.islice(best_scores.items(), k))
     result_obj = []
-    for docID in k_best_scores.keys():
-        snippet = create_snippet(index.docs["docs"][str(docID)]["content"], doc_positions[docID], prox_search=True)
+    for _, _, docID, match in matches[:k]:
+        result = SearchResult(docID, scores[docID], index.doc_table.title(docID),
+                              SnippetLoader(index, docID, match=match, stats=stats), index.doc_table.lang(docID))
         if verbose:
-            print(f"Document {docID} with score {best_scores[docID]:.3f}")
-            print("Title:", index.docs["docs"][str(docID)]["title"])
+            print(f"Document {docID} with score {scores[docID]:.3f}")
+            print("Title:", index.doc_table.title(docID))
             print("\n")
-            print(snippet)
-        result_obj.append(SearchResult(docID, best_scores[docID], index.docs["docs"][str(docID)]["title"],
-                                       snippet,
-                                       index.docs["docs"][str(docID)]["lang_all"]))
+            print(result.snippet)
+        result_obj.append(result)
     return result_obj, results_total
@@ -104,7 +104,7 @@ class ClickableLabel(QLabel):
             docID = self.title.split(" (id: ")[1].split(" -")[0].replace(")", "")
             index_name = SEARCH_CONFIG["index"]
             index = [index for index in indexes if index.index_name == index_name][0]
-            document = index.docs["docs"][docID]
+            document = index.docs["docs"][int(docID)]
             dialog = QDialog()
             dialog.setWindowTitle(self.title)
             dialog.setWindowFlags(dialog.windowFlags() & ~Qt.WindowContextHelpButtonHint)
@@ -0,0 +1,472 @@
+import argparse
+import asyncio
+import contextlib
+import functools
+import json
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+from config import indexes, SERVER_HOST, SERVER_PORT, SERVER_PROCESSES, SERVER_WORKERS, SERVER_ADMIN_TOKEN
+from searcher import fields, result_cache, search, search_in_worker, slow_query_log
+from utils.query_stats import QueryStats
+
+MAX_BODY_SIZE = 16 * 1024 * 1024  # max size of a request body in bytes
+MAX_K = 1000  # max number of results of one search
+REQUEST_TIMEOUT = 30  # seconds to wait for the next request of an idle connection
+
+_process_indexes = None  # {name: index} of a search process, shared with the server by fork
+
+
+def _init_search_process(indexes):
+    """
+    Initializes a search process forked from the server
+    :param indexes: {name: index} - the memory of the server, nothing is copied
+    """
+    global _process_indexes
+    _process_indexes = indexes
+    sys.stdout = open(os.devnull, "w")  # the output of the server could be locked by one of its threads
+
+
+def _search_process(name, query, field, k, model, prune):
+    """
+    Searches for the query in a search process, see searcher.search_in_worker
+    :param name: name of the index
+    :return: result_obj, results_total, QueryStats
+    """
+    return search_in_worker(query, field, k, _process_indexes[name], model, prune)
+
+
+class HTTPError(Exception):
+    """
+    Error returned to the client as a JSON response
+    """
+
+    def __init__(self, status, message):
+        """
+        Initializes the error
+        :param status: HTTP status of the response
+        :param message: description of the error
+        """
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class ReadWriteLock:
+    """
+    Lock of an index - searches run concurrently, a change of the index waits for the running searches and new
+    searches wait for the change (a waiting change is preferred, so changes are not starved)
+    """
+
+    def __init__(self):
+        """
+        Initializes the unlocked lock
+        """
+        self.readers = 0
+        self.writing = False
+        self.waiting_writers = 0
+        self.condition = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def read(self):
+        """
+        Holds the lock shared with other readers
+        """
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self.writing and self.waiting_writers == 0)
+            self.readers += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.readers -= 1
+                self.condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def write(self):
+        """
+        Holds the lock exclusively
+        """
+        async with self.condition:
+            self.waiting_writers += 1
+            try:
+                await self.condition.wait_for(lambda: not self.writing and self.readers == 0)
+            finally:
+                self.waiting_writers -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+
+class SearchService:
+    """
+    HTTP/JSON search service over the loaded indexes
+    Requests are handled in the event loop. Searches run in a pool of processes forked from the service, so they
+    share the memory of the loaded indexes (copy-on-write) and a slow query doesn't hold the GIL needed by the other
+    requests (query preprocessing and snippets are pure Python). The result cache and the slow query log stay in
+    the service. Changes of the indexes run in a pool of threads, which also wait for the search processes; after
+    a change the processes are forked again. Sharded indexes search in their shard processes and without fork
+    (Windows) the searches run in the threads, where only the NumPy scoring runs in parallel.
+
+    Endpoints:
+    GET  /indexes                                       - names and sizes of the indexes
+    GET  /search?q=&index=&field=&k=&model=             - search (model "tf-idf" or "boolean")
+    GET  /boolean_search?q=&index=&field=&k=            - search with the boolean model
+    GET  /admin/stats                                   - result cache counters and the slow query log
+    POST /admin/documents?index=                        - add the document in the JSON body, returns its id
+    DELETE /admin/documents/<id>?index=                 - delete the document
+
+    Attributes:
+    indexes: {name: index}
+    locks: {name: ReadWriteLock of the index}
+    executor: pool of the threads running the changes and waiting for the searches
+    processes: number of the search processes, 0 searches in the threads
+    process_pool: pool of the search processes, forked on the first search after a change
+    admin_token: token of the admin endpoints (header "Authorization: Bearer <token>"),
+                 None allows them only from localhost
+    """
+
+    def __init__(self, indexes, workers=None, admin_token=None, processes=None):
+        """
+        Initializes the service
+        :param indexes: list of the loaded indexes
+        :param workers: number of the worker threads, None for the default of ThreadPoolExecutor
+        :param admin_token: token of the admin endpoints, None allows them only from localhost
+        :param processes: number of the search processes, None for the number of CPUs, 0 searches in the threads
+        """
+        self.indexes = {index.index_name: index for index in indexes}
+        self.locks = {name: ReadWriteLock() for name in self.indexes}
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="search")
+        self.admin_token = admin_token
+        if "fork" not in multiprocessing.get_all_start_methods():
+            processes = 0
+        self.processes = os.cpu_count() if processes is None else processes
+        self.process_pool = None
+        self.process_lock = threading.Lock()
+
+    async def serve(self, host, port):
+        """
+        Serves the requests until cancelled
+        :param host: address to listen on
+        :param port: port to listen on
+        """
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print("Serving {} indexes on http://{}:{}".format(len(self.indexes), host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown(wait=False)
+            self.restart_processes()
+
+    def search_in_process(self, name, query, field, k, model, prune):
+        """
+        Searches for the query in a search process (worker of searcher.search), called from a thread
+        :param name: name of the index
+        :return: result_obj, results_total, QueryStats
+        """
+        with self.process_lock:
+            if self.process_pool is None:
+                self.process_pool = ProcessPoolExecutor(self.processes, multiprocessing.get_context("fork"),
+                                                        _init_search_process, (self.indexes,))
+                # all processes are forked by the first submit - no index may be in the middle of a change
+                # (e.g. a background merge of a SegmentedIndex)
+                with contextlib.ExitStack() as stack:
+                    for index in self.indexes.values():
+                        if hasattr(index, "lock"):
+                            stack.enter_context(index.lock)
+                    future = self.process_pool.submit(_search_process, name, query, field, k, model, prune)
+            else:
+                future = self.process_pool.submit(_search_process, name, query, field, k, model, prune)
+        return future.result()
+
+    def restart_processes(self):
+        """
+        Stops the search processes after a change of an index, new ones are forked with the changed index
+        The running searches are finished first.
+        """
+        with self.process_lock:
+            if self.process_pool is not None:
+                self.process_pool.shutdown(wait=False)
+                self.process_pool = None
+
+    async def handle_connection(self, reader, writer):
+        """
+        Handles the requests of one connection (HTTP/1.1 keep-alive)
+        :param reader: stream of the connection
+        :param writer: stream of the connection
+        """
+        client = writer.get_extra_info("peername")
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self.read_request(reader), REQUEST_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                if request is None:
+                    break
+                method, target, headers, body, keep_alive = request
+                try:
+                    status, response = await self.route(method, target, headers, body, client)
+                except HTTPError as error:
+                    status, response = error.status, {"error": error.message}
+                except Exception as error:
+                    print("Error while handling {} {}: {!r}".format(method, target, error))
+                    status, response = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "Internal server error"}
+                await self.write_response(writer, status, response, keep_alive)
+                if not keep_alive:
+                    break
+        except HTTPError as error:  # the request couldn't be read
+            with contextlib.suppress(ConnectionError):
+                await self.write_response(writer, error.status, {"error": error.message}, False)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def read_request(self, reader):
+        """
+        Reads one request
+        :param reader: stream of the connection
+        :return: method, target, headers, body, keep_alive - None if the connection was closed
+        """
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode("latin-1").split()
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Malformed request line")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length", 0) or 0)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length")
+        if length < 0:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length")
+        if length > MAX_BODY_SIZE:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Request body is too large")
+        body = await reader.readexactly(length) if length > 0 else b""
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+        return method.upper(), target, headers, body, keep_alive
+
+    @staticmethod
+    async def write_response(writer, status, response, keep_alive):
+        """
+        Writes a JSON response
+        :param writer: stream of the connection
+        :param status: HTTP status
+        :param response: JSON serializable response
+        :param keep_alive: whether the connection stays open
+        """
+        body = json.dumps(response, ensure_ascii=False).encode("utf-8")
+        status = HTTPStatus(status)
+        head = ("HTTP/1.1 {} {}\r\n"
+                "Content-Type: application/json; charset=utf-8\r\n"
+                "Content-Length: {}\r\n"
+                "Connection: {}\r\n\r\n").format(status.value, status.phrase, len(body),
+                                                 "keep-alive" if keep_alive else "close")
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def route(self, method, target, headers, body, client):
+        """
+        Calls the handler of the request
+        :param method: HTTP method
+        :param target: path with the query string
+        :param headers: {lower case name: value}
+        :param body: body of the request
+        :param client: address of the client
+        :return: HTTP status, JSON serializable response
+        """
+        url = urlsplit(target)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        path = url.path.rstrip("/") or "/"
+        if path == "/indexes" and method == "GET":
+            return HTTPStatus.OK, self.list_indexes()
+        if path in ("/search", "/boolean_search") and method in ("GET", "POST"):
+            if method == "POST" and body:
+                params.update(self.parse_json(body))
+            if path == "/boolean_search":
+                params["model"] = "boolean"
+            return HTTPStatus.OK, await self.search(params)
+        if path.startswith("/admin/"):
+            self.check_admin(headers, client)
+            if path == "/admin/stats" and method == "GET":
+                return HTTPStatus.OK, {"result_cache": result_cache.stats(),
+                                       "slow_queries": list(slow_query_log.entries)}
+            if path == "/admin/documents" and method == "POST":
+                return HTTPStatus.CREATED, await self.create_document(params, self.parse_json(body))
+            if path.startswith("/admin/documents/") and method == "DELETE":
+                return HTTPStatus.OK, await self.delete_document(params, path[len("/admin/documents/"):])
+        raise HTTPError(HTTPStatus.NOT_FOUND, "Unknown endpoint: {} {}".format(method, url.path))
+
+    def list_indexes(self):
+        """
+        Returns the names and sizes of the indexes
+        :return: list of {"name", "documents"}
+        """
+        return [{"name": name, "documents": len(index.docs["docs"])} for name, index in self.indexes.items()]
+
+    def get_index(self, params):
+        """
+        Returns the index selected by the request, the first index by default
+        :param params: parameters of the request
+        :return: name of the index, index
+        """
+        name = params.get("index") or next(iter(self.indexes), None)
+        if name not in self.indexes:
+            raise HTTPError(HTTPStatus.NOT_FOUND, "Unknown index: {}".format(name))
+        return name, self.indexes[name]
+
+    @staticmethod
+    def parse_json(body):
+        """
+        Parses the JSON body of the request
+        :param body: body of the request
+        :return: parsed JSON object
+        """
+        try:
+            parsed = json.loads(body.decode("utf-8"))
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Body is not valid JSON")
+        if not isinstance(parsed, dict):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Body must be a JSON object")
+        return parsed
+
+    def check_admin(self, headers, client):
+        """
+        Checks that the client may use the admin endpoints
+        :param headers: headers of the request
+        :param client: address of the client
+        """
+        if self.admin_token is None:
+            if client is None or client[0] not in ("127.0.0.1", "::1"):
+                raise HTTPError(HTTPStatus.FORBIDDEN, "Admin endpoints are only available from localhost")
+        elif headers.get("authorization") != "Bearer " + self.admin_token:
+            raise HTTPError(HTTPStatus.UNAUTHORIZED, "Invalid admin token")
+
+    async def search(self, params):
+        """
+        Searches for the query of the request
+        :param params: q, index, field (empty for all fields), k, model
+        :return: {"index", "query", "total", "results", "stats"}
+        """
+        query = str(params.get("q", "")).strip()
+        if not query:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Missing query parameter q")
+        name, index = self.get_index(params)
+        field = params.get("field", "")
+        if field not in fields + [""]:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Unknown field: {}".format(field))
+        model = params.get("model", "tf-idf")
+        if model not in ("tf-idf", "boolean"):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Unknown model: {}".format(model))
+        try:
+            k = int(params.get("k", 10))
+        except (TypeError, ValueError):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "k must be a number")
+        if not 0 < k <= MAX_K:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "k must be between 1 and {}".format(MAX_K))
+
+        # the shards of a ShardedIndex search in their own processes, which can't be shared by forked ones
+        worker = None
+        if self.processes and not hasattr(index, "scatter_search"):
+            worker = functools.partial(self.search_in_process, name)
+
+        def run():
+            stats = QueryStats()
+            result_obj, results_total = search(query, field, k, index, model, stats=stats, worker=worker)
+            # snippets are created here (or by the search process) - the index can't change before the lock
+            # is released
+            results = [{"doc_id": result.doc_id, "score": result.score, "title": result.title, "lang": result.lang,
+                        "snippet": result.snippet} for result in result_obj]
+            return results, results_total, stats
+
+        async with self.locks[name].read():
+            results, results_total, stats = await asyncio.get_running_loop().run_in_executor(self.executor, run)
+        return {"index": name, "query": query, "total": results_total, "results": results,
+                "stats": stats.as_dict()}
+
+    async def create_document(self, params, doc):
+        """
+        Adds the document to the index
+        :param params: index
+        :param doc: document - title, content, table_of_contents (list, optional), infobox (optional)
+        :return: {"index", "doc_id"}
+        """
+        name, index = self.get_index(params)
+        if not isinstance(doc.get("title"), str) or not isinstance(doc.get("content"), str):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Document must have a title and a content")
+        doc = {"title": doc["title"], "table_of_contents": list(doc.get("table_of_contents") or []),
+               "infobox": str(doc.get("infobox") or ""), "content": doc["content"]}
+        async with self.locks[name].write():
+            try:
+                doc_id = await asyncio.get_running_loop().run_in_executor(self.executor, index.create_document, doc)
+            except RuntimeError as error:  # read-only index
+                raise HTTPError(HTTPStatus.CONFLICT, str(error))
+            finally:
+                self.restart_processes()
+        return {"index": name, "doc_id": doc_id}
+
+    async def delete_document(self, params, doc_id):
+        """
+        Deletes the document from the index
+        :param params: index
+        :param doc_id: id of the document
+        :return: {"index", "doc_id"}
+        """
+        name, index = self.get_index(params)
+        try:
+            doc_id = int(doc_id)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Document id must be a number")
+        async with self.locks[name].write():
+            if doc_id not in index.docs["docs"]:
+                raise HTTPError(HTTPStatus.NOT_FOUND, "Unknown document: {}".format(doc_id))
+            try:
+                await asyncio.get_running_loop().run_in_executor(self.executor, index.delete_document, doc_id)
+            except RuntimeError as error:  # read-only index
+                raise HTTPError(HTTPStatus.CONFLICT, str(error))
+            finally:
+                self.restart_processes()
+        return {"index": name, "doc_id": doc_id}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP/JSON search service over the indexes from config.py")
+    parser.add_argument("--host", default=SERVER_HOST, help="address to listen on")
+    parser.add_argument("--port", type=int, default=SERVER_PORT, help="port to listen on")
+    parser.add_argument("--processes", type=int, default=SERVER_PROCESSES,
+                        help="number of the search processes, 0 searches in the threads")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS,
+                        help="number of the threads running the changes and waiting for the searches")
+    args = parser.parse_args()
+
+    service = SearchService(indexes, args.workers, SERVER_ADMIN_TOKEN, args.processes)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+import pytest
+
+import Index
+import SegmentedIndex
+
+
+class LangDetector:
+    """
+    Stand-in of the language detector - the model for all languages is not in the repository
+    """
+
+    def __init__(self, only_czech_slovak=False):
+        pass
+
+    def predict(self, sentences):
+        if not isinstance(sentences, list):
+            sentences = [sentences]
+        return ["cs" for _ in sentences]
+
+
+@pytest.fixture
+def lang_detector(monkeypatch):
+    monkeypatch.setattr(Index, "LangDetector", LangDetector)
+    monkeypatch.setattr(SegmentedIndex, "LangDetector", LangDetector)
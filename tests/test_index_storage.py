@@ -0,0 +1,105 @@
+import json
+
+import numpy as np
+import pytest
+
+import preprocessing_pipelines
+from Index import Index
+from SegmentedIndex import SegmentedIndex
+
+PIPELINE = preprocessing_pipelines.pipeline_stemmer
+DOCUMENTS = [
+    {"title": "Železná dýka", "table_of_contents": ["1 Popis", "2 Výroba"], "infobox": "Zbraň, železo",
+     "content": "Železná dýka je krátká zbraň. Dýka se vyrábí ze železa a kůže."},
+    {"title": "Ocelový meč", "table_of_contents": ["1 Popis"], "infobox": "Zbraň, ocel",
+     "content": "Ocelový meč je dlouhá zbraň s rovnou čepelí. Meč nosí císařská legie."},
+    {"title": "Císařská legie", "table_of_contents": [], "infobox": "Frakce",
+     "content": "Císařská legie je armáda císařství. Legie bojovala ve městě Solitude."},
+    {"title": "Solitude", "table_of_contents": ["1 Historie", "2 Obyvatelé"], "infobox": "Město",
+     "content": "Solitude je hlavní město provincie. Ve městě sídlí císařská legie a kovář prodává meč."},
+    {"title": "Kovář", "table_of_contents": ["1 Práce"], "infobox": "Povolání",
+     "content": "Kovář vyrábí dýka, meč i štít ze železa a oceli."},
+]
+
+
+def rounded(value):
+    return round(float(value), 9)
+
+
+def snapshot(index):
+    """
+    Postings, norms and documents of the index in plain Python values
+    """
+    postings = {field: {term: (rounded(entry["idf"]), entry["df"],
+                               {int(doc): (rounded(posting["tf"]), rounded(posting["tf-idf"]), list(posting["pos"]))
+                                for doc, posting in entry["docIDs"].items()})
+                        for term, entry in index.index[field].items()}
+                for field in index.fields}
+    norms = {field: [rounded(norm) for norm in np.trim_zeros(np.asarray(index.document_norms[field]), "b")]
+             for field in index.fields}
+    docs = {int(doc): dict(document) for doc, document in index.docs["docs"].items()}
+    return postings, norms, docs
+
+
+def forward(index):
+    return {field: {int(doc): dict(terms) for doc, terms in index.forward[field].items()} for field in index.fields}
+
+
+@pytest.fixture
+def data(tmp_path):
+    folder = tmp_path / "data"
+    folder.mkdir()
+    for number, document in enumerate(DOCUMENTS):
+        with open(folder / "doc{}.json".format(number), "w", encoding="utf-8") as file:
+            json.dump(document, file, ensure_ascii=False)
+    return str(folder)
+
+
+@pytest.fixture
+def index(tmp_path, lang_detector, data):
+    index = Index(PIPELINE, str(tmp_path / "index"), "test")
+    index.create_index_from_folder(data)
+    index.set_keywords()
+    return index
+
+
+@pytest.mark.parametrize("fmt, options, mmap", [
+    ("binary", {}, False),
+    ("binary", {}, True),
+    ("binary", {"compress": True}, False),
+    ("binary", {"compress": True}, True),
+    ("binary", {"compress_docs": True}, True),
+    ("json", {}, False),
+])
+def test_save_and_load(index, fmt, options, mmap):
+    index.save_index(fmt=fmt, **options)
+
+    loaded = Index(PIPELINE, index.index_folder, index.index_name)
+    loaded.load_index(fmt, mmap=mmap)
+
+    assert snapshot(loaded) == snapshot(index)
+    assert forward(loaded) == forward(index)
+    assert loaded.keywords == index.keywords
+    assert loaded.docs["max_id"] == index.docs["max_id"]
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_external_build(tmp_path, index, data, compress):
+    external = Index(PIPELINE, str(tmp_path / "external"), "test")
+    # the small budget flushes a run after every batch, so the runs are merged
+    external.create_index_external(data, memory_budget=1024, batch_size=2, compress=compress)
+
+    assert snapshot(external) == snapshot(index)
+    assert forward(external) == forward(index)
+
+
+@pytest.mark.parametrize("mmap", [False, True])
+def test_segmented(tmp_path, index, mmap):
+    segmented = SegmentedIndex.from_index(index)
+    segmented.save_index()
+
+    loaded = SegmentedIndex(PIPELINE, index.index_folder, index.index_name)
+    loaded.load_index(mmap=mmap)
+
+    assert snapshot(loaded) == snapshot(index)
+    assert loaded.keywords == index.keywords
@@ -0,0 +1,24 @@
+import numpy as np
+
+from utils.postings_codec import impact_bound, impact_bounds
+
+
+def test_impact_bounds_skip_documents_with_zero_norm():
+    # term 0 is in every document (idf 0), document 3 has no other term, so its norm is 0;
+    # document 4 is empty - it has no postings and no norm
+    doc_ids = np.array([0, 1, 2, 3, 1, 2])
+    tf = np.array([1.0, 2.0, 1.0, 1.0, 1.0, 3.0])
+    starts = np.array([0, 4])
+    norms = np.array([0.5, 2.0, 4.0, 0.0, 0.0])
+
+    bounds = impact_bounds(doc_ids, tf, starts, norms)
+
+    assert np.all(np.isfinite(bounds))
+    assert bounds.tolist() == [2.0, 0.75]
+    # the bound of a term with zero idf must not turn into nan in the pruned search
+    assert bounds[0] * 0.0 == 0.0
+
+
+def test_impact_bound_of_term_only_in_documents_with_zero_norm():
+    postings = {3: {"tf": 1.0, "tf-idf": 0.0, "pos": [0]}}
+    assert impact_bound(postings, np.array([0.5, 2.0, 4.0, 0.0])) == 0.0
@@ -0,0 +1,37 @@
+import json
+
+import Index
+import preprocessing_pipelines
+from utils import preprocessor
+
+WORDS = ["meč", "dýka", "štít", "luk", "kopí", "sekera", "zbroj", "helma", "šíp", "palcát", "kuše", "halapartna"]
+
+
+def write_documents(folder, count):
+    folder.mkdir()
+    for number in range(count):
+        words = [WORDS[(number + i) % len(WORDS)] for i in range(5)]
+        document = {"title": "Zbraň {}".format(number), "table_of_contents": ["1 Popis", "2 Historie"],
+                    "infobox": words[0], "content": "Dlouhé {} s rovnou čepelí a {} ze dřeva.".format(*words[1:3])}
+        with open(folder / "doc{}.json".format(number), "w", encoding="utf-8") as file:
+            json.dump(document, file, ensure_ascii=False)
+
+
+def test_parallel_build_saves_the_tokens_cached_by_the_workers(tmp_path, lang_detector, monkeypatch):
+    data = tmp_path / "data"
+    write_documents(data, 100)  # more than one chunk, so the documents are preprocessed in the pool
+
+    monkeypatch.setattr(preprocessor.token_cache, "forms", {})
+    serial = Index.Index(preprocessing_pipelines.pipeline_stemmer, str(tmp_path / "serial"), "serial")
+    serial.create_index_from_folder(str(data), workers=1)
+    serial_forms = preprocessor.token_cache.forms
+
+    monkeypatch.setattr(preprocessor.token_cache, "forms", {})
+    index = Index.Index(preprocessing_pipelines.pipeline_stemmer, str(tmp_path / "parallel"), "parallel")
+    index.create_index_from_folder(str(data), workers=2)
+    index.save_index(save_tokens=True)
+
+    with open(tmp_path / "parallel" / "parallel_tokens.json", encoding="utf-8") as file:
+        saved = json.load(file)
+    assert saved
+    assert saved == serial_forms
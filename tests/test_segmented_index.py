@@ -0,0 +1,101 @@
+import threading
+import time
+
+import pytest
+
+import preprocessing_pipelines
+import SegmentedIndex as segmented_index
+from SegmentedIndex import SegmentedIndex
+
+TIMEOUT = 10
+
+
+def document(number):
+    return {"title": "Zbraň {}".format(number), "table_of_contents": ["1 Popis"], "infobox": "Zbraň",
+            "content": "Meč číslo {} je dlouhá zbraň s rovnou čepelí.".format(number)}
+
+
+def wait_until(condition):
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def blocked_merge(monkeypatch):
+    """
+    Stops the merged segments (the only segments with more than one document here) from being built
+    until the release event is set
+    """
+    started = threading.Event()
+    release = threading.Event()
+
+    class Segment(segmented_index.Segment):
+        def __init__(self, name, index, document_norms, docs, *args, **kwargs):
+            if len(docs) > 1:
+                started.set()
+                release.wait(TIMEOUT)
+            super().__init__(name, index, document_norms, docs, *args, **kwargs)
+
+    monkeypatch.setattr(segmented_index, "Segment", Segment)
+    return started, release
+
+
+def test_explicit_merge_during_background_merge(tmp_path, lang_detector, blocked_merge):
+    started, release = blocked_merge
+    index = SegmentedIndex(preprocessing_pipelines.pipeline_stemmer, str(tmp_path), "seg",
+                           merge_factor=2, background_merge=True)
+    try:
+        ids = [index.create_document(document(number)) for number in range(2)]
+        assert started.wait(TIMEOUT)
+
+        errors = []
+
+        def explicit_merge():
+            try:
+                index.merge()
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=explicit_merge)
+        thread.start()
+        time.sleep(0.1)
+        release.set()
+        thread.join(TIMEOUT)
+
+        assert errors == []
+        wait_until(lambda: len(index.segments) == 1)
+        assert sorted(index.docs["docs"]) == ids
+        assert index.merge_thread.is_alive()
+
+        # the background thread still merges
+        ids += [index.create_document(document(number)) for number in range(2, 4)]
+        wait_until(lambda: len(index.segments) == 1)
+        assert sorted(index.docs["docs"]) == ids
+    finally:
+        release.set()
+        index.close()
+
+
+def test_background_merge_survives_failed_merge(tmp_path, lang_detector, monkeypatch):
+    failures = []
+    merge = SegmentedIndex.merge
+
+    def failing_merge(self, segments=None):
+        if not failures:
+            failures.append(segments)
+            raise RuntimeError("merge failed")
+        merge(self, segments)
+
+    monkeypatch.setattr(SegmentedIndex, "merge", failing_merge)
+    index = SegmentedIndex(preprocessing_pipelines.pipeline_stemmer, str(tmp_path), "seg",
+                           merge_factor=2, background_merge=True)
+    try:
+        index.create_document(document(0))
+        index.create_document(document(1))
+        wait_until(lambda: len(index.segments) == 1)
+        assert len(failures) == 1
+        assert index.merge_thread.is_alive()
+    finally:
+        index.close()
@@ -0,0 +1,133 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from web_crawler import Crawler
+
+ALLPAGES = {
+    "/allpages/0": (["/allpages/1"], ["/wiki/Dyka", "/wiki/Mec", "/wiki/Alias"]),
+    "/allpages/1": (["/allpages/0"], ["/wiki/Stit", "/wiki/Luk"]),
+}
+ARTICLES = {
+    "/wiki/Dyka": "Dýka",
+    "/wiki/Mec": "Meč",
+    "/wiki/Stit": "Štít",
+    "/wiki/Luk": "Luk",
+}
+ARTICLES.update({"/wiki/Topic{}".format(number): "Téma {}".format(number) for number in range(12)})
+REDIRECTS = {"/wiki/Alias": "/wiki/Mec#Historie"}
+DELAY = 0.05  # seconds the server takes to answer, so the requests of the crawler overlap
+
+
+def allpages_page(nav, body):
+    links = lambda hrefs: "".join('<a href="{}">odkaz</a>'.format(href) for href in hrefs)
+    return ('<html><head><meta charset="utf-8"></head><body><div class="mw-allpages-nav">{}</div>'
+            '<div class="mw-allpages-body">{}</div></body></html>').format(links(nav), links(body))
+
+
+def article_page(title):
+    return ('<html><head><meta charset="utf-8"></head><body><span class="mw-page-title-main">{0}</span>'
+            '<div class="mw-parser-output"><table class="infobox"><tr><td>Zbraň {0}</td></tr></table>'
+            '<div class="toc">1 Popis\n2 Historie</div><p>{0} je zbraň.</p>\nZdroje\n<p>odkazy</p></div>'
+            '</body></html>').format(title)
+
+
+class WikiHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in of the wiki - serves the allpages and article fixtures and records the requests
+    """
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+    requests = []  # (time, path)
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.requests.append((time.monotonic(), self.path))
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        try:
+            time.sleep(DELAY)
+            self.respond()
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+    def respond(self):
+        if self.path in REDIRECTS:
+            self.send_response(301)
+            self.send_header("Location", REDIRECTS[self.path])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path in ALLPAGES:
+            page = allpages_page(*ALLPAGES[self.path])
+        elif self.path in ARTICLES:
+            page = article_page(ARTICLES[self.path])
+        else:
+            self.send_error(404)
+            return
+        data = page.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def wiki():
+    WikiHandler.requests = []
+    WikiHandler.in_flight = WikiHandler.max_in_flight = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), WikiHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}".format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+def test_crawl_and_scrape(wiki, tmp_path):
+    crawler = Crawler(wiki, concurrency=4, rate=None, parse_workers=2)
+
+    topics_refs = crawler.crawl(wiki + "/allpages/0")
+    assert topics_refs == ["/wiki/Dyka", "/wiki/Mec", "/wiki/Alias", "/wiki/Stit", "/wiki/Luk"]
+
+    assert crawler.scrape(topics_refs, str(tmp_path)) is None
+    # the alias redirects to an article that is scraped already
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["Dýka.json", "Luk.json", "Meč.json", "Štít.json"]
+    with open(tmp_path / "Dýka.json", encoding="utf-8") as file:
+        assert json.load(file) == {"title": "Dýka", "table_of_contents": ["1 Popis", "2 Historie"],
+                                   "infobox": "Zbraň Dýka", "content": "Dýka je zbraň."}
+
+    documents = crawler.scrape(["/wiki/Stit", "/wiki/Dyka", "/wiki/Missing", "/wiki/Luk"])
+    assert [document["title"] for document in documents] == ["Štít", "Dýka", "Luk"]
+
+
+def test_requests_in_flight_are_limited(wiki):
+    crawler = Crawler(wiki, concurrency=3, rate=None, parse_workers=0)
+
+    documents = crawler.scrape(["/wiki/Topic{}".format(number) for number in range(12)])
+
+    assert len(documents) == 12
+    assert 1 < WikiHandler.max_in_flight <= 3
+
+
+def test_token_bucket_spaces_requests_to_one_host(wiki):
+    rate = 10
+    crawler = Crawler(wiki, concurrency=4, rate=rate, burst=1, parse_workers=0)
+
+    crawler.scrape(["/wiki/Topic{}".format(number) for number in range(6)])
+
+    times = sorted(request_time for request_time, _ in WikiHandler.requests)
+    assert len(times) == 6
+    # the first request takes the full bucket, every next one waits for a new token
+    assert times[-1] - times[0] >= (len(times) - 1) / rate * 0.9
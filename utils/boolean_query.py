@@ -0,0 +1,254 @@
+from collections.abc import Mapping
+
+import numpy as np
+
+from utils.postings_codec import ArrayPostings, CompressedPostings, postings_arrays
+
+# A query is a tree of nodes:
+#   ("term", [postings, ...]) - documents in any of the postings (one per searched field)
+#   ("and", [node, ...]), ("or", [node, ...]), ("not", node)
+# Results are sorted arrays of document ids. A conjunction is evaluated from its most selective operand, the other
+# operands are only looked up for the documents found so far, so the cost follows the rarest term. NOT is never
+# evaluated over all documents - a negated result is kept as the set of excluded documents (AND NOT becomes
+# a difference) and only a query that is negated as a whole is subtracted from the live documents at the end.
+
+
+def parse_postfix(postfix, term_postings):
+    """
+    Builds the query tree from the query in postfix notation
+    Operators without enough operands are skipped.
+    :param postfix: tokens of the query in postfix notation (infix_to_postfix)
+    :param term_postings: function returning the list of postings of a term token, None to skip the token
+    :return: root node, None if the query is not valid
+    """
+    stack = []
+    for token in postfix:
+        if token in ("AND", "OR"):
+            if len(stack) >= 2:
+                right, left = stack.pop(), stack.pop()
+                operator = token.lower()
+                # nested operators of the same kind are merged, so all operands can be ordered together
+                operands = [operand for node in (left, right)
+                            for operand in (node[1] if node[0] == operator else [node])]
+                stack.append((operator, operands))
+        elif token == "NOT":
+            if len(stack) >= 1:
+                stack.append(("not", stack.pop()))
+        else:
+            postings = term_postings(token)
+            if postings is not None:
+                stack.append(("term", postings))
+    if len(stack) != 1:
+        return None
+    return stack[0]
+
+
+def evaluate(node, live_ids):
+    """
+    Evaluates the query
+    :param node: root node of the query
+    :param live_ids: function returning the sorted ids of the live documents, used only for a negated query
+    :return: sorted array of the matching document ids
+    """
+    doc_ids, negated = _evaluate(node)
+    if negated:
+        return difference(live_ids(), doc_ids)
+    return doc_ids
+
+
+def posting_doc_ids(postings):
+    """
+    Returns the document ids of the postings of a term
+    :param postings: postings of the term
+    :return: sorted int array
+    """
+    if isinstance(postings, ArrayPostings):
+        return postings.doc_ids.astype(np.int64)
+    if isinstance(postings, CompressedPostings):
+        return np.concatenate([np.empty(0, dtype=np.int64)] +
+                              [postings.block_doc_ids(block) for block in range(len(postings.block_last))]
+                              ).astype(np.int64)
+    return np.sort(postings_arrays(postings, idf=1.0)[0]).astype(np.int64)
+
+
+def intersect(a, b):
+    """
+    Intersects two sorted arrays by binary search of the shorter one in the longer one
+    :param a: sorted int array
+    :param b: sorted int array
+    :return: sorted int array
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    return a[_in_sorted(b, a)]
+
+
+def union(a, b):
+    """
+    Merges two sorted arrays
+    :param a: sorted int array
+    :param b: sorted int array
+    :return: sorted int array without duplicates
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    b = difference(b, a)
+    return np.insert(a, np.searchsorted(a, b), b)
+
+
+def difference(a, b):
+    """
+    Returns the documents of a that are not in b
+    :param a: sorted int array
+    :param b: sorted int array
+    :return: sorted int array
+    """
+    return a[~_in_sorted(b, a)]
+
+
+def _in_sorted(sorted_ids, doc_ids):
+    """
+    Finds out which documents are in a sorted array
+    :param sorted_ids: sorted int array
+    :param doc_ids: int array
+    :return: bool mask of doc_ids
+    """
+    if len(sorted_ids) == 0:
+        return np.zeros(len(doc_ids), dtype=bool)
+    doc_ids = doc_ids.astype(sorted_ids.dtype, copy=False)
+    positions = np.minimum(np.searchsorted(sorted_ids, doc_ids), len(sorted_ids) - 1)
+    return sorted_ids[positions] == doc_ids
+
+
+def _contains(postings, doc_ids):
+    """
+    Finds out which documents are in the postings of a term without decoding all of them
+    :param postings: postings of the term
+    :param doc_ids: sorted int array
+    :return: bool mask of doc_ids
+    """
+    if len(doc_ids) == 0:
+        return np.zeros(0, dtype=bool)
+    if isinstance(postings, ArrayPostings):
+        return _in_sorted(postings.doc_ids, doc_ids)
+    if isinstance(postings, CompressedPostings):
+        # the last document of every block works as a skip pointer - only the blocks that can contain
+        # the documents are decoded
+        mask = np.zeros(len(doc_ids), dtype=bool)
+        blocks = np.searchsorted(postings.block_last, doc_ids)
+        starts = np.flatnonzero(np.diff(blocks, prepend=-1))
+        ends = np.append(starts[1:], len(doc_ids))
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            block = int(blocks[start])
+            if block < len(postings.block_last):
+                mask[start:end] = _in_sorted(postings.block_doc_ids(block), doc_ids[start:end])
+        return mask
+    if isinstance(postings, Mapping) and len(doc_ids) < len(postings):
+        return np.fromiter((doc_id in postings for doc_id in doc_ids.tolist()), dtype=bool, count=len(doc_ids))
+    return _in_sorted(posting_doc_ids(postings), doc_ids)
+
+
+def _estimate(node):
+    """
+    Estimates the number of documents of a node that is not negated
+    :param node: query node
+    :return: upper bound of the number of documents
+    """
+    kind, operand = node
+    if kind == "term":
+        return sum(len(postings) for postings in operand)
+    if kind == "not":  # the complement of a negated node - its size is not known without evaluating it
+        return float("inf")
+    if kind == "and":
+        return min(_estimate(child) for child in operand if not _is_negated(child))
+    return sum(_estimate(child) for child in operand)
+
+
+def _is_negated(node):
+    """
+    Finds out whether a node is evaluated as the set of excluded documents
+    :param node: query node
+    :return: True if the node matches all documents except the evaluated ones
+    """
+    kind, operand = node
+    if kind == "term":
+        return False
+    if kind == "not":
+        return not _is_negated(operand)
+    if kind == "and":
+        return all(_is_negated(child) for child in operand)
+    return any(_is_negated(child) for child in operand)
+
+
+def _evaluate(node):
+    """
+    Evaluates a node
+    :param node: query node
+    :return: sorted int array, whether the node matches the documents not in the array instead
+    """
+    kind, operand = node
+    if kind == "term":
+        doc_ids = np.empty(0, dtype=np.int64)
+        for postings in operand:
+            doc_ids = union(doc_ids, posting_doc_ids(postings))
+        return doc_ids, False
+    if kind == "not":
+        doc_ids, negated = _evaluate(operand)
+        return doc_ids, not negated
+    if kind == "and":
+        positive = [child for child in operand if not _is_negated(child)]
+        if not positive:  # NOT a AND NOT b = NOT (a OR b)
+            doc_ids = np.empty(0, dtype=np.int64)
+            for child in operand:
+                doc_ids = union(doc_ids, _evaluate(child)[0])
+            return doc_ids, True
+        driver = min(positive, key=_estimate)
+        doc_ids = _evaluate(driver)[0]
+        rest = sorted((child for child in operand if child is not driver),
+                      key=lambda child: (_is_negated(child), _estimate(child) if not _is_negated(child) else 0))
+        for child in rest:
+            if len(doc_ids) == 0:
+                break
+            doc_ids = doc_ids[_matches(child, doc_ids)]
+        return doc_ids, False
+    # or
+    doc_ids, excluded = np.empty(0, dtype=np.int64), None
+    for child in operand:
+        child_ids, negated = _evaluate(child)
+        if negated:  # NOT a OR NOT b = NOT (a AND b)
+            excluded = child_ids if excluded is None else intersect(excluded, child_ids)
+        else:
+            doc_ids = union(doc_ids, child_ids)
+    if excluded is not None:  # a OR NOT b = NOT (b AND NOT a)
+        return difference(excluded, doc_ids), True
+    return doc_ids, False
+
+
+def _matches(node, doc_ids):
+    """
+    Finds out which of the documents match a node, the terms are only looked up for the given documents
+    :param node: query node
+    :param doc_ids: sorted int array
+    :return: bool mask of doc_ids
+    """
+    kind, operand = node
+    if kind == "term":
+        mask = np.zeros(len(doc_ids), dtype=bool)
+        for postings in operand:
+            rest = np.flatnonzero(~mask)
+            mask[rest] = _contains(postings, doc_ids[rest])
+        return mask
+    if kind == "not":
+        return ~_matches(operand, doc_ids)
+    if kind == "and":
+        selected = np.arange(len(doc_ids))
+        for child in operand:
+            selected = selected[_matches(child, doc_ids[selected])]
+        mask = np.zeros(len(doc_ids), dtype=bool)
+        mask[selected] = True
+        return mask
+    mask = np.zeros(len(doc_ids), dtype=bool)
+    for child in operand:
+        rest = np.flatnonzero(~mask)
+        mask[rest] = _matches(child, doc_ids[rest])
+    return mask
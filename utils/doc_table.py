@@ -0,0 +1,120 @@
+import numpy as np
+
+
+class DocTable:
+    """
+    Per-document data kept in NumPy arrays indexed by the internal (dense integer) document id
+
+    Document ids are integers 0..max_id everywhere inside the index. External ids (strings typed in the GUI,
+    ids in the evaluation data) are converted at the edge with int() or kept in the document itself.
+
+    Attributes:
+    live: True for the documents in the index (not deleted, not unused)
+    norms: {field: document norms} - 0 for the documents without the field
+    lang_all, lang_cz_sk: codes of the detected languages, index to languages (0 - not detected)
+    languages: language names by code
+    titles: titles of the documents (list indexed by docID) - the hot part of the documents needed for every result
+    """
+
+    def __init__(self, fields, size=0):
+        """
+        Initializes an empty table
+        :param fields: fields with document norms
+        :param size: number of document ids to allocate
+        """
+        self.live = np.zeros(size, dtype=bool)
+        self.norms = {field: np.zeros(size, dtype=np.float64) for field in fields}
+        self.lang_all = np.zeros(size, dtype=np.uint8)
+        self.lang_cz_sk = np.zeros(size, dtype=np.uint8)
+        self.languages = [None]
+        self.codes = {None: 0}
+        self.titles = [None] * size
+
+    @classmethod
+    def from_docs(cls, fields, docs, max_id):
+        """
+        Creates the table for the documents
+        :param fields: fields with document norms
+        :param docs: {docID: document}
+        :param max_id: highest document id
+        :return: DocTable
+        """
+        table = cls(fields, max_id + 1)
+        for doc_id, doc in docs.items():
+            table.add(doc_id, doc)
+        return table
+
+    def __len__(self):
+        return len(self.live)
+
+    def ensure(self, doc_id):
+        """
+        Grows the arrays so that they can hold the document id
+        :param doc_id: document id
+        """
+        if doc_id < len(self.live):
+            return
+        size = max(doc_id + 1, 2 * len(self.live))
+        self.live = np.concatenate((self.live, np.zeros(size - len(self.live), dtype=bool)))
+        self.lang_all = np.concatenate((self.lang_all, np.zeros(size - len(self.lang_all), dtype=np.uint8)))
+        self.lang_cz_sk = np.concatenate((self.lang_cz_sk, np.zeros(size - len(self.lang_cz_sk), dtype=np.uint8)))
+        self.titles += [None] * (size - len(self.titles))
+        # the dictionary is shared with Index.document_norms, so the arrays are replaced in place
+        for field, norms in self.norms.items():
+            self.norms[field] = np.concatenate((norms, np.zeros(size - len(norms), dtype=np.float64)))
+
+    def code(self, lang):
+        """
+        Returns the code of the language, new languages get the next code
+        :param lang: language abbreviation or None
+        :return: code
+        """
+        if lang not in self.codes:
+            self.codes[lang] = len(self.languages)
+            self.languages.append(lang)
+        return self.codes[lang]
+
+    def add(self, doc_id, doc):
+        """
+        Marks the document as live and stores its languages and title
+        :param doc_id: document id
+        :param doc: document
+        """
+        self.ensure(doc_id)
+        self.live[doc_id] = True
+        self.lang_all[doc_id] = self.code(doc.get("lang_all"))
+        self.lang_cz_sk[doc_id] = self.code(doc.get("lang_cz_sk"))
+        self.titles[doc_id] = doc.get("title")
+
+    def remove(self, doc_id):
+        """
+        Marks the document as deleted
+        :param doc_id: document id
+        """
+        self.live[doc_id] = False
+        self.titles[doc_id] = None
+        for norms in self.norms.values():
+            norms[doc_id] = 0
+
+    def lang(self, doc_id):
+        """
+        Returns the language of the document detected from all languages
+        :param doc_id: document id
+        :return: language abbreviation, None if not detected
+        """
+        return self.languages[self.lang_all[doc_id]]
+
+    def title(self, doc_id):
+        """
+        Returns the title of the document
+        :param doc_id: document id
+        :return: title
+        """
+        return self.titles[doc_id]
+
+    def live_ids(self):
+        """
+        Returns the ids of the live documents
+        :return: sorted int array
+        """
+        return np.flatnonzero(self.live)
@@ -0,0 +1,938 @@
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping
+
+import numpy as np
+
+from utils.doc_table import DocTable
+from utils.postings_codec import ArrayPostings, CompressedPostings, encode_postings, impact_bounds
+
+# Binary index format
+# -------------------
+# One file per index: <index_name>.bin
+#   magic (8 B) | format version (uint32) | header length (uint32) | JSON header | padding | sections
+# The JSON header holds the index metadata (fields, max_id, unused_ids) and a table of sections
+# {name: [offset, dtype, count]}. Every section is a raw little-endian NumPy array aligned to 8 bytes,
+# so it can be deserialized in bulk with np.frombuffer without touching the individual postings.
+#
+# Sections per field <f>:
+#   <f>.terms      - term dictionary: sorted UTF-8 terms separated by NUL bytes
+#   <f>.term_ptr   - byte offset of every term in <f>.terms (nterms + 1)
+#   <f>.df, <f>.idf
+#   <f>.post_ptr   - offset of the first posting of every term (nterms + 1)
+#   <f>.post_doc, <f>.post_tf, <f>.post_tfidf  - postings block (one item per posting)
+#   <f>.pos_ptr    - offset of the first position of every posting (nposts + 1)
+#   <f>.pos        - positions of all postings
+#   <f>.norm_doc, <f>.norm_val  - document norms of the field
+#   <f>.fwd_doc, <f>.fwd_ptr    - forward index: sorted documents with the offset of their terms (ndocs + 1)
+#   <f>.fwd_term, <f>.fwd_tf    - term numbers (in <f>.terms order) and term counts of every document
+#   <f>.max_impact - impact bound of every term: max(tf / document norm) over its postings (pruned top-k search)
+# With compressed postings (header "postings": "varint") the postings block and positions are replaced by
+#   <f>.blk_ptr    - first block of every term (nterms + 1)
+#   <f>.blk_off    - byte offset of every block in <f>.blk_data (nblocks + 1)
+#   <f>.blk_last   - last document ID of every block
+#   <f>.blk_data   - delta/varint coded blocks, see utils.postings_codec
+# Doc table:
+#   docs.id, docs.ptr, docs.data  - document store: ids, byte offsets (ndocs + 1) and NUL terminated JSON records
+#   docs.lang_all, docs.lang_cz_sk  - codes of the detected languages (header "languages" holds the names)
+#   docs.titles                   - NUL separated titles of the documents (hot table loaded into memory)
+# With compressed documents (header "docs": "zlib") the records are zlib compressed in blocks of
+# header "doc_block" documents and docs.ptr holds the byte offset of every block (nblocks + 1).
+#   keywords, keywords_ptr        - keywords of the index
+
+MAGIC = b"KIVIRIDX"
+# number of documents compressed together in the document store
+DOC_BLOCK = 16
+READ_ONLY_CACHED_TERMS = 4096  # decoded terms kept by a read-only field
+FORMAT_VERSION = 1
+_PREAMBLE = struct.Struct("<8sII")
+_ALIGN = 8
+
+
+def _unpack_strings(blob):
+    """
+    Unpacks the NUL separated UTF-8 blob written by IndexWriter
+    :param blob: blob as uint8 array
+    :return: list of strings
+    """
+    if len(blob) == 0:
+        return []
+    return blob.tobytes()[:-1].decode("utf-8").split("\x00")
+
+
+def write_index(path, index, document_norms, docs, keywords, fields, compress=False, compress_docs=False):
+    """
+    Writes the index to a binary file
+    :param path: path to the file
+    :param index: inverted index {field: {term: {"idf", "df", "docIDs": {docID: {"tf", "tf-idf", "pos"}}}}}
+    :param document_norms: norms of the documents {field: array indexed by docID}
+    :param docs: dictionary with documents {"docs": {...}, "unused_ids": [...], "max_id": int}
+    :param keywords: set of keywords
+    :param fields: indexed fields
+    :param compress: store delta/varint compressed postings (tf is stored as the term count)
+    :param compress_docs: compress the stored documents in zlib blocks
+    """
+    writer = IndexWriter(path, fields, compress, compress_docs)
+    for field in fields:
+        field_index = index.get(field, {})
+        writer.begin_field(field)
+        for term in sorted(field_index.keys()):
+            entry = field_index[term]
+            items = sorted(entry["docIDs"].items())
+            writer.add_term(term, entry["df"], entry["idf"], [doc_id for doc_id, _ in items],
+                            [posting["tf"] for _, posting in items], [posting["tf-idf"] for _, posting in items],
+                            [posting["pos"] for _, posting in items])
+        norms = np.asarray(document_norms.get(field, []), dtype=np.float64)
+        norm_doc = np.flatnonzero(norms)
+        writer.end_field(norm_doc, norms[norm_doc])
+    for doc_id in sorted(docs.get("docs", {}).keys()):
+        writer.add_doc(doc_id, docs["docs"][doc_id])
+    writer.close(keywords, docs.get("max_id", 0), docs.get("unused_ids", []))
+
+
+class IndexWriter:
+    """
+    Streaming writer of the binary index file
+
+    Sections are appended to temporary files next to the index and assembled into the final file on close,
+    so the index never has to be held in memory as a whole. Terms of a field must be added in sorted order
+    and documents in increasing id order.
+
+    Attributes:
+    path: path to the index file
+    fields: indexed fields
+    compress: whether the postings are delta/varint compressed
+    compress_docs: whether the documents are compressed in blocks
+    temp_folder: folder with the sections being written
+    sections: section name -> [file, dtype, number of items]
+    forward: buffered (doc_ids, term numbers, counts) of the postings of the current field
+    forward_runs: sizes of the runs of the postings of the current field sorted by document - the runs are
+                  written to one temporary file and merged into the forward index by end_field
+    """
+
+    # sections are buffered in memory up to this size before they are written to their temporary file
+    BUFFER_SIZE = 1 << 20
+    # postings of the forward index kept in memory - a run on disk or a window of the merged forward index
+    FORWARD_RUN_SIZE = 1 << 20
+
+    def __init__(self, path, fields, compress=False, compress_docs=False):
+        """
+        Initializes the writer
+        :param path: path to the index file
+        :param fields: indexed fields
+        :param compress: store delta/varint compressed postings
+        :param compress_docs: compress the documents in zlib blocks of DOC_BLOCK documents
+        """
+        self.path = path
+        self.fields = list(fields)
+        self.compress = compress
+        self.compress_docs = compress_docs
+        self.temp_folder = tempfile.mkdtemp(prefix=".tmp_index_", dir=os.path.dirname(os.path.abspath(path)))
+        self.sections = {}
+        self.buffers = {}
+        self.field = None
+        self.counters = {}
+        self.forward = []
+        self.forward_size = 0
+        self.forward_runs = []
+        self.terms_count = 0
+        for name in ("docs.id", "docs.ptr", "docs.data", "docs.lang_all", "docs.lang_cz_sk", "docs.titles"):
+            self._create(name)
+        self._append("docs.ptr", np.zeros(1, dtype="<i8"))
+        self.docs_size = 0
+        self.doc_block = []
+        self.languages = DocTable([])
+
+    def _create(self, name, dtype=None):
+        dtype = np.dtype(dtype or _SECTION_TYPES[name.split(".")[-1]])
+        self.sections[name] = [open(os.path.join(self.temp_folder, str(len(self.sections))), "wb"), dtype, 0]
+        self.buffers[name] = [[], 0]
+
+    def _append(self, name, array):
+        section = self.sections[name]
+        array = np.asarray(array, dtype=section[1])
+        section[2] += array.size
+        buffer = self.buffers[name]
+        buffer[0].append(array.tobytes())
+        buffer[1] += array.nbytes
+        if buffer[1] >= self.BUFFER_SIZE:
+            self._flush(name)
+
+    def _flush(self, name):
+        self.sections[name][0].write(b"".join(self.buffers[name][0]))
+        self.buffers[name] = [[], 0]
+
+    def begin_field(self, field):
+        """
+        Starts writing the postings of a field
+        :param field: name of the field
+        """
+        self.field = field
+        names = ["terms", "term_ptr", "df", "idf", "post_ptr"]
+        names += ["blk_ptr", "blk_off", "blk_last", "blk_data"] if self.compress else \
+            ["post_doc", "post_tf", "post_tfidf", "pos_ptr", "pos"]
+        for name in names + ["norm_doc", "norm_val", "fwd_doc", "fwd_ptr", "fwd_term", "fwd_tf", "max_impact"]:
+            self._create(field + "." + name)
+        pointers = ["term_ptr", "post_ptr"] + (["blk_ptr", "blk_off"] if self.compress else ["pos_ptr"])
+        for name in pointers:
+            self._append(field + "." + name, np.zeros(1, dtype="<i8"))
+        self.counters = {name: 0 for name in pointers}
+        self.terms_count = 0
+
+    def add_term(self, term, df, idf, doc_ids, tf, tf_idf, positions):
+        """
+        Appends the postings of a term to the current field
+        :param term: term, greater than all terms added before
+        :param df: document frequency of the term
+        :param idf: inverse document frequency of the term
+        :param doc_ids: sorted integer ids of the documents containing the term
+        :param tf: tf of the postings (not stored in the compressed format - derived from the positions)
+        :param tf_idf: tf-idf of the postings (not stored in the compressed format)
+        :param positions: positions of the term in the documents
+        """
+        field, counters = self.field, self.counters
+        encoded = term.encode("utf-8") + b"\x00"
+        self._append(field + ".terms", np.frombuffer(encoded, dtype=np.uint8))
+        counters["term_ptr"] += len(encoded)
+        self._append(field + ".term_ptr", [counters["term_ptr"]])
+        self._append(field + ".df", [df])
+        self._append(field + ".idf", [idf])
+        counters["post_ptr"] += len(doc_ids)
+        self._append(field + ".post_ptr", [counters["post_ptr"]])
+        self.forward.append((np.asarray(doc_ids, dtype=np.int32), np.full(len(doc_ids), self.terms_count, np.int32),
+                             np.fromiter(map(len, positions), dtype=np.int32, count=len(positions))))
+        self.terms_count += 1
+        self.forward_size += len(doc_ids)
+        if self.forward_size >= self.FORWARD_RUN_SIZE:
+            self._spill_forward()
+        if self.compress:
+            data, block_ptr, block_last = encode_postings(doc_ids, positions)
+            self._append(field + ".blk_off", block_ptr[1:] + counters["blk_off"])
+            counters["blk_off"] += len(data)
+            counters["blk_ptr"] += len(block_last)
+            self._append(field + ".blk_ptr", [counters["blk_ptr"]])
+            self._append(field + ".blk_last", block_last)
+            self._append(field + ".blk_data", data)
+            return
+        self._append(field + ".post_doc", doc_ids)
+        self._append(field + ".post_tf", tf)
+        self._append(field + ".post_tfidf", tf_idf)
+        lengths = np.fromiter(map(len, positions), dtype=np.int64, count=len(positions))
+        self._append(field + ".pos_ptr", np.cumsum(lengths) + counters["pos_ptr"])
+        counters["pos_ptr"] += int(lengths.sum())
+        self._append(field + ".pos", np.concatenate(positions) if positions else [])
+
+    def end_field(self, norm_doc, norm_val):
+        """
+        Finishes the current field
+        :param norm_doc: sorted integer ids of the documents with a norm in the field
+        :param norm_val: norms of the documents
+        """
+        self._append(self.field + ".norm_doc", norm_doc)
+        self._append(self.field + ".norm_val", norm_val)
+        self._spill_forward()
+        path = os.path.join(self.temp_folder, "forward")
+        stored = np.memmap(path, dtype=_FORWARD_DTYPE, mode="r") if self.forward_runs else None
+        offsets = np.cumsum([0] + self.forward_runs)
+        runs = [stored[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        max_doc = max([int(run["doc"][-1]) for run in runs] + [int(np.max(norm_doc, initial=-1))])
+
+        # impact bounds of the terms - every term is in one run, a run fits into memory
+        norms = np.zeros(max_doc + 1)
+        norms[norm_doc] = norm_val
+        bounds = np.zeros(self.terms_count)
+        doc_counts = np.zeros(max_doc + 1, dtype=np.int64)
+        for run in runs:
+            run = run[np.argsort(run["term"], kind="stable")]
+            starts = np.flatnonzero(np.diff(run["term"], prepend=-1))
+            bounds[run["term"][starts]] = impact_bounds(run["doc"], 1 + np.log10(run["tf"].astype(np.float64)),
+                                                        starts, norms)
+            doc_counts += np.bincount(run["doc"], minlength=max_doc + 1)
+        self._append(self.field + ".max_impact", bounds)
+
+        # forward index - the runs are merged in windows of documents, the runs are in term order and sorted
+        # by document (stable), so the terms of a document stay in term order
+        docs = np.flatnonzero(doc_counts)
+        pointers = np.concatenate([[0], np.cumsum(doc_counts[docs])])
+        self._append(self.field + ".fwd_doc", docs)
+        self._append(self.field + ".fwd_ptr", pointers)
+        first = 0
+        while first < len(docs):
+            last = max(int(np.searchsorted(pointers, pointers[first] + self.FORWARD_RUN_SIZE, "right")) - 1,
+                       first + 1)
+            low, high = docs[first], docs[last - 1] + 1
+            window = np.concatenate([run[np.searchsorted(run["doc"], low):np.searchsorted(run["doc"], high)]
+                                     for run in runs])
+            window = window[np.argsort(window["doc"], kind="stable")]
+            self._append(self.field + ".fwd_term", window["term"])
+            self._append(self.field + ".fwd_tf", window["tf"])
+            first = last
+        del runs, stored
+        if self.forward_runs:
+            os.remove(path)
+        self.forward_runs = []
+        self.field = None
+
+    def _spill_forward(self):
+        """
+        Writes the buffered postings of the current field to a temporary run sorted by document
+        """
+        if self.forward_size == 0:
+            return
+        run = np.empty(self.forward_size, dtype=_FORWARD_DTYPE)
+        for name, column in zip(("doc", "term", "tf"), zip(*self.forward)):
+            run[name] = np.concatenate(column)
+        with open(os.path.join(self.temp_folder, "forward"), "ab") as file:
+            run[np.argsort(run["doc"], kind="stable")].tofile(file)
+        self.forward_runs.append(self.forward_size)
+        self.forward = []
+        self.forward_size = 0
+
+    def add_doc(self, doc_id, doc):
+        """
+        Appends a document to the doc table
+        :param doc_id: integer id of the document, greater than all ids added before
+        :param doc: document
+        """
+        encoded = json.dumps(doc, ensure_ascii=False).encode("utf-8") + b"\x00"
+        self._append("docs.id", [doc_id])
+        self._append("docs.lang_all", [self.languages.code(doc.get("lang_all"))])
+        self._append("docs.lang_cz_sk", [self.languages.code(doc.get("lang_cz_sk"))])
+        title = doc.get("title", "").encode("utf-8") + b"\x00"
+        self._append("docs.titles", np.frombuffer(title, dtype=np.uint8))
+        if self.compress_docs:
+            self.doc_block.append(encoded)
+            if len(self.doc_block) == DOC_BLOCK:
+                self._flush_docs()
+            return
+        self._append("docs.data", np.frombuffer(encoded, dtype=np.uint8))
+        self.docs_size += len(encoded)
+        self._append("docs.ptr", [self.docs_size])
+
+    def _flush_docs(self):
+        """
+        Compresses the buffered documents into one block of the document store
+        """
+        block = zlib.compress(b"".join(self.doc_block))
+        self._append("docs.data", np.frombuffer(block, dtype=np.uint8))
+        self.docs_size += len(block)
+        self._append("docs.ptr", [self.docs_size])
+        self.doc_block = []
+
+    def close(self, keywords, max_id, unused_ids):
+        """
+        Writes the keywords and the header and assembles the index file
+        :param keywords: set of keywords
+        :param max_id: highest document id
+        :param unused_ids: ids of removed documents
+        """
+        if self.doc_block:
+            self._flush_docs()
+        self._create("keywords")
+        self._create("keywords_ptr")
+        self._append("keywords_ptr", np.zeros(1, dtype="<i8"))
+        size = 0
+        for keyword in sorted(keywords):
+            encoded = keyword.encode("utf-8") + b"\x00"
+            self._append("keywords", np.frombuffer(encoded, dtype=np.uint8))
+            size += len(encoded)
+            self._append("keywords_ptr", [size])
+
+        header = {
+            "fields": self.fields,
+            "max_id": max_id,
+            "unused_ids": unused_ids,
+            "postings": "varint" if self.compress else "raw",
+            "languages": self.languages.languages,
+            "docs": "zlib" if self.compress_docs else "raw",
+            "doc_block": DOC_BLOCK,
+            "sections": {},
+        }
+        offset = 0
+        for name, (file, dtype, count) in self.sections.items():
+            self._flush(name)
+            file.close()
+            header["sections"][name] = [offset, dtype.str, count]
+            offset += _padded(count * dtype.itemsize)
+        header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        data_start = _padded(_PREAMBLE.size + len(header_bytes))
+
+        # the file is assembled next to the old one and replaced at once - an index loaded from the old file
+        # keeps reading its documents from the old (still mapped) file
+        assembled = os.path.join(self.temp_folder, "index.bin")
+        with open(assembled, "wb") as output:
+            output.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+            output.write(header_bytes)
+            output.write(b"\x00" * (data_start - _PREAMBLE.size - len(header_bytes)))
+            for name, (file, dtype, count) in self.sections.items():
+                with open(file.name, "rb") as section:
+                    shutil.copyfileobj(section, output)
+                nbytes = count * dtype.itemsize
+                output.write(b"\x00" * (_padded(nbytes) - nbytes))
+        os.replace(assembled, self.path)
+        shutil.rmtree(self.temp_folder)
+
+
+# postings of a field in the temporary runs of the forward index
+_FORWARD_DTYPE = np.dtype([("doc", "<i4"), ("term", "<i4"), ("tf", "<i4")])
+
+# dtype of the sections by the last part of their name
+_SECTION_TYPES = {
+    "terms": np.uint8, "term_ptr": "<i8", "df": "<i4", "idf": "<f8", "post_ptr": "<i8",
+    "post_doc": "<i4", "post_tf": "<f8", "post_tfidf": "<f8", "pos_ptr": "<i8", "pos": "<i4",
+    "blk_ptr": "<i8", "blk_off": "<i8", "blk_last": "<i4", "blk_data": np.uint8,
+    "norm_doc": "<i4", "norm_val": "<f8", "fwd_doc": "<i4", "fwd_ptr": "<i8", "fwd_term": "<i4", "fwd_tf": "<i4",
+    "max_impact": "<f8",
+    "id": "<i4", "ptr": "<i8", "data": np.uint8, "lang_all": np.uint8, "lang_cz_sk": np.uint8, "titles": np.uint8,
+    "keywords": np.uint8, "keywords_ptr": "<i8",
+}
+
+
+def _padded(size):
+    """
+    Rounds the size up to the section alignment
+    :param size: size in bytes
+    :return: aligned size
+    """
+    return (size + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+class IndexFile:
+    """
+    Binary index file opened for reading
+
+    Attributes:
+    header: metadata of the index
+    buffer: read-only memory map of the file
+    data_start: offset of the first section
+    use_mmap: whether the sections are used in place (otherwise they are copied into memory when loaded)
+    """
+
+    def __init__(self, path, use_mmap=False):
+        """
+        Maps the file and parses the header
+        :param path: path to the file
+        :param use_mmap: use the sections in place instead of copying them, pages are faulted in on access and
+                         shared through the OS page cache with other processes mapping the same file
+                         (the document store is always read from the mapping)
+        """
+        self.use_mmap = use_mmap
+        with open(path, "rb") as file:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_len = _PREAMBLE.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a binary index file: {}".format(path))
+        if version != FORMAT_VERSION:
+            raise ValueError("Unsupported index format version {} (expected {})".format(version, FORMAT_VERSION))
+        self.header = json.loads(self.buffer[_PREAMBLE.size:_PREAMBLE.size + header_len].decode("utf-8"))
+        self.data_start = _padded(_PREAMBLE.size + header_len)
+
+    def array(self, name, copy=None):
+        """
+        Returns the section as a NumPy array
+        :param name: name of the section
+        :param copy: copy the section into memory, by default when the file is not used in place
+        :return: array
+        """
+        offset, dtype, count = self.header["sections"][name]
+        array = np.frombuffer(self.buffer, dtype=np.dtype(dtype), count=count, offset=self.data_start + offset)
+        if copy is None:
+            copy = not self.use_mmap
+        return array.copy() if copy else array
+
+    def field(self, field):
+        """
+        Returns the postings of the field
+        :param field: name of the field
+        :return: BinaryField
+        """
+        if self.header.get("postings", "raw") == "varint":
+            return CompressedBinaryField(self, field)
+        return BinaryField(self, field)
+
+    def document_norms(self, field, size=None):
+        """
+        Returns the document norms of the field
+        :param field: name of the field
+        :param size: length of the array, max_id + 1 by default
+        :return: array indexed by docID, 0 for the documents without the field
+        """
+        norms = np.zeros(self.header["max_id"] + 1 if size is None else size, dtype=np.float64)
+        norms[self.array(field + ".norm_doc")] = self.array(field + ".norm_val")
+        return norms
+
+    def doc_table(self, fields):
+        """
+        Returns the per-document arrays
+        :param fields: fields with document norms
+        :return: DocTable
+        """
+        doc_ids = self.array("docs.id")
+        size = max(self.header["max_id"], int(doc_ids.max()) if len(doc_ids) else -1) + 1
+        table = DocTable([])
+        table.ensure(size - 1)
+        table.norms = {field: self.document_norms(field, len(table)) for field in fields}
+        table.live[doc_ids] = True
+        if "docs.titles" in self.header["sections"]:
+            table.languages = self.header["languages"]
+            table.codes = {lang: code for code, lang in enumerate(table.languages)}
+            table.lang_all[doc_ids] = self.array("docs.lang_all")
+            table.lang_cz_sk[doc_ids] = self.array("docs.lang_cz_sk")
+            for doc_id, title in zip(doc_ids.tolist(), _unpack_strings(self.array("docs.titles"))):
+                table.titles[doc_id] = title
+        else:  # written before the languages and titles were stored
+            for doc_id, doc in self.docs()["docs"].items():
+                table.add(doc_id, doc)
+        return table
+
+    def forward(self, field):
+        """
+        Returns the forward index of the field
+        :param field: name of the field
+        :return: LazyForward {docID: {term: count}}, None if the file was written without the forward index
+        """
+        if field + ".fwd_doc" not in self.header["sections"]:
+            return None
+        return LazyForward(self, field)
+
+    def docs(self):
+        """
+        Returns the document cache
+        :return: dictionary {"docs": DocStore, "unused_ids": [...], "max_id": int}
+        """
+        block_size = self.header["doc_block"] if self.header.get("docs") == "zlib" else 0
+        # the records stay in the mapped file, only the offset table is loaded
+        docs = DocStore(self.array("docs.id"), self.array("docs.ptr"), self.array("docs.data", copy=False), block_size)
+        unused_ids = [int(doc_id) for doc_id in self.header["unused_ids"]]
+        return {"docs": docs, "unused_ids": unused_ids, "max_id": self.header["max_id"]}
+
+    def keywords(self):
+        """
+        Returns the keywords of the index
+        :return: set of keywords
+        """
+        return set(_unpack_strings(self.array("keywords")))
+
+
+def _term_dictionary(index_file, field):
+    """
+    Loads the term dictionary of the field
+    :param index_file: opened IndexFile
+    :param field: name of the field
+    :return: term -> term number (dictionary, or a TermDictionary searched in place when memory-mapped)
+    """
+    if index_file.use_mmap:
+        return TermDictionary(index_file.array(field + ".terms"), index_file.array(field + ".term_ptr"))
+    return {term: i for i, term in enumerate(_unpack_strings(index_file.array(field + ".terms")))}
+
+
+def _max_impact(index_file, field):
+    """
+    Loads the impact bounds of the terms of the field
+    :param index_file: opened IndexFile
+    :param field: name of the field
+    :return: array indexed by term number, None if the file was written without the bounds
+    """
+    if field + ".max_impact" not in index_file.header["sections"]:
+        return None
+    return index_file.array(field + ".max_impact")
+
+
+class BinaryField:
+    """
+    Postings of one field stored in the binary index file
+
+    Attributes:
+    terms: term -> term number (dictionary, or a TermDictionary searched in place when memory-mapped)
+    df, idf: document frequency and inverse document frequency of the terms
+    post_ptr, post_doc, post_tf, post_tfidf: postings block
+    pos_ptr, pos: positions of the postings
+    max_impact: impact bounds of the terms, None if the file was written without them
+    """
+
+    def __init__(self, index_file, field):
+        """
+        Loads the field sections in bulk
+        :param index_file: opened IndexFile
+        :param field: name of the field
+        """
+        self.terms = _term_dictionary(index_file, field)
+        self.df = index_file.array(field + ".df")
+        self.idf = index_file.array(field + ".idf")
+        self.post_ptr = index_file.array(field + ".post_ptr")
+        self.post_doc = index_file.array(field + ".post_doc")
+        self.post_tf = index_file.array(field + ".post_tf")
+        self.post_tfidf = index_file.array(field + ".post_tfidf")
+        self.pos_ptr = index_file.array(field + ".pos_ptr")
+        self.pos = index_file.array(field + ".pos")
+        self.max_impact = _max_impact(index_file, field)
+
+    def entry(self, term_id):
+        """
+        Returns the term entry with the postings as views into the stored arrays (nothing is decoded)
+        :param term_id: term number
+        :return: {"idf", "df", "docIDs": ArrayPostings}
+        """
+        start, end = self.post_ptr[term_id], self.post_ptr[term_id + 1]
+        postings = ArrayPostings(self.post_doc[start:end], self.post_tf[start:end], self.post_tfidf[start:end],
+                                 self.pos_ptr[start:end + 1], self.pos)
+        return {"idf": float(self.idf[term_id]), "df": int(self.df[term_id]), "docIDs": postings}
+
+    def max_impacts(self):
+        """
+        Returns the stored impact bounds of the terms
+        :return: TermValues {term: bound}, None if the file was written without them
+        """
+        if self.max_impact is None:
+            return None
+        return TermValues(self.terms, self.max_impact)
+
+
+class CompressedBinaryField(BinaryField):
+    """
+    Compressed postings of one field stored in the binary index file
+
+    Attributes:
+    terms: term -> term number
+    df, idf: document frequency and inverse document frequency of the terms
+    post_ptr: offset of the first posting of every term
+    blk_ptr, blk_off, blk_last, blk_data: compressed blocks of the postings
+    max_impact: impact bounds of the terms, None if the file was written without them
+    """
+
+    def __init__(self, index_file, field):
+        """
+        Loads the field sections in bulk, the blocks stay compressed
+        :param index_file: opened IndexFile
+        :param field: name of the field
+        """
+        self.terms = _term_dictionary(index_file, field)
+        self.df = index_file.array(field + ".df")
+        self.idf = index_file.array(field + ".idf")
+        self.post_ptr = index_file.array(field + ".post_ptr")
+        self.blk_ptr = index_file.array(field + ".blk_ptr")
+        self.blk_off = index_file.array(field + ".blk_off")
+        self.blk_last = index_file.array(field + ".blk_last")
+        self.blk_data = index_file.array(field + ".blk_data")
+        self.max_impact = _max_impact(index_file, field)
+
+    def entry(self, term_id):
+        """
+        Returns the term entry with compressed postings (views into the stored blocks, nothing is decoded)
+        :param term_id: term number
+        :return: {"idf", "df", "docIDs": CompressedPostings}
+        """
+        first, last = self.blk_ptr[term_id], self.blk_ptr[term_id + 1]
+        offsets = self.blk_off[first:last + 1]
+        idf = float(self.idf[term_id])
+        postings = CompressedPostings(self.blk_data[offsets[0]:offsets[-1]], offsets - offsets[0],
+                                      self.blk_last[first:last],
+                                      self.post_ptr[term_id + 1] - self.post_ptr[term_id], idf)
+        return {"idf": idf, "df": int(self.df[term_id]), "docIDs": postings}
+
+
+class LazyField(MutableMapping):
+    """
+    Field of the inverted index backed by a BinaryField
+
+    Terms are decoded on the first access and kept in memory, so changes made to the returned
+    entries (e.g. by Index.create_document) persist like in a plain dictionary.
+    A read-only field keeps only the last used terms (LRU), so a term looked up several times by one query
+    is decoded once and memory use does not grow with the number of queried terms.
+    """
+
+    def __init__(self, binary_field, read_only=False, cached_terms=READ_ONLY_CACHED_TERMS):
+        """
+        Initializes the field
+        :param binary_field: BinaryField with the stored postings
+        :param read_only: whether the field can be modified
+        :param cached_terms: max number of decoded terms kept by a read-only field
+        """
+        self.binary_field = binary_field
+        self.read_only = read_only
+        self.cached_terms = cached_terms
+        self.decoded = OrderedDict() if read_only else {}
+        self.removed = set()
+        self.lock = threading.Lock()  # the searches of the server share the read-only field
+
+    def __getitem__(self, term):
+        if self.read_only:
+            with self.lock:
+                entry = self.decoded.get(term)
+                if entry is not None:
+                    self.decoded.move_to_end(term)
+                    return entry
+        elif term in self.decoded:
+            return self.decoded[term]
+        if term in self.removed or term not in self.binary_field.terms:
+            raise KeyError(term)
+        entry = self.binary_field.entry(self.binary_field.terms[term])
+        if self.read_only:
+            with self.lock:
+                self.decoded[term] = entry
+                while len(self.decoded) > self.cached_terms:
+                    self.decoded.popitem(last=False)
+        else:
+            self.decoded[term] = entry
+        return entry
+
+    def __setitem__(self, term, entry):
+        if self.read_only:
+            raise TypeError("The index is opened read-only")
+        self.decoded[term] = entry
+
+    def __delitem__(self, term):
+        if self.read_only:
+            raise TypeError("The index is opened read-only")
+        if term not in self:
+            raise KeyError(term)
+        self.decoded.pop(term, None)
+        if term in self.binary_field.terms:
+            self.removed.add(term)
+
+    def __contains__(self, term):
+        if term in self.decoded:
+            return True
+        return term not in self.removed and term in self.binary_field.terms
+
+    def __iter__(self):
+        for term in self.binary_field.terms:
+            if term not in self.removed:
+                yield term
+        for term in self.decoded:
+            if term not in self.binary_field.terms:
+                yield term
+
+    def __len__(self):
+        extra = sum(1 for term in self.decoded if term not in self.binary_field.terms)
+        return len(self.binary_field.terms) - len(self.removed) + extra
+
+
+class LazyForward(MutableMapping):
+    """
+    Forward index of a field (document -> term counts) backed by the binary index file
+
+    Documents are decoded on access, changed documents are kept in memory like in LazyField.
+    The term strings are unpacked only when the first document is decoded.
+    """
+
+    def __init__(self, index_file, field):
+        """
+        Initializes the forward index
+        :param index_file: opened IndexFile
+        :param field: name of the field
+        """
+        self.index_file = index_file
+        self.field = field
+        self.doc_ids = index_file.array(field + ".fwd_doc")
+        self.ptr = index_file.array(field + ".fwd_ptr")
+        self.term_ids = index_file.array(field + ".fwd_term")
+        self.counts = index_file.array(field + ".fwd_tf")
+        self.terms = None
+        self.decoded = {}
+        self.removed = set()
+
+    def _stored(self, doc_id):
+        try:
+            _find_doc(self.doc_ids, doc_id)
+        except KeyError:
+            return False
+        return doc_id not in self.removed
+
+    def __getitem__(self, doc_id):
+        if doc_id in self.decoded:
+            return self.decoded[doc_id]
+        if doc_id in self.removed:
+            raise KeyError(doc_id)
+        i = _find_doc(self.doc_ids, doc_id)
+        if self.terms is None:
+            self.terms = _unpack_strings(self.index_file.array(self.field + ".terms"))
+        start, end = self.ptr[i], self.ptr[i + 1]
+        return {self.terms[term]: count for term, count in zip(self.term_ids[start:end].tolist(),
+                                                               self.counts[start:end].tolist())}
+
+    def __setitem__(self, doc_id, counts):
+        self.decoded[doc_id] = counts
+
+    def __delitem__(self, doc_id):
+        if doc_id not in self:
+            raise KeyError(doc_id)
+        self.decoded.pop(doc_id, None)
+        self.removed.add(doc_id)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.decoded or self._stored(doc_id)
+
+    def __iter__(self):
+        for doc_id in self.doc_ids.tolist():
+            if doc_id not in self.removed and doc_id not in self.decoded:
+                yield doc_id
+        yield from self.decoded
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+def _find_doc(doc_ids, doc_id):
+    """
+    Finds the document in the sorted array of document ids
+    :param doc_ids: sorted document ids
+    :param doc_id: document id
+    :return: position of the document
+    """
+    try:
+        key = int(doc_id)
+    except (TypeError, ValueError):
+        raise KeyError(doc_id)
+    i = int(np.searchsorted(doc_ids, key))
+    if i < len(doc_ids) and doc_ids[i] == key:
+        return i
+    raise KeyError(doc_id)
+
+
+class TermDictionary(Mapping):
+    """
+    Sorted term dictionary searched directly in the stored blob (binary search over the term offsets)
+    """
+
+    def __init__(self, blob, ptr):
+        """
+        Initializes the dictionary
+        :param blob: NUL separated UTF-8 terms in sorted order
+        :param ptr: byte offsets of the terms
+        """
+        self.blob = blob
+        self.ptr = ptr
+
+    def _term(self, term_id):
+        return self.blob[self.ptr[term_id]:self.ptr[term_id + 1] - 1].tobytes()
+
+    def __getitem__(self, term):
+        key = term.encode("utf-8")
+        # UTF-8 byte order is the same as the code point order the terms were sorted by
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._term(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and self._term(low) == key:
+            return low
+        raise KeyError(term)
+
+    def __iter__(self):
+        return iter(_unpack_strings(self.blob))
+
+    def __len__(self):
+        return len(self.ptr) - 1
+
+
+class TermValues(Mapping):
+    """
+    Read-only {term: value} view of a per-term section (e.g. the impact bounds)
+    """
+
+    def __init__(self, terms, values):
+        """
+        Initializes the view
+        :param terms: term -> term number
+        :param values: array indexed by term number
+        """
+        self.terms = terms
+        self.values = values
+
+    def __getitem__(self, term):
+        return float(self.values[self.terms[term]])
+
+    def __contains__(self, term):
+        return term in self.terms
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __len__(self):
+        return len(self.terms)
+
+
+class DocStore(MutableMapping):
+    """
+    Random-access document store backed by the doc table of the binary index file
+
+    A document is fetched and parsed only when it is accessed (e.g. the top-k results for their snippets),
+    so neither the load time nor the memory use grows with the total text of the corpus. Records can be
+    compressed in zlib blocks, then the block containing the document is decompressed.
+    Added and changed documents are kept in memory until the index is saved. Documents returned by the store
+    are parsed copies - a changed document must be stored back (store[doc_id] = doc).
+    """
+
+    def __init__(self, doc_ids, ptr, data, block_size=0):
+        """
+        Initializes the store
+        :param doc_ids: sorted document ids
+        :param ptr: byte offsets of the records (or of the blocks)
+        :param data: NUL terminated JSON records (or zlib compressed blocks of them)
+        :param block_size: number of documents in a compressed block, 0 if the records are not compressed
+        """
+        self.doc_ids = doc_ids
+        self.ptr = ptr
+        self.data = data
+        self.block_size = block_size
+        self.changed = {}
+        self.removed = set()
+
+    def _record(self, i):
+        """
+        Reads the stored record
+        :param i: position of the document in the doc table
+        :return: JSON record as bytes
+        """
+        if not self.block_size:
+            return self.data[self.ptr[i]:self.ptr[i + 1] - 1].tobytes()
+        block, i = divmod(i, self.block_size)
+        records = zlib.decompress(self.data[self.ptr[block]:self.ptr[block + 1]].tobytes())
+        return records.split(b"\x00")[i]
+
+    def _stored(self, doc_id):
+        try:
+            _find_doc(self.doc_ids, doc_id)
+        except KeyError:
+            return False
+        return doc_id not in self.removed
+
+    def __getitem__(self, doc_id):
+        if doc_id in self.changed:
+            return self.changed[doc_id]
+        if doc_id in self.removed:
+            raise KeyError(doc_id)
+        return json.loads(self._record(_find_doc(self.doc_ids, doc_id)).decode("utf-8"))
+
+    def __setitem__(self, doc_id, doc):
+        self.changed[doc_id] = doc
+
+    def __delitem__(self, doc_id):
+        if doc_id not in self:
+            raise KeyError(doc_id)
+        if self._stored(doc_id):
+            self.removed.add(doc_id)
+        self.changed.pop(doc_id, None)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.changed or self._stored(doc_id)
+
+    def __iter__(self):
+        for doc_id in self.doc_ids.tolist():
+            if doc_id not in self.removed and doc_id not in self.changed:
+                yield doc_id
+        yield from self.changed
+
+    def __len__(self):
+        stored = sum(1 for doc_id in self.changed if self._stored(doc_id))
+        return len(self.doc_ids) - len(self.removed) + len(self.changed) - stored
@@ -0,0 +1,46 @@
+from collections import deque
+
+
+def shortest_match(positions, proximity):
+    """
+    Finds the shortest occurrence of the query words in a document
+    The words have to occur in the order of the query and every word at most proximity positions after
+    the previous one (proximity 1 is a phrase). For every position of a word the latest start of a valid
+    occurrence ending there is computed from the positions of the previous word - the maximum over a sliding
+    window, so the time is linear in the number of positions.
+    :param positions: sorted positions of every query word in the document (in the order of the query)
+    :param proximity: max distance between neighbouring words
+    :return: positions of the words in the shortest occurrence (the first one of the same length),
+             None if the words don't occur in the document close enough
+    """
+    starts = [list(positions[0])]  # latest start of an occurrence ending at the position, -1 if there is none
+    previous = [None]  # index of the position of the previous word in the occurrence
+    for word_positions, before, before_starts in zip(positions[1:], positions, starts):
+        word_starts, word_previous = [], []
+        window = deque()  # indexes of the positions of the previous word with decreasing starts
+        i = 0
+        for position in word_positions:
+            while i < len(before) and before[i] < position:
+                if before_starts[i] >= 0:
+                    while window and before_starts[window[-1]] <= before_starts[i]:
+                        window.pop()
+                    window.append(i)
+                i += 1
+            while window and before[window[0]] < position - proximity:
+                window.popleft()
+            word_starts.append(before_starts[window[0]] if window else -1)
+            word_previous.append(window[0] if window else -1)
+        starts.append(word_starts)
+        previous.append(word_previous)
+
+    best = None
+    for j, (position, start) in enumerate(zip(positions[-1], starts[-1])):
+        if start >= 0 and (best is None or position - start < positions[-1][best] - starts[-1][best]):
+            best = j
+    if best is None:
+        return None
+    match = []
+    for word in range(len(positions) - 1, -1, -1):
+        match.append(positions[word][best])
+        best = previous[word][best] if word > 0 else None
+    return match[::-1]
@@ -0,0 +1,398 @@
+from collections.abc import Mapping
+
+import numpy as np
+
+# Postings are split into blocks of BLOCK_SIZE documents. Every block is one varint stream:
+#   doc ID gaps (first gap relative to the last document of the previous block) | term counts | position gaps
+# The position gaps restart at every posting. The last document ID of every block is kept uncompressed,
+# so a document can be found by decoding a single block.
+BLOCK_SIZE = 128
+# single blocks with at most this many positions are encoded without NumPy
+SMALL_BLOCK = 512
+
+
+def encode_varint(values, return_lengths=False):
+    """
+    Encodes non-negative integers as variable length bytes (7 bits per byte, high bit = continuation)
+    :param values: non-negative integers
+    :param return_lengths: also return the number of bytes of every value
+    :return: encoded bytes as uint8 array (and the lengths)
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        nbytes += rest > 0
+        rest >>= np.uint64(7)
+    out = np.empty(int(nbytes.sum()), dtype=np.uint8)
+    starts = np.cumsum(nbytes) - nbytes
+    rest = values.copy()
+    for k in range(int(nbytes.max()) if len(values) else 0):
+        mask = nbytes > k
+        continuation = (nbytes[mask] > k + 1).astype(np.uint8) << 7
+        out[starts[mask] + k] = (rest[mask] & np.uint64(0x7F)).astype(np.uint8) | continuation
+        rest >>= np.uint64(7)
+    if return_lengths:
+        return out, nbytes
+    return out
+
+
+def decode_varint(data, count=None):
+    """
+    Decodes the bytes created by encode_varint
+    :param data: encoded bytes as uint8 array
+    :param count: decode only the first count integers
+    :return: decoded integers as int64 array
+    """
+    ends = np.flatnonzero(data < 0x80)[:count]
+    starts = np.empty_like(ends)
+    starts[:1] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts + 1
+    values = np.zeros(len(ends), dtype=np.int64)
+    for k in range(int(lengths.max()) if len(ends) else 0):
+        mask = lengths > k
+        values[mask] |= (data[starts[mask] + k] & 0x7F).astype(np.int64) << (7 * k)
+    return values
+
+
+def encode_postings(doc_ids, positions):
+    """
+    Compresses the postings of one term
+    :param doc_ids: sorted integer document ids
+    :param positions: sorted positions of the term in every document
+    :return: data (uint8 array), block_ptr (byte offset of every block + end), block_last (last doc ID of every block)
+    """
+    if len(doc_ids) <= BLOCK_SIZE and sum(map(len, positions)) <= SMALL_BLOCK:
+        return _encode_small_postings(doc_ids, positions)
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    counts = np.fromiter(map(len, positions), dtype=np.int64, count=len(positions))
+    flat = np.concatenate(positions).astype(np.int64) if len(positions) else np.empty(0, dtype=np.int64)
+    # the gap of the first document of a block is relative to the last document of the previous block,
+    # which is the same as the gap to the previous document
+    doc_gaps = np.diff(doc_ids, prepend=0)
+    position_gaps = np.diff(flat, prepend=0)
+    firsts = (np.cumsum(counts) - counts)[counts > 0]
+    position_gaps[firsts] = flat[firsts]  # position gaps restart at every posting
+    position_ends = np.cumsum(counts)
+
+    values, value_ends = [], [0]
+    for start in range(0, len(doc_ids), BLOCK_SIZE):
+        end = min(start + BLOCK_SIZE, len(doc_ids))
+        first_position = position_ends[start - 1] if start > 0 else 0
+        values += [doc_gaps[start:end], counts[start:end], position_gaps[first_position:position_ends[end - 1]]]
+        value_ends.append(value_ends[-1] + 2 * (end - start) + position_ends[end - 1] - first_position)
+    if not values:
+        return np.empty(0, dtype=np.uint8), np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int32)
+    data, lengths = encode_varint(np.concatenate(values), return_lengths=True)
+    block_ptr = np.concatenate(([0], np.cumsum(lengths)))[value_ends]
+    block_last = doc_ids[np.minimum(np.arange(BLOCK_SIZE, len(doc_ids) + BLOCK_SIZE, BLOCK_SIZE), len(doc_ids)) - 1]
+    return data, block_ptr.astype(np.int64), block_last.astype(np.int32)
+
+
+def _encode_small_postings(doc_ids, positions):
+    """
+    Compresses postings that fit into a single block in pure Python - most terms occur in a few documents only
+    and the NumPy encoder would spend most of its time in per-call overhead
+    :param doc_ids: sorted integer document ids (at most BLOCK_SIZE)
+    :param positions: sorted positions of the term in every document
+    :return: data (uint8 array), block_ptr, block_last - see encode_postings
+    """
+    values = []
+    previous = 0
+    for doc_id in doc_ids:
+        values.append(doc_id - previous)
+        previous = doc_id
+    values += [len(pos) for pos in positions]
+    for pos in positions:
+        previous = 0
+        for p in pos:
+            values.append(p - previous)
+            previous = p
+    data = bytearray()
+    for value in values:
+        while value >= 0x80:
+            data.append(value & 0x7F | 0x80)
+            value >>= 7
+        data.append(value)
+    if not doc_ids:
+        return np.empty(0, dtype=np.uint8), np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int32)
+    return (np.frombuffer(bytes(data), dtype=np.uint8), np.array([0, len(data)], dtype=np.int64),
+            np.array([doc_ids[-1]], dtype=np.int32))
+
+
+class CompressedPostings(Mapping):
+    """
+    Read-only postings of one term kept in the compressed block format
+
+    Behaves like the {docID: {"tf", "tf-idf", "pos"}} dictionary of the in-memory index, but decodes
+    only the block containing the requested document. tf and tf-idf are computed from the stored term
+    count: tf = 1 + log10(count), tf-idf = tf * idf.
+
+    Attributes:
+    data: compressed blocks
+    block_ptr: byte offset of every block (nblocks + 1)
+    block_last: last document ID of every block
+    length: number of postings
+    idf: inverse document frequency of the term
+    """
+
+    def __init__(self, data, block_ptr, block_last, length, idf):
+        """
+        Initializes the postings
+        :param data: compressed blocks
+        :param block_ptr: byte offset of every block (nblocks + 1)
+        :param block_last: last document ID of every block
+        :param length: number of postings
+        :param idf: inverse document frequency of the term
+        """
+        self.data = data
+        self.block_ptr = block_ptr
+        self.block_last = block_last
+        self.length = int(length)
+        self.idf = idf
+
+    @classmethod
+    def from_dict(cls, postings, idf):
+        """
+        Compresses the postings dictionary
+        :param postings: {docID: {"tf", "tf-idf", "pos"}} or ArrayPostings
+        :param idf: inverse document frequency of the term
+        :return: CompressedPostings
+        """
+        items = sorted(postings.items())
+        data, block_ptr, block_last = encode_postings([doc_id for doc_id, _ in items],
+                                                      [posting["pos"] for _, posting in items])
+        return cls(data, block_ptr, block_last, len(items), idf)
+
+    def decode_block(self, block):
+        """
+        Decodes one block
+        :param block: block number
+        :return: doc_ids, counts, positions - int arrays, positions as list of arrays (one per posting)
+        """
+        n = min(BLOCK_SIZE, self.length - block * BLOCK_SIZE)
+        values = decode_varint(self.data[self.block_ptr[block]:self.block_ptr[block + 1]])
+        previous = int(self.block_last[block - 1]) if block > 0 else 0
+        doc_ids = previous + np.cumsum(values[:n])
+        counts = values[n:2 * n]
+        position_sums = np.cumsum(values[2 * n:])
+        ends = np.cumsum(counts)
+        # position gaps restart at every posting - subtract the running sum reached before the posting
+        bases = np.concatenate(([0], position_sums))[ends - counts]
+        positions = np.split(position_sums - np.repeat(bases, counts), ends[:-1])
+        return doc_ids, counts, positions
+
+    def block_doc_ids(self, block):
+        """
+        Decodes only the document ids of one block
+        :param block: block number
+        :return: doc_ids int array
+        """
+        n = min(BLOCK_SIZE, self.length - block * BLOCK_SIZE)
+        values = decode_varint(self.data[self.block_ptr[block]:self.block_ptr[block + 1]], n)
+        previous = int(self.block_last[block - 1]) if block > 0 else 0
+        return previous + np.cumsum(values)
+
+    def blocks(self, idf=None):
+        """
+        Decodes the postings block by block
+        :param idf: idf used for the tf-idf weights instead of the stored one
+        :return: generator of (doc_ids, tf_idf) arrays
+        """
+        idf = self.idf if idf is None else idf
+        for block in range(len(self.block_last)):
+            n = min(BLOCK_SIZE, self.length - block * BLOCK_SIZE)
+            values = decode_varint(self.data[self.block_ptr[block]:self.block_ptr[block + 1]])
+            previous = int(self.block_last[block - 1]) if block > 0 else 0
+            yield previous + np.cumsum(values[:n]), (1 + np.log10(values[n:2 * n].astype(np.float64))) * idf
+
+    def _find(self, doc_id):
+        try:
+            key = int(doc_id)
+        except (TypeError, ValueError):
+            return None
+        block = int(np.searchsorted(self.block_last, key))
+        if block >= len(self.block_last):
+            return None
+        doc_ids, counts, positions = self.decode_block(block)
+        i = int(np.searchsorted(doc_ids, key))
+        if i < len(doc_ids) and doc_ids[i] == key:
+            return counts[i], positions[i]
+        return None
+
+    def _posting(self, count, positions):
+        tf = 1 + np.log10(float(count))
+        return {"tf": tf, "tf-idf": tf * self.idf, "pos": positions.tolist()}
+
+    def __getitem__(self, doc_id):
+        found = self._find(doc_id)
+        if found is None:
+            raise KeyError(doc_id)
+        return self._posting(*found)
+
+    def __contains__(self, doc_id):
+        return self._find(doc_id) is not None
+
+    def __iter__(self):
+        for block in range(len(self.block_last)):
+            yield from self.decode_block(block)[0].tolist()
+
+    def __len__(self):
+        return self.length
+
+    def items(self):
+        """
+        Decodes all postings block by block
+        :return: list of (docID, {"tf", "tf-idf", "pos"})
+        """
+        items = []
+        for block in range(len(self.block_last)):
+            doc_ids, counts, positions = self.decode_block(block)
+            items += [(doc_id, self._posting(count, pos))
+                      for doc_id, count, pos in zip(doc_ids.tolist(), counts.tolist(), positions)]
+        return items
+
+    def to_dict(self):
+        """
+        Decodes the postings into a plain (modifiable) dictionary
+        :return: {docID: {"tf", "tf-idf", "pos"}}
+        """
+        return dict(self.items())
+
+
+class ArrayPostings(Mapping):
+    """
+    Read-only postings of one term kept in NumPy arrays (e.g. slices of the binary index sections)
+
+    Behaves like the {docID: {"tf", "tf-idf", "pos"}} dictionary of the in-memory index, a posting is found
+    by binary search in the sorted document ids. Scoring reads the arrays directly.
+
+    Attributes:
+    doc_ids: sorted document ids
+    tf, tf_idf: tf and tf-idf of the postings
+    pos_ptr: offset of the positions of every posting in pos (length + 1)
+    pos: positions of the term
+    """
+
+    def __init__(self, doc_ids, tf, tf_idf, pos_ptr, pos):
+        """
+        Initializes the postings
+        :param doc_ids: sorted document ids
+        :param tf: tf of the postings
+        :param tf_idf: tf-idf of the postings
+        :param pos_ptr: offset of the positions of every posting in pos (length + 1)
+        :param pos: positions of the term
+        """
+        self.doc_ids = doc_ids
+        self.tf = tf
+        self.tf_idf = tf_idf
+        self.pos_ptr = pos_ptr
+        self.pos = pos
+
+    def arrays(self, idf=None):
+        """
+        Returns the postings as arrays
+        :param idf: idf used for the tf-idf weights instead of the stored ones
+        :return: doc_ids, tf-idf weights
+        """
+        if idf is None:
+            return self.doc_ids, self.tf_idf
+        return self.doc_ids, self.tf * idf
+
+    def _find(self, doc_id):
+        i = int(np.searchsorted(self.doc_ids, doc_id))
+        if i < len(self.doc_ids) and self.doc_ids[i] == doc_id:
+            return i
+        return None
+
+    def _posting(self, i):
+        return {"tf": float(self.tf[i]), "tf-idf": float(self.tf_idf[i]),
+                "pos": self.pos[self.pos_ptr[i]:self.pos_ptr[i + 1]].tolist()}
+
+    def __getitem__(self, doc_id):
+        i = self._find(doc_id)
+        if i is None:
+            raise KeyError(doc_id)
+        return self._posting(i)
+
+    def __contains__(self, doc_id):
+        return self._find(doc_id) is not None
+
+    def __iter__(self):
+        return iter(self.doc_ids.tolist())
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def items(self):
+        """
+        Returns all postings
+        :return: list of (docID, {"tf", "tf-idf", "pos"})
+        """
+        positions = self.pos[self.pos_ptr[0]:self.pos_ptr[-1]].tolist()
+        ptr = (self.pos_ptr - self.pos_ptr[0]).tolist()
+        return [(doc_id, {"tf": tf, "tf-idf": tf_idf, "pos": positions[ptr[i]:ptr[i + 1]]})
+                for i, (doc_id, tf, tf_idf) in enumerate(zip(self.doc_ids.tolist(), self.tf.tolist(),
+                                                             self.tf_idf.tolist()))]
+
+    def to_dict(self):
+        """
+        Converts the postings into a plain (modifiable) dictionary
+        :return: {docID: {"tf", "tf-idf", "pos"}}
+        """
+        return dict(self.items())
+
+
+def postings_arrays(postings, idf=None):
+    """
+    Returns the document ids and weights of the postings of a term as arrays (in the order of the postings)
+    :param postings: {docID: {"tf", "tf-idf", "pos"}} dictionary, ArrayPostings, CompressedPostings or any postings
+                     object with its own arrays() method
+    :param idf: if given, the weights are computed as tf * idf instead of the stored tf-idf
+    :return: doc_ids (int array), weights (float array)
+    """
+    if isinstance(postings, CompressedPostings):
+        blocks = list(postings.blocks(idf))
+        if not blocks:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        return np.concatenate([doc_ids for doc_ids, _ in blocks]), np.concatenate([weights for _, weights in blocks])
+    if isinstance(postings, dict):
+        doc_ids = np.fromiter(postings.keys(), dtype=np.int64, count=len(postings))
+        key = "tf-idf" if idf is None else "tf"
+        weights = np.fromiter((posting[key] for posting in postings.values()), dtype=np.float64, count=len(postings))
+        return doc_ids, weights if idf is None else weights * idf
+    return postings.arrays(idf)
+
+
+def impact_bounds(doc_ids, tf, starts, norms):
+    """
+    Computes the impact bounds of terms for the pruned top-k search
+    The impact of a posting is tf / document norm, the bound of a term is the maximum over its postings,
+    so the term adds at most query weight * idf * bound / query norm to the cosine similarity of any document.
+    :param doc_ids: document ids of the postings of all terms (concatenated)
+    :param tf: tf of the postings
+    :param starts: offset of the first posting of every term, every term has at least one posting
+    :param norms: document norms indexed by docID
+    :return: bound of every term
+    """
+    if len(starts) == 0:
+        return np.empty(0, dtype=np.float64)
+    # a document with zero norm has only terms with zero idf (or none), its postings add nothing to a score
+    doc_norms = norms[doc_ids]
+    impacts = np.divide(np.asarray(tf, dtype=np.float64), doc_norms, out=np.zeros(len(doc_ids)),
+                        where=doc_norms > 0)
+    return np.maximum.reduceat(impacts, starts)
+
+
+def impact_bound(postings, norms):
+    """
+    Computes the impact bound of the postings of one term, see impact_bounds
+    :param postings: postings of the term
+    :param norms: document norms indexed by docID
+    :return: bound
+    """
+    doc_ids, tf = postings_arrays(postings, idf=1.0)  # weights with idf 1 are the tf
+    if len(doc_ids) == 0:
+        return 0.0
+    return float(impact_bounds(doc_ids, tf, np.zeros(1, dtype=np.int64), norms)[0])
@@ -1,10 +1,106 @@
+import itertools
+import json
+import os
 import re
+import numpy as np
 from simplemma.langdetect import lang_detector
 import simplemma
 import utils.stemmer_cs
 import utils.stemmer_sk
 from lemmagen3 import Lemmatizer
 
+HTML_TAGS_REGEX = r"<.*?>"
+CITATION_MARKS_REGEX = r"\[\d+\]"
+PARENTHESES_REGEX = r"[\(\)\[\]\{\}]"
+
+
+class TokenCache:
+    """
+    Bounded cache of the normalized forms of tokens (stems, lemmas)
+
+    Most token occurrences are a small vocabulary (Zipf's law), so every form is computed only once.
+    There is one cache per normalization and language, e.g. "stem:cs". When a cache is full, new forms
+    are computed but not added - the frequent tokens are usually seen first.
+
+    Attributes:
+    max_size: max number of tokens in the cache of one normalization and language
+    forms: {normalization and language: {token: normalized form}}
+    """
+
+    def __init__(self, max_size=200000):
+        """
+        Initializes an empty cache
+        :param max_size: max number of tokens in the cache of one normalization and language
+        """
+        self.max_size = max_size
+        self.forms = {}
+
+    def normalize(self, kind, tokens, function):
+        """
+        Normalizes the tokens, the forms that are not cached are computed by the function
+        :param kind: normalization and language, e.g. "stem:cs"
+        :param tokens: input tokens
+        :param function: normalization of one token
+        :return: list of normalized tokens
+        """
+        forms = self.forms.setdefault(kind, {})
+        normalized = []
+        for token in tokens:
+            form = forms.get(token)
+            if form is None:
+                form = function(token)
+                if len(forms) < self.max_size:
+                    forms[token] = form
+            normalized.append(form)
+        return normalized
+
+    def sizes(self):
+        """
+        Returns the number of cached forms of every normalization and language, used with added_since
+        :return: {normalization and language: number of forms}
+        """
+        return {kind: len(forms) for kind, forms in self.forms.items()}
+
+    def added_since(self, sizes):
+        """
+        Returns the forms added after the sizes were taken - forms are never removed, so they are the last ones
+        :param sizes: output of sizes
+        :return: {normalization and language: {token: normalized form}}
+        """
+        return {kind: dict(itertools.islice(forms.items(), sizes.get(kind, 0), None))
+                for kind, forms in self.forms.items() if len(forms) > sizes.get(kind, 0)}
+
+    def update(self, new_forms):
+        """
+        Adds the forms to the cache, the forms that are already cached are kept
+        :param new_forms: {normalization and language: {token: normalized form}}
+        """
+        for kind, kind_forms in new_forms.items():
+            forms = self.forms.setdefault(kind, {})
+            for token, form in itertools.islice(kind_forms.items(), max(0, self.max_size - len(forms))):
+                forms.setdefault(token, form)
+
+    def save(self, path):
+        """
+        Saves the cached forms to a JSON file
+        :param path: path to the file
+        """
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.forms, file, ensure_ascii=False)
+
+    def load(self, path):
+        """
+        Adds the forms from a file saved by save to the cache, does nothing if the file doesn't exist
+        :param path: path to the file
+        """
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as file:
+            self.update(json.load(file))
+
+token_cache = TokenCache()  # shared by all pipelines
+_lemmatizers = {}  # lemmagen3 lemmatizers by language, loading one is slow
+
 
 def to_lower(text):
     """
@@ -21,7 +117,7 @@ def remove_html_tags(text):
     :param text: input text
     :return: text without html tags
     """
-    return re.sub(r"<.*?>", "", text)
+    return re.sub(HTML_TAGS_REGEX, "", text)
 
 
 def remove_in_text_citation_marks(text):
@@ -30,7 +126,7 @@ def remove_in_text_citation_marks(text):
     :param text: input text
     :return: text without in text citation marks
     """
-    return re.sub(r"\[\d+\]", "", text)
+    return re.sub(CITATION_MARKS_REGEX, "", text)
 
 
 def remove_parentheses(text):
@@ -40,7 +136,7 @@ def remove_parentheses(text):
     :return: text without parentheses
     """
     # remove also single parentheses
-    return re.sub(r"[\(\)\[\]\{\}]", "", text)
+    return re.sub(PARENTHESES_REGEX, "", text)
 
 
 def remove_stop_words(stop_words_file, tokens):
@@ -61,6 +157,15 @@ def tokenize(text):
     :param text: input text
     :return: list of tokens
     """
+    return [token for _, token in tokenize_with_starts(text)]
+
+
+def tokenize_with_starts(text):
+    """
+    Tokenizes the text like tokenize and returns also the offsets of the tokens in the text
+    :param text: input text
+    :return: list of (offset, token)
+    """
     default_regex = r"(\d+[.,]\d+?)|([\w]+)"  # default regex - numbers and words
     url_regex = r"(https?:\/\/[^\s]+)"
     date_regex = r"(\d{1,2}\.\d{1,2}\.\d{4})"  # date in format dd.mm.yyyy
@@ -69,18 +174,43 @@ def tokenize(text):
     words_with_stars = r"(\w+\*\w+)"
 
     tokenized = []
+    start = 0
     for word in text.split(' '):
+        offset = start
+        start += len(word) + 1
         word = word.replace("-", " ").replace("_", " ")
         if re.match(url_regex, word) or re.match(date_regex, word) or re.match(time_regex, word) or re.match(
                 email_regex, word) or re.match(words_with_stars, word):
-            tokenized.append(word)
+            tokenized.append((offset, word))
         else:
             matched = re.match(default_regex, word)
             if matched:
-                tokenized.append(matched.group())
+                tokenized.append((offset, matched.group()))
 
     return tokenized
 
+
+def remove_with_mapping(pattern, text, mapping):
+    """
+    Removes the matches of the pattern from the text like re.sub(pattern, "", text) and keeps the offsets
+    of the remaining characters in the original text
+    :param pattern: regex to remove
+    :param text: input text
+    :param mapping: offset of every character of the text in the original text (int array)
+    :return: text without the matches, mapping of its characters
+    """
+    parts, mapping_parts, last = [], [], 0
+    for matched in re.finditer(pattern, text):
+        parts.append(text[last:matched.start()])
+        mapping_parts.append(mapping[last:matched.start()])
+        last = matched.end()
+    if last == 0:
+        return text, mapping
+    parts.append(text[last:])
+    mapping_parts.append(mapping[last:])
+    return "".join(parts), np.concatenate(mapping_parts)
+
+
 def tokenize_snippet(text):
     """
     Tokenizes the text using regexs for urls, dates, times, emails and words with stars and default regex
@@ -119,11 +249,13 @@ def stem(line, tokens, aggressive=True):
     language = lang_detector(line, lang=('cs', 'sk'))  # detect language
     language = dict(language)
     try:
-        if language['cs'] > language['sk']:  # if czech
-            return [utils.stemmer_cs.stem(word, aggressive) for word in tokens]
-        return [utils.stemmer_sk.stem(word, aggressive) for word in tokens]
+        czech = language['cs'] > language['sk']
     except KeyError:  # if no language detected
-        return [utils.stemmer_cs.stem(word, aggressive) for word in tokens]
+        czech = True
+    kind = "stem" if aggressive else "light_stem"
+    if czech:
+        return token_cache.normalize(kind + ":cs", tokens, lambda word: utils.stemmer_cs.stem(word, aggressive))
+    return token_cache.normalize(kind + ":sk", tokens, lambda word: utils.stemmer_sk.stem(word, aggressive))
 
 
 def lemmatize(line, tokens):
@@ -134,7 +266,8 @@ def lemmatize(line, tokens):
     :return: list of lemmatized tokens
     """
 
-    lemmatized = [simplemma.lemmatize(word, lang=("cs", "sk"), greedy=True) for word in tokens]
+    lemmatized = token_cache.normalize("lemma:cs+sk", tokens,
+                                       lambda word: simplemma.lemmatize(word, lang=("cs", "sk"), greedy=True))
 
 
     # don't lemmatize urls and emails
@@ -153,9 +286,9 @@ def lemmatize2(line, tokens):
     :param tokens: input tokens
     :return: list of lemmatized tokens
     """
-    lem_cs = Lemmatizer('cs')
-
-    lemmatized = [lem_cs.lemmatize(word) for word in tokens]
+    if "cs" not in _lemmatizers:
+        _lemmatizers["cs"] = Lemmatizer('cs')
+    lemmatized = token_cache.normalize("lemmagen:cs", tokens, _lemmatizers["cs"].lemmatize)
 
 
     # don't lemmatize urls and emails
@@ -0,0 +1,119 @@
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class QueryStats:
+    """
+    Measurements of one search - where the time was spent and how much work was done
+
+    Attributes:
+    query: searched query
+    field: searched field, empty for all fields
+    model: model of the search
+    k: number of best documents
+    stages: {stage: wall time in seconds}, stages are named after the functions of the searcher
+    postings: number of postings read
+    scored: number of documents that got a score
+    snippets: number of snippets created (snippets are created when the results are shown)
+    cached: whether the results were taken from the result cache
+    total: wall time of the search in seconds (without the snippets)
+    """
+
+    def __init__(self, query="", field="", model="", k=0):
+        """
+        Initializes empty measurements
+        :param query: searched query
+        :param field: searched field
+        :param model: model of the search
+        :param k: number of best documents
+        """
+        self.query = query
+        self.field = field
+        self.model = model
+        self.k = k
+        self.stages = {}
+        self.postings = 0
+        self.scored = 0
+        self.snippets = 0
+        self.cached = False
+        self.total = 0.0
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Measures the wall time of a stage, the times of repeated stages are added up
+        :param name: name of the stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def as_dict(self):
+        """
+        Returns the measurements as a dictionary (JSON serializable)
+        :return: dictionary of the measurements, times in milliseconds
+        """
+        return {"query": self.query, "field": self.field, "model": self.model, "k": self.k,
+                "total_ms": self.total * 1000, "cached": self.cached,
+                "stages_ms": {name: seconds * 1000 for name, seconds in self.stages.items()},
+                "postings": self.postings, "scored": self.scored, "snippets": self.snippets}
+
+    def explain(self):
+        """
+        Returns the measurements as a readable text
+        :return: text with one line per stage
+        """
+        lines = ["Query: {} (field: {}, model: {}, k: {}){}".format(self.query, self.field or "all", self.model,
+                                                                    self.k, " - cached" if self.cached else ""),
+                 "Total: {:.3f} ms".format(self.total * 1000)]
+        for name, seconds in sorted(self.stages.items(), key=lambda item: -item[1]):
+            lines.append("  {:<40} {:10.3f} ms".format(name, seconds * 1000))
+        lines.append("Postings read: {}, documents scored: {}, snippets created: {}".format(
+            self.postings, self.scored, self.snippets))
+        return "\n".join(lines)
+
+
+class SlowQueryLog:
+    """
+    Log of the searches slower than a threshold - the last entries are kept in memory and every entry
+    is appended to a file as a JSON line
+
+    Attributes:
+    threshold: min time of a logged search in seconds, None disables the log
+    path: path to the log file, None keeps the entries only in memory
+    entries: last logged measurements (dictionaries of QueryStats.as_dict)
+    """
+
+    def __init__(self, threshold, path=None, max_entries=100):
+        """
+        Initializes the log
+        :param threshold: min time of a logged search in seconds, None disables the log
+        :param path: path to the log file, None keeps the entries only in memory
+        :param max_entries: number of the entries kept in memory
+        """
+        self.threshold = threshold
+        self.path = path
+        self.entries = deque(maxlen=max_entries)
+        self.lock = threading.Lock()
+
+    def record(self, stats):
+        """
+        Logs the search if it was slower than the threshold
+        :param stats: QueryStats of the search
+        :return: True if the search was logged
+        """
+        if self.threshold is None or stats.total < self.threshold:
+            return False
+        entry = dict(stats.as_dict(), time=time.strftime("%Y-%m-%dT%H:%M:%S"))
+        print("Slow query ({:.1f} ms): {}".format(entry["total_ms"], stats.query))
+        with self.lock:
+            self.entries.append(entry)
+            if self.path is not None:
+                with open(self.path, "a", encoding="utf-8") as file:
+                    file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        return True
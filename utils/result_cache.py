@@ -0,0 +1,89 @@
+import itertools
+import sys
+import threading
+from collections import OrderedDict
+
+# generations are unique across all indexes, so a key with the generation can't match a result of another index
+_generations = itertools.count(1)
+
+
+def new_generation():
+    """
+    Returns a new generation for an index - every change of an index that can change the search results
+    gives it a new generation, so the cached results of the previous one are not used anymore
+    :return: generation number
+    """
+    return next(_generations)
+
+
+class ResultCache:
+    """
+    LRU cache of the search results bounded by their approximate size in memory
+
+    Attributes:
+    max_bytes: max size of the cached results, 0 disables the cache
+    size: approximate size of the cached results in bytes
+    hits: number of the results found in the cache
+    misses: number of the results not found in the cache
+    """
+
+    def __init__(self, max_bytes):
+        """
+        Initializes an empty cache
+        :param max_bytes: max size of the cached results, 0 disables the cache
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key: (value, size), the least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached value and marks it as recently used
+        :param key: key of the value
+        :return: value, None if it is not in the cache
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        """
+        Adds the value to the cache, the least recently used values are evicted to keep the size bound
+        :param key: key of the value
+        :param value: value to cache
+        :param size: approximate size of the value in bytes
+        """
+        size += sys.getsizeof(key)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.size -= self.entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        """
+        Removes all values from the cache, the counters are kept
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Returns the counters of the cache
+        :return: {"hits", "misses", "entries", "bytes"}
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.size}
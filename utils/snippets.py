@@ -0,0 +1,56 @@
+import base64
+import html
+
+import numpy as np
+
+from utils.postings_codec import decode_varint, encode_varint
+
+HIGHLIGHT = '<span style="background-color:#4B77BE;">{}</span>'
+
+
+def encode_offsets(starts, ends):
+    """
+    Encodes the offsets of the tokens of a text - gaps between the starts and lengths of the tokens as varints
+    :param starts: start of every token in the text (non-decreasing int array)
+    :param ends: end of every token in the text
+    :return: base64 string
+    """
+    values = np.empty(2 * len(starts), dtype=np.int64)
+    values[0::2] = np.diff(starts, prepend=0)
+    values[1::2] = np.asarray(ends) - np.asarray(starts)
+    return base64.b64encode(encode_varint(values).tobytes()).decode("ascii")
+
+
+def decode_offsets(encoded):
+    """
+    Decodes the offsets of the tokens encoded by encode_offsets
+    :param encoded: base64 string
+    :return: starts, ends - int arrays
+    """
+    values = decode_varint(np.frombuffer(base64.b64decode(encoded), dtype=np.uint8))
+    starts = np.cumsum(values[0::2])
+    return starts, starts + values[1::2]
+
+
+def slice_snippet(text, starts, ends, first, last, highlighted):
+    """
+    Creates the snippet as a slice of the original text from the first token to the last token (excluded)
+    :param text: original text
+    :param starts: start of every token in the text
+    :param ends: end of every token in the text
+    :param first: first token of the snippet
+    :param last: token after the snippet
+    :param highlighted: set of the tokens to highlight
+    :return: HTML snippet - escaped text with the highlighted tokens, whitespace collapsed
+    """
+    if first >= last:
+        return ""
+    parts = []
+    previous = int(starts[first])
+    for i in sorted(token for token in highlighted if first <= token < last):
+        start, end = int(starts[i]), int(ends[i])
+        parts.append(html.escape(text[previous:start]))
+        parts.append(HIGHLIGHT.format(html.escape(text[start:end])))
+        previous = end
+    parts.append(html.escape(text[previous:int(ends[last - 1])]))
+    return " ".join("".join(parts).split())
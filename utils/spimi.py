@@ -0,0 +1,140 @@
+import heapq
+import itertools
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+
+# rough memory cost of the in-memory block used to decide when to flush a run (bytes)
+TERM_OVERHEAD = 200
+POSTING_OVERHEAD = 120
+POSITION_SIZE = 8
+
+
+class SpimiBuilder:
+    """
+    Block-based (SPIMI) index builder for corpora that don't fit into memory
+
+    Documents are indexed into an in-memory block until its estimated size exceeds the memory budget.
+    The block is then written to disk as a run sorted by term and emptied. At the end the runs are
+    merged term by term (k-way merge) into the binary index, only the postings of one term and the
+    document norms are kept in memory during the merge.
+
+    Attributes:
+    fields: indexed fields
+    memory_budget: maximal estimated size of the in-memory block in bytes
+    temp_folder: folder with the runs
+    runs: number of runs written
+    block: in-memory block {field: {term: (doc_ids, positions)}}
+    block_size: estimated size of the block in bytes
+    num_docs: number of indexed documents
+    max_doc: highest document id
+    """
+
+    def __init__(self, fields, folder, memory_budget=256 * 1024 * 1024):
+        """
+        Initializes the builder
+        :param fields: fields to index
+        :param folder: folder for the temporary runs
+        :param memory_budget: maximal estimated size of the in-memory block in bytes
+        """
+        self.fields = list(fields)
+        self.memory_budget = memory_budget
+        self.temp_folder = tempfile.mkdtemp(prefix=".tmp_spimi_", dir=folder)
+        self.runs = 0
+        self.block = {field: {} for field in self.fields}
+        self.block_size = 0
+        self.num_docs = 0
+        self.max_doc = -1
+
+    def add(self, preped_doc):
+        """
+        Adds a preprocessed document, documents must be added in increasing id order
+        :param preped_doc: preprocessed document (output of preprocessing_pipelines.preprocess)
+        """
+        doc_id = int(preped_doc["id"])
+        for field in self.fields:
+            block = self.block[field]
+            doc_positions = {}
+            for pos, token in enumerate(preped_doc[field]):
+                positions = doc_positions.get(token)
+                if positions is None:
+                    doc_positions[token] = [pos]
+                else:
+                    positions.append(pos)
+            for token, positions in doc_positions.items():
+                postings = block.get(token)
+                if postings is None:
+                    block[token] = postings = ([], [])
+                    self.block_size += TERM_OVERHEAD + len(token)
+                postings[0].append(doc_id)
+                postings[1].append(positions)
+                self.block_size += POSTING_OVERHEAD + POSITION_SIZE * len(positions)
+        self.num_docs += 1
+        self.max_doc = max(self.max_doc, doc_id)
+        if self.block_size >= self.memory_budget:
+            self.flush()
+
+    def _run_path(self, run, field):
+        return os.path.join(self.temp_folder, "run_{}_{}".format(run, self.fields.index(field)))
+
+    def flush(self):
+        """
+        Writes the in-memory block to disk as a run sorted by term
+        """
+        if self.block_size == 0:
+            return
+        for field in self.fields:
+            block = self.block[field]
+            with open(self._run_path(self.runs, field), "wb") as file:
+                for token in sorted(block.keys()):
+                    pickle.dump((token,) + block[token], file, protocol=pickle.HIGHEST_PROTOCOL)
+        print("Written run", self.runs, "with estimated size", self.block_size, "B")
+        self.runs += 1
+        self.block = {field: {} for field in self.fields}
+        self.block_size = 0
+
+    def _read_run(self, run, field):
+        """
+        Reads the run sequentially
+        :param run: number of the run
+        :param field: field to read
+        :return: generator of (term, doc_ids, positions)
+        """
+        with open(self._run_path(run, field), "rb") as file:
+            while True:
+                try:
+                    yield pickle.load(file)
+                except EOFError:
+                    return
+
+    def merge(self, writer):
+        """
+        Merges the runs into the binary index, computes idf, tf-idf and the document norms
+        :param writer: utils.index_storage.IndexWriter to write the postings to
+        """
+        self.flush()
+        N = self.num_docs
+        for field in self.fields:
+            norms = np.zeros(self.max_doc + 1, dtype=np.float64)
+            has_field = np.zeros(self.max_doc + 1, dtype=bool)
+            writer.begin_field(field)
+            # heapq.merge keeps the run order for equal terms, so the documents stay sorted
+            runs = heapq.merge(*[self._read_run(run, field) for run in range(self.runs)], key=lambda item: item[0])
+            for token, group in itertools.groupby(runs, key=lambda item: item[0]):
+                doc_ids, positions = [], []
+                for _, run_doc_ids, run_positions in group:
+                    doc_ids += run_doc_ids
+                    positions += run_positions
+                df = len(doc_ids)
+                idf = np.log10(N / float(df))
+                tf = 1 + np.log10(np.fromiter(map(len, positions), dtype=np.float64, count=df))
+                tf_idf = tf * idf
+                norms[doc_ids] += tf_idf ** 2
+                has_field[doc_ids] = True
+                writer.add_term(token, df, idf, doc_ids, tf.tolist(), tf_idf.tolist(), positions)
+            present = np.flatnonzero(has_field)
+            writer.end_field(present, np.sqrt(norms[present]))
+        shutil.rmtree(self.temp_folder)
@@ -1,126 +1,324 @@
+import contextlib
+import threading
 import time
 import json
-from lxml import html
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from urllib.parse import urlsplit
+from lxml import etree, html
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 
+BASE_URL = 'https://theelderscrolls.fandom.com'  # base of the relative links of the wiki
 
-def crawl(seed_url, wait_time=1):
+
+class TokenBucket:
+    """
+    Token bucket limiting the rate of requests to one host - a request takes a token, tokens are added
+    at the given rate up to the burst size
+
+    Attributes:
+    rate:  tokens added per second
+    burst:  max number of tokens
+    tokens:  available tokens
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        Initializes a full bucket
+        :param rate:  requests per second
+        :param burst:  max number of requests sent at once
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token, waits until one is available
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class Crawler:
+    """
+    Concurrent crawler of the wiki
+    Pages are downloaded by a pool of threads sharing one session (kept-alive connections), so at most
+    `concurrency` requests are in flight. Requests to every host are limited by a token bucket (politeness).
+    The article pages are parsed in a pool of processes, so the parsing doesn't hold up the downloads.
+
+    Attributes:
+    base_url:  base of the relative links (a local server can be used instead of the wiki)
+    concurrency:  max number of requests in flight
+    rate:  max requests per second to one host, None for no limit
+    burst:  max requests sent to one host at once
+    parse_workers:  number of processes parsing the articles, None for the number of CPUs, 0 parses in this process
+    timeout:  timeout of a request in seconds
+    session:  HTTP session with the connection pool
+    """
+
+    def __init__(self, base_url=BASE_URL, concurrency=8, rate=1.0, burst=1, parse_workers=None, timeout=30,
+                 retries=3):
+        """
+        Initializes the crawler
+        :param base_url:  base of the relative links
+        :param concurrency:  max number of requests in flight
+        :param rate:  max requests per second to one host, None for no limit
+        :param burst:  max requests sent to one host at once
+        :param parse_workers:  number of processes parsing the articles, None for the number of CPUs,
+                               0 parses in this process
+        :param timeout:  timeout of a request in seconds
+        :param retries:  number of retries of a failed request (connection errors, 429 and 5xx responses)
+        """
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.parse_workers = parse_workers
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                      respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.buckets = {}  # host: TokenBucket
+        self.buckets_lock = threading.Lock()
+
+    def fetch(self, url):
+        """
+        Downloads the page, waits for the politeness limit of its host
+        :param url:  URL of the page
+        :return:  final URL (after redirects), content of the page
+        """
+        if self.rate is not None:
+            host = urlsplit(url).netloc
+            with self.buckets_lock:
+                bucket = self.buckets.get(host)
+                if bucket is None:
+                    bucket = self.buckets[host] = TokenBucket(self.rate, self.burst)
+            bucket.acquire()
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.url, response.content
+
+    def crawl(self, seed_url):
+        """
+        Crawls the list of all pages of the wiki and returns the topics references
+        The navigation pages found on the downloaded pages are downloaded concurrently.
+        :param seed_url:  URL of the seed page
+        :return:  list of topics references (in the order the pages were found)
+        """
+        visited = {seed_url}  # set of visited URLs
+        topics_refs = []
+        with ThreadPoolExecutor(self.concurrency) as fetchers:
+            pending = {fetchers.submit(self.fetch, seed_url): seed_url}
+            while pending:  # while there are still URLs to visit
+                for done in wait(pending, return_when=FIRST_COMPLETED).done:
+                    url = pending.pop(done)
+                    try:
+                        _, content = done.result()
+                        tree = html.fromstring(content)  # parse the page
+                    except (requests.RequestException, etree.LxmlError) as e:  # the other pages are still crawled
+                        print('Error: ' + url)
+                        print('Exception: ' + str(e))
+                        continue
+                    for link in tree.xpath('//div[@class="mw-allpages-nav"]//a/@href'):  # links to the next pages
+                        link = self.base_url + link  # create full URL
+                        if link not in visited:
+                            visited.add(link)
+                            pending[fetchers.submit(self.fetch, link)] = link
+                    topics_refs.extend(tree.xpath('//div[@class="mw-allpages-body"]//a/@href'))  # topics references
+        return topics_refs
+
+    def scrape(self, topics_refs, folder=None):
+        """
+        Downloads and parses the pages of the topics
+        With a folder every document is saved to a JSON file as soon as it is parsed, so the documents are not
+        kept in memory and the documents scraped before a crash are kept. Without a folder the documents are
+        returned.
+        :param topics_refs:  list of topics references
+        :param folder:  folder to save the JSON files, None to return the documents
+        :return:  list of the documents (title, table_of_contents, infobox, content) in the order of the topics,
+                  None if they are saved to the folder
+        """
+        unique_topics = set()  # set of unique topics URLs to avoid duplicates
+        documents = {}
+
+        def parsed(number, json_output):
+            if json_output is None:
+                return
+            if folder is None:
+                documents[number] = json_output
+            else:
+                save_document(json_output, folder)
+
+        parse_workers = self.parse_workers if len(topics_refs) > 1 else 0
+        with ThreadPoolExecutor(self.concurrency) as fetchers, \
+                (ProcessPoolExecutor(parse_workers) if parse_workers != 0 else contextlib.nullcontext()) as parsers:
+            fetches = {fetchers.submit(self.fetch, self.base_url + topic): (number, topic)
+                       for number, topic in enumerate(topics_refs)}
+            parses = {}
+            for done in as_completed(fetches):
+                number, topic = fetches.pop(done)  # the page is not kept after it is parsed
+                try:
+                    subpage_url, content = done.result()
+                except requests.RequestException as e:
+                    print('Error: ' + topic)
+                    print('Exception: ' + str(e))
+                    continue
+                subpage_url = subpage_url.split('#')[0]  # remove the anchor
+                if subpage_url in unique_topics:  # if the URL was already visited, skip it
+                    continue
+                unique_topics.add(subpage_url)
+                print(subpage_url)
+                if parsers is None:
+                    parsed(number, _parse_topic(topic, content))
+                    continue
+                parses[parsers.submit(_parse_topic, topic, content)] = number
+                for parse in wait(parses, timeout=0).done:  # documents parsed while downloading
+                    parsed(parses.pop(parse), parse.result())
+            for parse in as_completed(parses):
+                parsed(parses[parse], parse.result())
+
+        if folder is None:
+            return [documents[number] for number in sorted(documents)]
+
+
+def save_document(json_output, folder):
+    """
+    Saves the document to a JSON file named by its title
+    :param json_output:  document - title, table_of_contents, infobox, content
+    :param folder:  folder to save the JSON file to
+    """
+    # remove quotes from title, replace / and : with _
+    name = json_output['title'].replace('"', '').replace('/', '_').replace(':', '_')
+    with open(os.path.join(folder, name + '.json'), 'w', encoding="utf-8") as f:  # save the JSON file
+        json.dump(json_output, f, ensure_ascii=False, indent=4)
+
+
+def parse_article(content):
+    """
+    Parses the page of an article
+    :param content:  HTML of the page
+    :return:  JSON content - title, table_of_contents, infobox, content
+    """
+    subtree = html.fromstring(content)  # parse the page
+    title = subtree.xpath('//span[@class="mw-page-title-main"]/text()')  # get the title
+
+    content = subtree.xpath('string(//div[@class="mw-parser-output"])')  # get the content - full text
+
+    toc = subtree.xpath('string(//div[@class="toc"])')  # get the table of contents
+
+    infobox = subtree.xpath('string(//table[@class="infobox"])')  # get the infobox
+
+    if toc:  # if there is a table of contents
+        content = content.replace(toc, '')  # remove it from the content
+        toc = toc.split('\n')  # split the table of contents by new line
+        toc = list(filter(None, toc))  # remove empty strings from the list
+
+    if infobox:  # if there is an infobox
+        content = content.replace(infobox, '')  # remove it from the content
+        infobox = infobox.replace('\n', ' ')  # remove new lines
+        infobox = ' '.join(infobox.split())  # remove more than 1 space in a row
+
+    content = content.replace('[]', '').replace('↑', '')  # remove some characters - bullet points artefacts
+
+    # remove unnecessary parts of the content
+    if 'Zdroje\n' in content:
+        content = content.split('Zdroje\n')[0]
+    if 'Reference\n' in content:
+        content = content.split('Reference\n')[0]
+    if 'Reference a poznámky\n' in content:
+        content = content.split('Reference a poznámky\n')[0]
+    if 'Galerie\n' in content:
+        content = content.split('Galerie\n')[0]
+
+    content = content.replace('\n', ' ')  # remove new lines
+    content = ' '.join(content.split())  # remove more than 1 space in a row
+
+    return {
+        'title': title[0],
+        'table_of_contents': toc,
+        'infobox': infobox,
+        'content': content
+    }
+
+
+def _parse_topic(topic, content):
+    """
+    Parses the page of a topic in a worker, errors are printed
+    :param topic:  topic reference
+    :param content:  HTML of the page
+    :return:  JSON content, None if the page can't be parsed
+    """
+    try:
+        json_output = parse_article(content)
+        print([json_output['title']])
+        return json_output
+    except Exception as e:  # if there is an exception, print the error
+        print('Error: ' + topic)
+        print('Exception: ' + str(e))
+        return None
+
+
+def crawl(seed_url, wait_time=1, base_url=BASE_URL, concurrency=8):
     """
     Crawl the website and return list of topics references
     :param seed_url:  URL of the seed page
-    :param wait_time:  time to wait between requests - politeness
+    :param wait_time:  min time between requests to the host - politeness
+    :param base_url:  base of the relative links
+    :param concurrency:  max number of requests in flight
     :return:  list of topics references
     """
-    visited = set()  # set of visited URLs
-    url_queue = set()
-    topics_refs = []
-    url_queue.add(seed_url)
-    visited.add(seed_url)
-    while url_queue:  # while there are still URLs to visit
-        url = url_queue.pop()  # get the next URL
-        page = requests.get(url)  # get the page
-        tree = html.fromstring(page.content)  # parse the page
-        links = tree.xpath('//div[@class="mw-allpages-nav"]//a/@href')  # get links on the page
-        for link in links:  # for each link
-            link = 'https://theelderscrolls.fandom.com' + link  # create full URL
-            if link not in visited:  # if the link was not visited
-                visited.add(link)
-                url_queue.add(link)
-        topics_refs.append(tree.xpath('//div[@class="mw-allpages-body"]//a/@href'))  # get topics references
-        time.sleep(wait_time)  # politeness
-    topics_refs = [item for sublist in topics_refs for item in sublist]  # flatten the list
-    return topics_refs
-
-
-def scrape_urls(topics_refs, folder, wait_time=1, return_json=False):
+    return Crawler(base_url, concurrency, rate=1 / wait_time if wait_time > 0 else None,
+                   parse_workers=0).crawl(seed_url)
+
+
+def scrape_urls(topics_refs, folder, wait_time=1, return_json=False, base_url=BASE_URL, concurrency=8):
     """
     Scrape the URLs and save the content to JSON files
     :param topics_refs:  list of topics references
     :param folder:  folder to save the JSON files
-    :param wait_time:  time to wait between requests - politeness
-    :param return_json:  if True, return the JSON content
-    :return:  None
-    """
-    unique_topics = set()  # set of unique topics URLs to avoid duplicates
-    for topic in topics_refs:
-        subpage = requests.get('https://theelderscrolls.fandom.com' + topic)  # get the page
-        subpage_url = subpage.request.url  # get the URL
-        subpage_url = subpage_url.split('#')[0]  # remove the anchor
-        if subpage_url in unique_topics:  # if the URL was already visited, skip it
-            continue
-        unique_topics.add(subpage_url)
-        print(subpage_url)
-        subtree = html.fromstring(subpage.content)  # parse the page
-        try:
-            title = subtree.xpath('//span[@class="mw-page-title-main"]/text()')  # get the title
-            print(title)
-
-            content = subtree.xpath('string(//div[@class="mw-parser-output"])')  # get the content - full text
-
-            toc = subtree.xpath('string(//div[@class="toc"])')  # get the table of contents
-
-            infobox = subtree.xpath('string(//table[@class="infobox"])')  # get the infobox
-
-            if toc:  # if there is a table of contents
-                content = content.replace(toc, '')  # remove it from the content
-                toc = toc.split('\n')  # split the table of contents by new line
-                toc = list(filter(None, toc))  # remove empty strings from the list
-
-            if infobox:  # if there is an infobox
-                content = content.replace(infobox, '')  # remove it from the content
-                infobox = infobox.replace('\n', ' ')  # remove new lines
-                infobox = ' '.join(infobox.split())  # remove more than 1 space in a row
-
-            content = content.replace('[]', '').replace('↑', '')  # remove some characters - bullet points artefacts
-
-            # remove unnecessary parts of the content
-            if 'Zdroje\n' in content:
-                content = content.split('Zdroje\n')[0]
-            if 'Reference\n' in content:
-                content = content.split('Reference\n')[0]
-            if 'Reference a poznámky\n' in content:
-                content = content.split('Reference a poznámky\n')[0]
-            if 'Galerie\n' in content:
-                content = content.split('Galerie\n')[0]
-
-            content = content.replace('\n', ' ')  # remove new lines
-            content = ' '.join(content.split())  # remove more than 1 space in a row
-
-            json_output = {
-                'title': title[0],
-                'table_of_contents': toc,
-                'infobox': infobox,
-                'content': content
-            }
-            # remove quotes from title, replace / and : with _
-            title[0] = title[0].replace('"', '').replace('/', '_').replace(':', '_')
-            if return_json:  # if return_json is True, return the JSON content
-                return json_output
-
-            with open(folder + '/' + title[0] + '.json', 'w', encoding="utf-8") as f:  # save the JSON file
-                json.dump(json_output, f, ensure_ascii=False, indent=4)
-
-        except Exception as e:  # if there is an exception, print the error
-            print('Error: ' + topic)
-            print('Exception: ' + str(e))
-        time.sleep(wait_time)  # politeness
-
-def scrape_url(url):
+    :param wait_time:  min time between requests to the host - politeness
+    :param return_json:  if True, return the JSON content of the first page instead of saving the files
+    :param base_url:  base of the relative links
+    :param concurrency:  max number of requests in flight
+    :return:  None, JSON content if return_json is True
+    """
+    crawler = Crawler(base_url, concurrency, rate=1 / wait_time if wait_time > 0 else None)
+    if return_json:  # if return_json is True, return the JSON content
+        documents = crawler.scrape(topics_refs[:1])
+        return documents[0] if documents else None
+    crawler.scrape(topics_refs, folder)
+
+def scrape_url(url, base_url=BASE_URL):
     """
     Scrape the URL and return the content as JSON
     :param url:  URL to scrape
+    :param base_url:  base of the relative links
     :return:  JSON content
     """
-    topic = url.replace('https://theelderscrolls.fandom.com', '')  # remove the base URL
-    json_output = scrape_urls([topic], folder='', return_json=True)  # get the JSON content
+    topic = url.replace(base_url, '')  # remove the base URL
+    json_output = scrape_urls([topic], folder='', return_json=True, base_url=base_url)  # get the JSON content
 
     return json_output
 
 
-
 def main():
-    seed_url = 'https://theelderscrolls.fandom.com/cs/wiki/Speci%C3%A1ln%C3%AD:V%C5%A1echny_str%C3%A1nky?from=%22%C5%A0%C3%ADlenci%22+z+Pl%C3%A1n%C3%AD'
+    seed_url = BASE_URL + '/cs/wiki/Speci%C3%A1ln%C3%AD:V%C5%A1echny_str%C3%A1nky?from=%22%C5%A0%C3%ADlenci%22+z+Pl%C3%A1n%C3%AD'
     wait_time = 1  # seconds
 
     topics_refs = crawl(seed_url, wait_time)  # get the topics references from the website
@@ -131,6 +329,5 @@ def main():
 
     scrape_urls(topics_refs, folder='data', wait_time=wait_time)  # scrape the URLs and save the content to JSON files
 
-
 if __name__ == '__main__':
     main()